@@ -1,20 +1,28 @@
-from multiprocessing import Queue
+# Import standard packages (the startup is measured from here)
+import time
+STARTED = time.time()
 
 # Import custom subpackages
-from core import config, monitor, viewer
-from common import utils, logger, recorder
+from core import config, supervisor
+from common import utils, logger as applog, metrics, profiler
 
 import os
 import sys
-import time
+import logging
 
 
-# Initialize the logger
-logger = logger.get_logger('voltazero_monitor')
+# Module logger (the handlers are attached by the main process only)
+logger = logging.getLogger('voltazero_monitor')
 
 
 if __name__ == '__main__':
 
+    startup = profiler.StartupTimer('main', STARTED, phase='imports')
+
+    # Initialize the logger
+    logger = applog.get_logger('voltazero_monitor')
+    startup.mark('logging')
+
     # Clear console
     utils.clear_console()
 
@@ -24,57 +32,42 @@ if __name__ == '__main__':
     # Initialization
     config_file = "./core/config.json"
 
-    # Setup telemetry queue used by the Monitor and Recorder
-    q = Queue()
-
     # Read the application config
     appConfig = config.AppConfig(config_file)
     rc = appConfig.load_app_config()
 
     if rc == -1:
         logger.error(f'The configuration file cannot be found!')
+        applog.stop_listeners()
         sys.exit()
     elif rc == -2:
         logger.error(f'An exception has occured. Application will stop!')
+        applog.stop_listeners()
         sys.exit()
     else:
         logger.info(f'App configuration loaded and parsed successfully.')
+        applog.set_levels(appConfig.log_levels)
+    startup.mark('config')
 
-    # Start the Monitor and establish connection to the MQTT broker
-    pmonitor = monitor.Monitor(appConfig, q, client_id="cp100")
-    pmonitor.start()
+    # Expose the main process metrics (Recorder) if enabled
+    metrics.start_server(appConfig.metrics_port, 'main')
+    startup.mark('metrics')
 
-    # Initialize and start database recorder
-    trecorder = recorder.Recorder(q, appConfig)
-    trecorder.start()
-
-    # Start viewer if required
-    if(not appConfig.no_viewer):
-        viewer = viewer.Viewer(appConfig, window_title='Sensors data')
-        viewer.start()
-    else:
-        logger.info('The viewer is disabled.')
+    # Start the Monitor, Recorder and Viewer
+    supervisor = supervisor.Supervisor(appConfig, client_id="cp100")
+    supervisor.start()
+    startup.mark('components')
+    startup.report()
 
     try:
-        # Sleep main thread
-        while True:
-            time.sleep(1)
+        # Sleep main thread until a stop signal is received
+        supervisor.wait()
 
     except Exception as e:
         print(f'Exception: {str(e)}')
 
-    except KeyboardInterrupt:
-        logger.info("Stopping all threads and processes... (This may take few seconds)")
-
-        # Stop the monitor process
-        pmonitor.stop()
-        pmonitor.join()
-
-        # Stop the recorder thread
-        trecorder.stop()
-        trecorder.join()
+    # Stop ingestion, drain the queue and stop all the components
+    supervisor.stop()
 
-        # Stop viewer process if already started
-        if(not appConfig.no_viewer):
-            viewer.stop()
-            viewer.join()
+    # Flush the pending log records
+    applog.stop_listeners()
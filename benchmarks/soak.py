@@ -0,0 +1,292 @@
+
+# Import standard packages
+import os
+import sys
+
+# Force a non-interactive matplotlib backend before the viewer is imported
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+# Import custom subpackages
+from core import config, monitor, viewer
+from core.loadgen import TelemetryGenerator
+from common import database, recorder, metrics, utils
+
+from datetime import datetime
+
+import argparse
+import gc
+import json
+import queue
+import shutil
+import tempfile
+import time
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.soak')
+
+
+def build_config(database_filename, time_window=300):
+
+    """ Builds an application configuration for the soak test
+
+        :param database_filename: the database filename
+        :param time_window: the viewer time window
+        :return: the application configuration object
+    """
+
+    appconfig = config.AppConfig(None)
+    appconfig.parse_app_config({
+        "host": "localhost",
+        "port": 1883,
+        "username": "",
+        "secret": "",
+        "mac_address": "",
+        "topic": "voltazero/soak",
+        "database": database_filename,
+        "table_name": "data",
+        "recorder_batch_size": 1000,
+        "recorder_interval": 1,
+        "recorder_commit_window": 0.2,
+        "time_window": time_window,
+        "viewer_interval": 5,
+        "no_viewer": False,
+        "latest_shared_memory": ""
+    })
+
+    return appconfig
+
+
+def get_slope(samples, warmup=0):
+
+    """ Fits a line to samples (least squares) after a warmup period
+
+        :param samples: the list of (elapsed seconds, value) samples
+        :param warmup: the ignored initial period in seconds
+        :return: the slope in units per hour (None if less than two samples)
+    """
+
+    points = [(x, y) for x, y in samples if x >= warmup]
+
+    if len(points) < 2:
+        return None
+
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+
+    if variance == 0:
+        return 0.0
+
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance * 3600
+
+
+class SoakTest():
+
+    """ Runs the whole pipeline in one process for a long time with
+        synthetic load (Monitor parsing, Recorder thread, Viewer fetch and
+        draw with the Agg backend, query cache reads) and samples the
+        resident set size and the number of objects, so that a leak shows
+        as a growth trend once the buffers have filled up (warmup).
+
+        :param appconfig: the application configuration object
+        :param generator: the telemetry generator
+        :param rate: the number of messages per second
+        :param duration: the test duration in seconds
+        :param sample_interval: the interval in seconds between two memory samples
+        :param cache_mb: the memory budget of the query cache in MB
+        :param rss: the list of (elapsed seconds, RSS bytes) samples
+        :param objects: the list of (elapsed seconds, object count) samples
+        :param sent: the number of sent messages
+    """
+
+    def __init__(self, appconfig, generator, rate=200, duration=3600, sample_interval=10, cache_mb=16):
+
+        """ Initializes the soak test
+
+            :param appconfig: the application configuration object
+            :param generator: the telemetry generator
+            :param rate: the number of messages per second
+            :param duration: the test duration in seconds
+            :param sample_interval: the interval in seconds between two memory samples
+            :param cache_mb: the memory budget of the query cache in MB
+        """
+
+        self.appconfig = appconfig
+        self.generator = generator
+        self.rate = rate
+        self.duration = duration
+        self.sample_interval = sample_interval
+        self.cache_mb = cache_mb
+        self.rss = []
+        self.objects = []
+        self.sent = 0
+
+
+    def sample(self, elapsed):
+
+        """ Records the memory use of the process
+
+            :param elapsed: the elapsed time in seconds
+        """
+
+        gc.collect()
+        rss = metrics.get_rss()
+
+        if rss is not None:
+            self.rss.append((elapsed, rss))
+
+        self.objects.append((elapsed, len(gc.get_objects())))
+        logger.info(f'{elapsed:8.0f}s  RSS {(rss or 0) / 1e6:8.1f} MB  objects {self.objects[-1][1]:9d}  sent {self.sent}')
+
+
+    def run(self):
+
+        """ Runs the load, the reads and the sampling for the test duration """
+
+        commit_log = database.CommitLog()
+        q = queue.Queue(maxsize=self.appconfig.queue_max_size)
+
+        trecorder = recorder.Recorder(q, self.appconfig, commit_log)
+        trecorder.start()
+
+        pmonitor = monitor.Monitor(self.appconfig, q, client_id="soak")
+        pviewer = viewer.Viewer(self.appconfig, commit_log=commit_log)
+        pviewer.init_viewer()
+
+        cache = database.QueryCache(self.cache_mb, commit_log=commit_log)
+        connection_handler = None
+
+        start = time.time()
+        next_draw = next_sample = start
+
+        try:
+            while time.time() - start < self.duration:
+                now = time.time()
+
+                if now >= next_draw:
+                    pviewer.fetch_and_format_data()
+                    pviewer.draw()
+
+                    # Query cache reads of the viewer window
+                    if connection_handler is None and os.path.exists(self.appconfig.database_filename):
+                        connection_handler = database.connect(self.appconfig.database_filename, readonly=True)
+                    if connection_handler is not None:
+                        cache.retrieve_columns(connection_handler, utils.get_naive_timestamp() - self.appconfig.time_window)
+
+                    next_draw = now + self.appconfig.viewer_interval
+
+                if now >= next_sample:
+                    self.sample(now - start)
+                    next_sample = now + self.sample_interval
+
+                # Pace the messages to match the requested rate
+                delay = start + self.sent / self.rate - time.time()
+                if delay > 0:
+                    time.sleep(min(delay, 0.1))
+                    continue
+
+                pmonitor.on_message(None, None, self.generator.next_message(self.sent, self.appconfig.topic))
+                self.sent += 1
+
+            self.sample(time.time() - start)
+
+        finally:
+            trecorder.stop()
+            trecorder.join()
+            database.disconnect(connection_handler)
+
+            for panel in pviewer.panels:
+                viewer.plt.close(panel["fig"])
+
+
+def main(argv=None):
+
+    """ Runs the soak test from the command line
+
+        :param argv: the command line arguments
+        :return: 0 if the memory stays flat, 1 if it grows beyond the limits
+    """
+
+    parser = argparse.ArgumentParser(description='VoltaZero Monitor memory soak test')
+    parser.add_argument('--duration', type=float, default=3600, help='test duration in seconds (default: 3600)')
+    parser.add_argument('--rate', type=float, default=200, help='messages per second (default: 200)')
+    parser.add_argument('--devices', type=int, default=10, help='number of simulated devices')
+    parser.add_argument('--sample-interval', dest='sample_interval', type=float, default=10,
+                        help='interval in seconds between two memory samples (default: 10)')
+    parser.add_argument('--time-window', dest='time_window', type=int, default=300,
+                        help='viewer time window in seconds (default: 300)')
+    parser.add_argument('--cache-mb', dest='cache_mb', type=float, default=16,
+                        help='memory budget of the query cache in MB (default: 16)')
+    parser.add_argument('--warmup', type=float, default=None,
+                        help='ignored initial period in seconds, long enough for the buffers to fill up '
+                             '(default: 600, at most a third of the duration)')
+    parser.add_argument('--max-rss-growth', dest='max_rss_growth', type=float, default=5.0,
+                        help='tolerated RSS growth in MB per hour (default: 5)')
+    parser.add_argument('--max-object-growth', dest='max_object_growth', type=float, default=10000,
+                        help='tolerated growth of the object count per hour (default: 10000)')
+    parser.add_argument('--config', default=None, help='application configuration file (memory budgets)')
+    parser.add_argument('--output', default=None, help='write the JSON samples and trends to this file')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logging.getLogger('voltazero_monitor').setLevel(logging.INFO)
+
+    tmpdir = tempfile.mkdtemp(prefix='voltazero_soak_')
+
+    try:
+        appconfig = build_config(os.path.join(tmpdir, 'soak.db'), args.time_window)
+
+        if args.config is not None:
+            appconfig = config.AppConfig(args.config)
+            if appconfig.load_app_config() != 0:
+                logger.error('The configuration file cannot be loaded!')
+                return 1
+            appconfig.database_filename = os.path.join(tmpdir, 'soak.db')
+            appconfig.latest_shared_memory = ""
+
+        # Keep two thirds of a short run for the trend when no warmup is given
+        warmup = args.warmup if args.warmup is not None else min(600, args.duration / 3)
+
+        test = SoakTest(appconfig, TelemetryGenerator(devices=args.devices, seed=1), args.rate, args.duration,
+                        args.sample_interval, args.cache_mb)
+        test.run()
+
+        rss_growth = get_slope(test.rss, warmup)
+        object_growth = get_slope(test.objects, warmup)
+
+        if rss_growth is None or object_growth is None:
+            print(f'Not enough samples after the {warmup:.0f}s warmup to measure a trend, '
+                  f'increase the duration or lower the warmup and the sample interval')
+            return 1
+
+        rss_growth /= 1e6
+
+        report = {
+            "meta": {"date": datetime.now().strftime('%Y/%m/%d %H:%M:%S'), "duration": args.duration,
+                     "rate": args.rate, "devices": args.devices, "warmup": warmup, "sent": test.sent},
+            "rss_growth_mb_per_hour": rss_growth,
+            "object_growth_per_hour": object_growth,
+            "rss": test.rss,
+            "objects": test.objects
+        }
+
+        if args.output is not None:
+            utils.write_to_file(args.output, 'w', json.dumps(report, indent=4))
+
+        print(f'RSS growth: {rss_growth:.2f} MB/h (limit {args.max_rss_growth}), '
+              f'object growth: {object_growth:.0f}/h (limit {args.max_object_growth})')
+
+        if rss_growth > args.max_rss_growth or object_growth > args.max_object_growth:
+            print('Memory growth detected')
+            return 1
+
+        return 0
+
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,539 @@
+
+# Import standard packages
+import os
+import sys
+
+# Force a non-interactive matplotlib backend before the viewer is imported
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+# Import custom subpackages
+from core import config, monitor, telemetry, viewer
+from core.loadgen import TelemetryGenerator
+from common import database, recorder, utils, chunks
+
+from multiprocessing import Process, Queue, Event, Value
+from collections import OrderedDict
+from datetime import datetime
+
+import argparse
+import json
+import platform
+import queue
+import shutil
+import statistics
+import tempfile
+import time
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.suite')
+
+
+# Benchmark sizes (the quick profile is meant for smoke runs)
+SIZES = {
+    "full": {"messages": 20000, "batch": 1000, "tables": [1000, 10000, 100000], "viewer": 10000, "draw": 2000,
+             "readers": [0, 1, 2, 4, 8], "repeat": 5},
+    "quick": {"messages": 2000, "batch": 200, "tables": [1000, 5000], "viewer": 1000, "draw": 200,
+              "readers": [0, 2, 4], "repeat": 3}
+}
+
+
+def measure(func, items, repeat, setup=None):
+
+    """ Runs a benchmark function several times and summarizes the timings
+
+        :param func: the function to benchmark
+        :param items: the number of items processed by one call
+        :param repeat: the number of repetitions
+        :param setup: an optional function called (untimed) before each run
+        :return: the timing summary dictionary
+    """
+
+    timings = []
+
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    median = statistics.median(timings)
+
+    return {
+        "items": items,
+        "repeat": repeat,
+        "min": min(timings),
+        "median": median,
+        "mean": statistics.mean(timings),
+        "throughput": items / median if median > 0 else None
+    }
+
+
+def build_config(database_filename, time_window=7200):
+
+    """ Builds an application configuration for the benchmarks
+
+        :param database_filename: the database filename
+        :param time_window: the viewer time window
+        :return: the application configuration object
+    """
+
+    appconfig = config.AppConfig(None)
+    appconfig.parse_app_config({
+        "host": "localhost",
+        "port": 1883,
+        "username": "",
+        "secret": "",
+        "mac_address": "",
+        "topic": "voltazero/benchmark",
+        "database": database_filename,
+        "table_name": "data",
+        "recorder_batch_size": 100,
+        "recorder_interval": 1,
+        "time_window": time_window,
+        "viewer_interval": 5,
+        "no_viewer": False
+    })
+
+    return appconfig
+
+
+def generate_records(count, span=3600, devices=10):
+
+    """ Generates parsed telemetry records spread over the last span seconds
+
+        :param count: the number of records
+        :param span: the covered time interval in seconds
+        :param devices: the number of simulated devices
+        :return: the list of telemetry records
+    """
+
+    generator = TelemetryGenerator(devices=devices, seed=count)
+    parser = monitor.Monitor(build_config(""), None, client_id="benchmark")
+    now = utils.get_unix_timestamp()
+    records = []
+
+    for i in range(count):
+        t0, t1, th, bz, lg, ir, id = parser.handle_telemetry(generator.next_payload(i))
+        ts = datetime.fromtimestamp(now - span + span * i / count).strftime('%Y/%m/%d %H:%M:%S')
+        records.append(telemetry.Telemetry(timestamp=ts, t0=t0, t1=t1, th=th, bz=bz, ls=lg, ir=ir, id=id))
+
+    return records
+
+
+def to_rows(records):
+
+    """ Converts telemetry records into database rows
+
+        :param records: the list of telemetry records
+        :return: the list of row tuples
+    """
+
+    return [tlm.as_row() for tlm in records]
+
+
+def create_database(path, records=None):
+
+    """ Creates a benchmark database and fills it with records
+
+        :param path: the database file path
+        :param records: the optional list of telemetry records to insert
+        :return: the connection handler
+    """
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    connection_handler = database.connect(path)
+    database.create_datatable(connection_handler)
+
+    if records:
+        rows = to_rows(records)
+        for i in range(0, len(rows), 500):
+            database.insert_telemetry_data(connection_handler, rows[i:i+500])
+
+    return connection_handler
+
+
+def produce(q, count):
+
+    """ Queue producer used by the queue transport benchmark
+
+        :param q: the telemetry queue
+        :param count: the number of records to put in the queue
+    """
+
+    for tlm in generate_records(count):
+        q.put(tlm)
+
+
+def read_snapshots(path, reader, window, interval, stop, reads):
+
+    """ Reader process of the concurrent readers benchmark: reads the
+        window in snapshots, one every interval, until the stop event is set
+
+        :param path: the database file path
+        :param reader: the snapshot reader shared by the reader processes
+        :param window: the read time window in seconds
+        :param interval: the time in seconds between two snapshots
+        :param stop: the stop event
+        :param reads: the shared number of completed snapshots
+    """
+
+    connection_handler = reader.connect(path)
+
+    try:
+        while not stop.is_set():
+            with reader.snapshot(connection_handler):
+                database.retrieve_columns(connection_handler, utils.get_naive_timestamp() - window)
+
+            with reads.get_lock():
+                reads.value += 1
+
+            stop.wait(interval)
+
+    finally:
+        database.disconnect(connection_handler)
+
+
+def bench_handle_telemetry(workdir, sizes):
+
+    """Measures the parsing of decoded payloads by Monitor.handle_telemetry"""
+
+    generator = TelemetryGenerator(devices=10, seed=1)
+    payloads = [generator.next_payload(i) for i in range(sizes["messages"])]
+    parser = monitor.Monitor(build_config(""), None, client_id="benchmark")
+
+    def run():
+        for payload in payloads:
+            parser.handle_telemetry(payload)
+
+    return measure(run, len(payloads), sizes["repeat"])
+
+
+def bench_queue_transport(workdir, sizes):
+
+    """Measures the transport of telemetry records between two processes"""
+
+    count = sizes["messages"]
+
+    def run():
+        q = Queue()
+        producer = Process(target=produce, args=(q, count))
+        producer.start()
+        for _ in range(count):
+            q.get()
+        producer.join()
+
+    return measure(run, count, sizes["repeat"])
+
+
+def bench_recorder_insert_batch(workdir, sizes):
+
+    """Measures Recorder.insert_batch on a pre-filled queue"""
+
+    path = os.path.join(workdir, 'recorder.db')
+    records = generate_records(sizes["batch"])
+    trecorder = recorder.Recorder(queue.Queue(), build_config(path))
+
+    def setup():
+        for tlm in records:
+            trecorder.q.put(tlm)
+
+    def run():
+        trecorder.insert_batch(len(records))
+
+    connection_handler = create_database(path)
+    trecorder.connection_handler = connection_handler
+
+    try:
+        return measure(run, len(records), sizes["repeat"], setup=setup)
+    finally:
+        database.disconnect(connection_handler)
+
+
+def bench_database_insert(workdir, sizes):
+
+    """Measures database.insert_telemetry_data with one batch"""
+
+    path = os.path.join(workdir, 'insert.db')
+    rows = to_rows(generate_records(sizes["batch"]))
+    connection_handler = create_database(path)
+
+    try:
+        return measure(lambda: database.insert_telemetry_data(connection_handler, rows), len(rows), sizes["repeat"])
+    finally:
+        database.disconnect(connection_handler)
+
+
+def bench_retrieve_data(workdir, sizes, count):
+
+    """Measures database.retrieve_data on a table of a given size"""
+
+    path = os.path.join(workdir, f'retrieve_{count}.db')
+    connection_handler = create_database(path, generate_records(count))
+
+    try:
+        return measure(lambda: database.retrieve_data(connection_handler, 7200, "data"), count, sizes["repeat"])
+    finally:
+        database.disconnect(connection_handler)
+
+
+def bench_write_with_readers(workdir, sizes, readers):
+
+    """ Measures database.insert_telemetry_data (WAL mode) while reader
+        processes read the last hour in snapshots (20 per second each, as
+        dashboards would), at most database_max_readers at once, so that
+        the write throughput stays flat unless the readers block the commits
+    """
+
+    path = os.path.join(workdir, f'readers_{readers}.db')
+    connection_handler = create_database(path, generate_records(sizes["viewer"]))
+    database.enable_wal(connection_handler)
+    rows = to_rows(generate_records(sizes["batch"], span=60))
+
+    reader = database.SnapshotReader.from_config(build_config(path))
+    stop = Event()
+    reads = Value('q', 0)
+    processes = [Process(target=read_snapshots, args=(path, reader, 3600, 0.05, stop, reads)) for _ in range(readers)]
+
+    for process in processes:
+        process.start()
+
+    # The readers are running before the measurements
+    deadline = time.monotonic() + 30
+    while reads.value < readers and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    def run():
+        for _ in range(20):
+            database.insert_telemetry_data(connection_handler, rows)
+
+    try:
+        result = measure(run, 20 * len(rows), sizes["repeat"])
+        result["readers"] = readers
+        result["reads"] = reads.value
+        return result
+
+    finally:
+        stop.set()
+        for process in processes:
+            process.join()
+        database.disconnect(connection_handler)
+
+
+def bench_query_cache(workdir, sizes):
+
+    """Measures database.QueryCache.retrieve_columns on a cached window"""
+
+    path = os.path.join(workdir, 'cache.db')
+    connection_handler = create_database(path, generate_records(sizes["viewer"]))
+    cache = database.QueryCache(commit_log=database.CommitLog())
+    start = utils.get_naive_timestamp() - 7200
+    cache.retrieve_columns(connection_handler, start)
+
+    try:
+        return measure(lambda: cache.retrieve_columns(connection_handler, start), sizes["viewer"], sizes["repeat"])
+    finally:
+        database.disconnect(connection_handler)
+
+
+def bench_viewer_fetch(workdir, sizes):
+
+    """Measures Viewer.fetch_and_format_data"""
+
+    path = os.path.join(workdir, 'viewer.db')
+    database.disconnect(create_database(path, generate_records(sizes["viewer"])))
+    pviewer = viewer.Viewer(build_config(path))
+
+    return measure(pviewer.fetch_and_format_data, sizes["viewer"], sizes["repeat"])
+
+
+def bench_viewer_draw(workdir, sizes):
+
+    """Measures Viewer.draw with the Agg backend"""
+
+    path = os.path.join(workdir, 'draw.db')
+    database.disconnect(create_database(path, generate_records(sizes["draw"])))
+    pviewer = viewer.Viewer(build_config(path))
+    pviewer.init_viewer()
+    pviewer.fetch_and_format_data()
+
+    try:
+        return measure(pviewer.draw, sizes["draw"], sizes["repeat"])
+    finally:
+        for panel in pviewer.panels:
+            viewer.plt.close(panel["fig"])
+
+
+def bench_chunk_encode(workdir, sizes):
+
+    """Measures chunks.encode_chunk on the records of one device"""
+
+    path = os.path.join(workdir, 'chunks.db')
+    connection_handler = create_database(path, generate_records(sizes["viewer"], devices=1))
+    columns = database.retrieve_columns(connection_handler, 0)
+    database.disconnect(connection_handler)
+
+    return measure(lambda: chunks.encode_chunk(columns), sizes["viewer"], sizes["repeat"])
+
+
+def bench_chunk_decode(workdir, sizes):
+
+    """Measures chunks.decode_chunk on the records of one device"""
+
+    path = os.path.join(workdir, 'chunks.db')
+    connection_handler = create_database(path, generate_records(sizes["viewer"], devices=1))
+    chunk = chunks.encode_chunk(database.retrieve_columns(connection_handler, 0))
+    database.disconnect(connection_handler)
+
+    return measure(lambda: chunks.decode_chunk(chunk), sizes["viewer"], sizes["repeat"])
+
+
+def get_stages(sizes):
+
+    """ Returns the ordered benchmark stages
+
+        :param sizes: the benchmark sizes
+        :return: dictionary mapping stage names to benchmark functions
+    """
+
+    stages = OrderedDict()
+    stages["handle_telemetry"] = bench_handle_telemetry
+    stages["queue_transport"] = bench_queue_transport
+    stages["recorder_insert_batch"] = bench_recorder_insert_batch
+    stages["database_insert_telemetry_data"] = bench_database_insert
+
+    for count in sizes["tables"]:
+        stages[f"retrieve_data_{count}"] = (lambda c: lambda w, s: bench_retrieve_data(w, s, c))(count)
+
+    for readers in sizes["readers"]:
+        stages[f"write_with_{readers}_readers"] = (lambda r: lambda w, s: bench_write_with_readers(w, s, r))(readers)
+
+    stages["query_cache"] = bench_query_cache
+    stages["chunk_encode"] = bench_chunk_encode
+    stages["chunk_decode"] = bench_chunk_decode
+    stages["viewer_fetch_and_format_data"] = bench_viewer_fetch
+    stages["viewer_draw"] = bench_viewer_draw
+
+    return stages
+
+
+def run_suite(profile='full', selected=None):
+
+    """ Runs the benchmark suite
+
+        :param profile: the sizes profile ('full' or 'quick')
+        :param selected: an optional list of stage names to run
+        :return: the results dictionary
+    """
+
+    sizes = SIZES[profile]
+    workdir = tempfile.mkdtemp(prefix='voltazero_bench_')
+    results = OrderedDict()
+
+    try:
+        for name, bench in get_stages(sizes).items():
+            if selected and name not in selected:
+                continue
+
+            logger.info(f'Running benchmark: {name}')
+            results[name] = bench(workdir, sizes)
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "profile": profile,
+            "date": datetime.now().strftime('%Y/%m/%d %H:%M:%S'),
+            "python": platform.python_version(),
+            "platform": platform.platform()
+        },
+        "results": results
+    }
+
+
+def compare(report, baseline, threshold=0.2):
+
+    """ Compares benchmark results to a baseline. The baseline file may
+        define per-stage thresholds in its 'thresholds' dictionary
+
+        :param report: the current results dictionary
+        :param baseline: the baseline results dictionary
+        :param threshold: the default tolerated relative slowdown
+        :return: dictionary mapping stage names to comparison entries
+    """
+
+    thresholds = baseline.get("thresholds", {})
+    comparison = OrderedDict()
+
+    for name, result in report["results"].items():
+        base = baseline.get("results", {}).get(name)
+
+        if base is None or not base.get("median"):
+            comparison[name] = {"status": "new"}
+            continue
+
+        limit = thresholds.get(name, threshold)
+        ratio = result["median"] / base["median"]
+
+        if ratio > 1 + limit:
+            status = "regression"
+        elif ratio < 1 - limit:
+            status = "improvement"
+        else:
+            status = "ok"
+
+        comparison[name] = {"status": status, "ratio": ratio, "threshold": limit}
+
+    return comparison
+
+
+def main(argv=None):
+
+    """ Runs the benchmark suite from the command line
+
+        :param argv: the command line arguments
+        :return: 0 if success, 1 if a regression is detected
+    """
+
+    parser = argparse.ArgumentParser(description='VoltaZero Monitor pipeline benchmarks')
+    parser.add_argument('--quick', action='store_true', help='use the reduced sizes profile')
+    parser.add_argument('--stage', action='append', default=None, help='run only the given stage (repeatable)')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON results file')
+    parser.add_argument('--baseline', default=None, help='baseline JSON results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='tolerated relative slowdown (default: 0.2)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logging.getLogger('voltazero_monitor').setLevel(logging.INFO)
+
+    report = run_suite('quick' if args.quick else 'full', args.stage)
+    regressions = []
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as json_file:
+            baseline = json.load(json_file)
+
+        report["comparison"] = compare(report, baseline, args.threshold)
+        regressions = [name for name, entry in report["comparison"].items() if entry["status"] == "regression"]
+
+    utils.write_to_file(args.output, 'w', json.dumps(report, indent=4))
+
+    for name, result in report["results"].items():
+        status = report.get("comparison", {}).get(name, {}).get("status", "")
+        print(f'{name:35s} {result["median"] * 1000:10.3f} ms  {result["throughput"] or 0:14.1f} items/s  {status}')
+
+    if regressions:
+        print(f'Regressions detected: {", ".join(regressions)}')
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+
+# Import custom subpackages
+from common import metrics
+
+# Import standard packages
+import math
+import time
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.adaptive')
+
+# Controller metrics
+TARGET_BATCH_SIZE = metrics.gauge('voltazero_adaptive_batch_size', 'Batch size chosen by the adaptive recorder controller')
+TARGET_INTERVAL = metrics.gauge('voltazero_adaptive_interval_seconds', 'Flush interval chosen by the adaptive recorder controller')
+ARRIVAL_RATE = metrics.gauge('voltazero_adaptive_arrival_rate', 'Smoothed arrival rate of the telemetry records (records per second)')
+COMMIT_LATENCY = metrics.gauge('voltazero_adaptive_commit_seconds', 'Smoothed commit latency observed by the adaptive recorder controller')
+ADJUSTMENTS = metrics.counter('voltazero_adaptive_adjustments_total', 'Number of batch size or flush interval changes')
+
+
+def clamp(value, lowest, highest):
+
+    """ Limits a value to an interval
+
+        :param value: the value
+        :param lowest: the lower bound
+        :param highest: the upper bound
+        :return: the limited value
+    """
+
+    return max(lowest, min(value, highest))
+
+
+class BatchController():
+
+    """ Adaptive batch size and flush interval of the Recorder. After each
+        flush, the controller updates its moving averages of the arrival rate
+        and of the commit latency, then chooses:
+
+        - the flush interval, so that a record waits less than
+          recorder_max_latency between its reception and its commit, without
+          spending more than max_duty of the time committing. When the
+          oldest record of a batch is older than the latency bound, the
+          interval is halved until the queue catches up.
+        - the batch size, large enough for the arrivals of one interval (with
+          some headroom) plus the queued backlog.
+
+        Both are kept within the configured bounds (recorder_min_interval to
+        recorder_interval and recorder_min_batch_size to
+        recorder_max_batch_size). The bounds are read from the configuration
+        at each update, so that they can be reloaded.
+
+        :param appconfig: the application configuration object
+        :param batch_size: the current batch size
+        :param interval: the current flush interval in seconds
+        :param rate: the smoothed arrival rate in records per second
+        :param commit_seconds: the smoothed commit latency in seconds
+        :param depth: the queue depth after the last flush
+        :param last: the time of the last update
+    """
+
+    # Smoothing factor of the moving averages
+    alpha = 0.3
+
+    # Maximum share of the time spent committing
+    max_duty = 0.5
+
+    # Batch size margin over the expected arrivals of one interval
+    headroom = 2.0
+
+    def __init__(self, appconfig):
+
+        """ Initializes the controller with the configured batch size and interval
+
+            :param appconfig: the application configuration object
+        """
+
+        self.appconfig = appconfig
+        self.batch_size = clamp(appconfig.recorder_batch_size, appconfig.recorder_min_batch_size,
+                                appconfig.recorder_max_batch_size)
+        self.interval = clamp(appconfig.recorder_interval, appconfig.recorder_min_interval,
+                              appconfig.recorder_interval)
+        self.rate = 0.0
+        self.commit_seconds = 0.0
+        self.depth = 0
+        self.last = None
+
+        TARGET_BATCH_SIZE.set(self.batch_size)
+        TARGET_INTERVAL.set(self.interval)
+
+
+    def smooth(self, average, value):
+
+        """ Updates an exponentially weighted moving average
+
+            :param average: the current average
+            :param value: the new observation
+            :return: the updated average
+        """
+
+        return value if average == 0 else self.alpha * value + (1 - self.alpha) * average
+
+
+    def update(self, count, commit_seconds, queue_age, depth, now=None):
+
+        """ Updates the batch size and flush interval after a flush
+
+            :param count: the number of records fetched from the queue by the flush
+            :param commit_seconds: the duration of the batch commit (0 if nothing was committed)
+            :param queue_age: the time spent in the queue by the oldest record of the batch
+            :param depth: the queue depth after the flush
+            :param now: the current monotonic time
+            :return: the new batch size and flush interval
+        """
+
+        now = time.monotonic() if now is None else now
+
+        # Arrivals since the last update: flushed records plus the queue growth
+        if self.last is not None and now > self.last:
+            arrivals = max(count + depth - self.depth, 0)
+            self.rate = self.smooth(self.rate, arrivals / (now - self.last))
+
+        if commit_seconds > 0:
+            self.commit_seconds = self.smooth(self.commit_seconds, commit_seconds)
+
+        self.last = now
+        self.depth = depth
+
+        appconfig = self.appconfig
+        max_interval = max(appconfig.recorder_interval, appconfig.recorder_min_interval)
+
+        # A record waits up to one interval in the queue, then for its commit
+        interval = (appconfig.recorder_max_latency - self.commit_seconds) / 2
+
+        # Catch up when the queue is late
+        if queue_age is not None and queue_age > appconfig.recorder_max_latency:
+            interval = min(interval, self.interval / 2)
+
+        # Keep the database available to the readers
+        interval = max(interval, self.commit_seconds * (1 - self.max_duty) / self.max_duty)
+        interval = clamp(interval, appconfig.recorder_min_interval, max_interval)
+
+        batch_size = math.ceil(self.rate * interval * self.headroom) + depth
+        batch_size = clamp(batch_size, appconfig.recorder_min_batch_size, appconfig.recorder_max_batch_size)
+
+        if batch_size != self.batch_size or abs(interval - self.interval) > 1e-3:
+            ADJUSTMENTS.inc()
+            logger.debug("Adaptive recorder: batch size %d -> %d, interval %.3fs -> %.3fs (rate %.1f/s, commit %.3fs, depth %d)",
+                         self.batch_size, batch_size, self.interval, interval, self.rate, self.commit_seconds, depth)
+
+        self.batch_size = batch_size
+        self.interval = interval
+
+        TARGET_BATCH_SIZE.set(batch_size)
+        TARGET_INTERVAL.set(interval)
+        ARRIVAL_RATE.set(self.rate)
+        COMMIT_LATENCY.set(self.commit_seconds)
+
+        return batch_size, interval
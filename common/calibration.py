@@ -0,0 +1,180 @@
+
+# Import standard packages
+import numpy as np
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.calibration')
+
+# Calibration model types
+MODELS = ('linear', 'polynomial', 'lut')
+
+
+def evaluate(model, values):
+
+    """ Applies a calibration model to an array of raw values (vectorized)
+
+        :param model: the calibration model dictionary
+        :param values: the array of raw values (NaN for missing values)
+        :return: the array of calibrated values
+    """
+
+    kind = model.get("type", "linear")
+
+    if kind == 'linear':
+        result = values * model.get("gain", 1.0) + model.get("offset", 0.0)
+    elif kind == 'polynomial':
+        # Coefficients are given from the highest degree to the constant term
+        result = np.polyval(np.asarray(model["coefficients"], dtype=float), values)
+    elif kind == 'lut':
+        # Piecewise linear interpolation, the table is clamped outside its range
+        result = np.interp(values, np.asarray(model["x"], dtype=float), np.asarray(model["y"], dtype=float))
+        result[np.isnan(values)] = np.nan
+    else:
+        raise ValueError(f"Unknown calibration model: {kind}")
+
+    return result
+
+
+class Calibration():
+
+    """ Per-device sensor calibration. The models are loaded from the
+        'calibration' configuration parameter, which maps device identifiers
+        (or "default") to sensor models, e.g.
+
+            {"default": {"ir": {"type": "linear", "gain": 2.0, "offset": 0.1, "unit": "mW/cm2"}},
+             "2113": {"t0": {"type": "lut", "x": [0, 50], "y": [0.5, 49.0]}}}
+
+        A device model overrides the default model of the same sensor. The
+        raw columns are never modified: the calibrated values are added to
+        the columns as <sensor>_cal arrays.
+
+        :param models: dictionary mapping device identifiers to sensor models
+    """
+
+    def __init__(self, models=None):
+
+        """ Initializes the calibration
+
+            :param models: dictionary mapping device identifiers to sensor models
+        """
+
+        self.models = {}
+
+        for device, sensors in (models or {}).items():
+            for sensor, model in sensors.items():
+                if model.get("type", "linear") not in MODELS:
+                    logger.error(f"Unknown calibration model for {device}/{sensor}: {model.get('type')}")
+                    continue
+                self.models.setdefault(str(device), {})[sensor] = model
+
+
+    @classmethod
+    def from_config(cls, appconfig):
+
+        """ Builds the calibration of an application configuration
+
+            :param appconfig: the application configuration object
+            :return: the Calibration instance
+        """
+
+        return cls(getattr(appconfig, 'calibration', None))
+
+
+    def get_model(self, sensor, device=None):
+
+        """ Returns the calibration model of a sensor
+
+            :param sensor: the sensor name
+            :param device: the device identifier (None for the default model)
+            :return: the model dictionary or None if the sensor is not calibrated
+        """
+
+        model = self.models.get(str(device), {}).get(sensor) if device is not None else None
+        return model if model is not None else self.models.get("default", {}).get(sensor)
+
+
+    def get_sensors(self):
+
+        """ Returns the calibrated sensors
+
+            :return: the set of sensor names with at least one model
+        """
+
+        return {sensor for sensors in self.models.values() for sensor in sensors}
+
+
+    def calibrate(self, sensor, values, devices=None):
+
+        """ Calibrates the raw values of a sensor. The rows are grouped by
+            device so that each model is applied once to all its rows.
+
+            :param sensor: the sensor name
+            :param values: the array of raw values
+            :param devices: the array of device identifiers (None to use the default model)
+            :return: the array of calibrated values
+        """
+
+        values = np.asarray(values, dtype=float)
+
+        if devices is None or len(self.models) == 1 and "default" in self.models:
+            model = self.get_model(sensor)
+            return evaluate(model, values) if model is not None else values.copy()
+
+        result = values.copy()
+        keys, inverse = np.unique(np.asarray(devices, dtype=str), return_inverse=True)
+
+        for index, device in enumerate(keys):
+            model = self.get_model(sensor, device)
+            if model is not None:
+                mask = inverse == index
+                result[mask] = evaluate(model, values[mask])
+
+        return result
+
+
+    def apply(self, columns):
+
+        """ Adds the calibrated arrays of the calibrated sensors to columnar
+            telemetry data (see database.retrieve_columns)
+
+            :param columns: dictionary of arrays
+            :return: the same dictionary with the <sensor>_cal arrays
+        """
+
+        devices = columns.get("device")
+
+        for sensor in self.get_sensors():
+            if sensor in columns:
+                columns[f"{sensor}_cal"] = self.calibrate(sensor, columns[sensor], devices)
+
+        return columns
+
+
+    def get_axis(self, sensor, info):
+
+        """ Returns the plot properties of a sensor, updated with the unit and
+            range of its default calibration model
+
+            :param sensor: the sensor name
+            :param info: the default plot properties (title, y limits)
+            :return: the plot properties dictionary
+        """
+
+        model = self.get_model(sensor)
+
+        if model is None:
+            return info
+
+        info = dict(info)
+
+        if "unit" in model:
+            info["title"] = f"{sensor.upper()} ({model['unit']})"
+
+        if "min" in model and "max" in model:
+            info["min_y_lim"] = model["min"]
+            info["max_y_lim"] = model["max"]
+            info["enable_y_limits"] = True
+
+        return info
@@ -0,0 +1,609 @@
+
+# Import custom subpackages
+from common import database, utils
+
+# Import standard packages
+from datetime import datetime
+
+import heapq
+import itertools
+import math
+import sqlite3
+import struct
+import time
+import zlib
+import logging
+
+import numpy as np
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.chunks')
+
+# Chunk format identifier
+MAGIC = b'VZC1'
+
+# Encoding of the sensor columns: run-length for the mostly constant buzzer
+# state, XOR with the previous reading for the others
+ENCODINGS = {"bz": "rle"}
+
+# Maximum number of decimals of the readings stored as scaled integers
+MAX_DECIMALS = 6
+
+# Size of an uncompressed record (timestamp and readings as 8 bytes values)
+RECORD_SIZE = 8 * (1 + len(database.SENSORS))
+
+
+def zigzag(values):
+
+    """ Maps signed integers to unsigned integers so that small magnitudes
+        give small codes (0, -1, 1, -2... to 0, 1, 2, 3...)
+
+        :param values: the int64 array
+        :return: the uint64 array
+    """
+
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def unzigzag(codes):
+
+    """ Reverses zigzag
+
+        :param codes: the uint64 array
+        :return: the int64 array
+    """
+
+    return (codes >> np.uint64(1)).view(np.int64) ^ -(codes & np.uint64(1)).view(np.int64)
+
+
+def pack_ints(values):
+
+    """ Packs signed integers with the narrowest unsigned type holding all
+        their zigzag codes
+
+        :param values: the integer array
+        :return: the bytes (item size followed by the codes)
+    """
+
+    codes = zigzag(np.asarray(values, dtype=np.int64))
+    highest = int(codes.max()) if len(codes) else 0
+
+    for itemsize in (1, 2, 4, 8):
+        if highest < 1 << (8 * itemsize):
+            break
+
+    return bytes([itemsize]) + codes.astype(f'<u{itemsize}').tobytes()
+
+
+def unpack_ints(data, count):
+
+    """ Unpacks the integers of pack_ints
+
+        :param data: the packed bytes
+        :param count: the number of integers
+        :return: the int64 array
+    """
+
+    codes = np.frombuffer(data, dtype=f'<u{data[0]}', count=count, offset=1)
+    return unzigzag(codes.astype(np.uint64))
+
+
+def encode_timestamps(timestamps):
+
+    """ Encodes second resolution timestamps as delta-of-delta integers: a
+        regular sampling period gives a sequence of zeros
+
+        :param timestamps: the sorted timestamps array
+        :return: the encoded bytes
+    """
+
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    dod = np.diff(np.diff(timestamps), prepend=0)
+
+    return struct.pack('<q', timestamps[0]) + pack_ints(dod)
+
+
+def decode_timestamps(data, count):
+
+    """ Decodes the timestamps of encode_timestamps
+
+        :param data: the encoded bytes
+        :param count: the number of timestamps
+        :return: the timestamps array (float)
+    """
+
+    first = struct.unpack_from('<q', data)[0]
+    deltas = np.cumsum(unpack_ints(data[8:], count - 1))
+
+    return (first + np.concatenate(([0], np.cumsum(deltas)))).astype(float)
+
+
+def encode_floats(values):
+
+    """ Encodes readings. Readings with a fixed number of decimals (as sent
+        by the devices) are stored exactly as scaled integer deltas, with a
+        run-length mask of the missing readings. The other readings are
+        stored as the XOR of each value with the previous one (Gorilla
+        style): slowly changing readings share their sign, exponent and high
+        mantissa bits, so the XOR is mostly zero bytes, grouped by
+        significance (byte planes) for the final compression.
+
+        :param values: the float array (NaN for missing readings)
+        :return: the encoded bytes
+    """
+
+    values = np.ascontiguousarray(values, dtype='<f8')
+    missing = np.isnan(values)
+    readings = values[~missing]
+
+    for decimals in range(MAX_DECIMALS + 1):
+        scaled = np.round(readings * 10 ** decimals)
+
+        if np.array_equal(scaled / 10 ** decimals, readings) and (len(scaled) == 0 or np.abs(scaled).max() < 2 ** 53):
+            mask = encode_runs(missing.astype(float))
+            return (b'D' + bytes([decimals]) + struct.pack('<I', len(mask)) + mask +
+                    pack_ints(np.diff(scaled.astype(np.int64), prepend=0)))
+
+    bits = values.view('<u8')
+    xored = bits.copy()
+    xored[1:] ^= bits[:-1]
+
+    return b'X' + xored.view(np.uint8).reshape(-1, 8).T.tobytes()
+
+
+def decode_floats(data, count):
+
+    """ Decodes the readings of encode_floats
+
+        :param data: the encoded bytes
+        :param count: the number of readings
+        :return: the float array
+    """
+
+    if data[0:1] == b'D':
+        decimals = data[1]
+        length = struct.unpack_from('<I', data, 2)[0]
+        missing = decode_runs(data[6:6 + length], count).astype(bool)
+
+        values = np.full(count, np.nan)
+        values[~missing] = np.cumsum(unpack_ints(data[6 + length:], count - int(missing.sum()))) / 10 ** decimals
+        return values
+
+    planes = np.frombuffer(data, dtype=np.uint8, count=8 * count, offset=1).reshape(8, count)
+    xored = np.ascontiguousarray(planes.T).view('<u8').ravel()
+
+    return np.bitwise_xor.accumulate(xored).view('<f8').astype(float)
+
+
+def encode_runs(values):
+
+    """ Encodes readings as runs of identical values (NaN runs included)
+
+        :param values: the float array
+        :return: the encoded bytes (number of runs, run values, run lengths)
+    """
+
+    values = np.ascontiguousarray(values, dtype='<f8')
+    bits = values.view('<u8')
+
+    starts = np.flatnonzero(np.concatenate(([True], bits[1:] != bits[:-1])))
+    lengths = np.diff(np.append(starts, len(values)))
+
+    return struct.pack('<I', len(starts)) + values[starts].tobytes() + pack_ints(lengths)
+
+
+def decode_runs(data, count):
+
+    """ Decodes the readings of encode_runs
+
+        :param data: the encoded bytes
+        :param count: the number of readings (unused, given by the runs)
+        :return: the float array
+    """
+
+    runs = struct.unpack_from('<I', data)[0]
+    values = np.frombuffer(data, dtype='<f8', count=runs, offset=4)
+
+    return np.repeat(values.astype(float), unpack_ints(data[4 + 8 * runs:], runs))
+
+
+def encode_chunk(columns, level=6):
+
+    """ Encodes the records of a device as a compressed chunk
+
+        :param columns: dictionary with the sorted 'timestamp' array and one array per sensor
+        :param level: the zlib compression level of the encoded columns
+        :return: the chunk bytes
+    """
+
+    count = len(columns["timestamp"])
+    sections = [encode_timestamps(columns["timestamp"])]
+
+    for sensor in database.SENSORS:
+        encode = encode_runs if ENCODINGS.get(sensor) == "rle" else encode_floats
+        sections.append(encode(columns[sensor]))
+
+    body = b''.join(struct.pack('<I', len(section)) + section for section in sections)
+
+    return MAGIC + struct.pack('<I', count) + zlib.compress(body, level)
+
+
+def decode_chunk(chunk):
+
+    """ Decodes a compressed chunk
+
+        :param chunk: the chunk bytes
+        :return: dictionary with the 'timestamp' array and one array per sensor
+        :raises ValueError: Unknown chunk format
+    """
+
+    if chunk[:4] != MAGIC:
+        raise ValueError("Unknown chunk format")
+
+    count = struct.unpack_from('<I', chunk, 4)[0]
+    body = memoryview(zlib.decompress(chunk[8:]))
+    sections = []
+    offset = 0
+
+    while offset < len(body):
+        length = struct.unpack_from('<I', body, offset)[0]
+        sections.append(body[offset + 4:offset + 4 + length])
+        offset += 4 + length
+
+    columns = {"timestamp": decode_timestamps(sections[0], count)}
+
+    for sensor, section in zip(database.SENSORS, sections[1:]):
+        decode = decode_runs if ENCODINGS.get(sensor) == "rle" else decode_floats
+        columns[sensor] = decode(section, count)
+
+    return columns
+
+
+def create_chunktable(connection_handler, table_name="data"):
+
+    """ Creates the compressed chunk table of a data table (<table>_chunks)
+
+        :param connection_handler: the Connection object
+        :param table_name: the data table name
+        :return: 0 if success, -1 if the connection handler is None and -2 if exception arises
+    """
+
+    try:
+        if connection_handler is None:
+            return -1
+
+        cursor = connection_handler.cursor()
+        cursor.execute(f"""CREATE TABLE IF NOT EXISTS {table_name}_chunks (
+                               chunk_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               device_id TEXT DEFAULT NULL,
+                               start_time REAL,
+                               end_time REAL,
+                               count INTEGER,
+                               payload BLOB
+                           )""")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_chunks_time ON {table_name}_chunks (start_time, end_time)")
+        cursor.close()
+        return 0
+
+    except Exception as e:
+        logger.error(f"Exception: {str(e)}")
+        return -2
+
+
+def compact(connection_handler, before, table_name="data", span=86400, level=6):
+
+    """ Moves the records older than a time into compressed chunks, one
+        chunk per device and time span. Each span is converted in its own
+        transaction, so that the writer is never blocked for long.
+
+        :param connection_handler: the Connection object
+        :param before: the end of the compacted range (see utils.get_naive_timestamp)
+        :param table_name: the data table name
+        :param span: the time span of a chunk in seconds
+        :param level: the zlib compression level
+        :return: the number of compacted records or -1 if exception arises
+    """
+
+    if create_chunktable(connection_handler, table_name) != 0:
+        return -1
+
+    cursor = connection_handler.cursor()
+    total = 0
+
+    try:
+        first = cursor.execute(f"SELECT MIN(timestamp) FROM {table_name} WHERE timestamp < ?",
+                               [utils.format_naive_timestamp(before)]).fetchone()[0]
+
+        if first is None:
+            return 0
+
+        window = math.floor(utils.get_naive_timestamp(datetime.strptime(first, utils.TIMESTAMP_FORMAT)) / span) * span
+
+        while window < before:
+            end = min(window + span, before)
+            columns = database.retrieve_columns(connection_handler, window, end, table_name)
+
+            if columns is None:
+                return -1
+
+            if len(columns["timestamp"]):
+                for device in dict.fromkeys(columns["device"].tolist()):
+                    mask = columns["device"] == device
+                    chunk = encode_chunk({key: values[mask] for key, values in columns.items()}, level)
+                    timestamps = columns["timestamp"][mask]
+
+                    cursor.execute(f"""INSERT INTO {table_name}_chunks (device_id, start_time, end_time, count, payload)
+                                       VALUES (?, ?, ?, ?, ?)""",
+                                   (device, timestamps[0], timestamps[-1], len(timestamps), chunk))
+
+                cursor.execute(f"DELETE FROM {table_name} WHERE timestamp >= ? AND timestamp < ?",
+                               (utils.format_naive_timestamp(window), utils.format_naive_timestamp(end)))
+                connection_handler.commit()
+                total += len(columns["timestamp"])
+
+            window += span
+
+        logger.info(f"Records compacted into chunks: {total}")
+        return total
+
+    except sqlite3.Error as error:
+        connection_handler.rollback()
+        logger.error(f"Exception: {str(error)}")
+        return -1
+
+    finally:
+        cursor.close()
+
+
+def select_chunk(connection_handler, start, end=None, table_name="data", device_id=None):
+
+    """ Builds the query of the chunks overlapping a time range
+
+        :param connection_handler: the Connection object
+        :param start: the range start (see utils.get_naive_timestamp)
+        :param end: the range end (excluded), None for no upper bound
+        :param table_name: the data table name
+        :param device_id: an optional device identifier filter
+        :return: the cursor over the (device_id, start_time, payload) rows, by start time
+    """
+
+    sql = f"SELECT device_id, start_time, payload FROM {table_name}_chunks WHERE end_time >= ?"
+    params = [start]
+
+    if end is not None:
+        sql = f"{sql} AND start_time < ?"
+        params.append(end)
+
+    if device_id is not None:
+        sql = f"{sql} AND device_id = ?"
+        params.append(device_id)
+
+    cursor = connection_handler.cursor()
+    cursor.execute(f"{sql} ORDER BY start_time ASC", params)
+
+    return cursor
+
+
+def clip_chunk(device, payload, start, end=None):
+
+    """ Decodes a chunk and keeps the records of a time range
+
+        :param device: the device identifier of the chunk
+        :param payload: the chunk bytes
+        :param start: the range start (see utils.get_naive_timestamp)
+        :param end: the range end (excluded), None for no upper bound
+        :return: the column dictionary with the 'device' array
+    """
+
+    columns = decode_chunk(payload)
+    inside = columns["timestamp"] >= start
+
+    if end is not None:
+        inside &= columns["timestamp"] < end
+
+    columns = {key: values[inside] for key, values in columns.items()}
+    columns["device"] = np.full(len(columns["timestamp"]), device, dtype=object)
+
+    return columns
+
+
+def retrieve_chunks(connection_handler, start, end=None, table_name="data", device_id=None):
+
+    """ Decodes the compressed records of a time range
+
+        :param connection_handler: the Connection object
+        :param start: the range start (see utils.get_naive_timestamp)
+        :param end: the range end (excluded), None for no upper bound
+        :param table_name: the data table name
+        :param device_id: an optional device identifier filter
+        :return: dictionary of arrays (as database.retrieve_columns, with id 0)
+                 or None if exception arises
+    """
+
+    try:
+        cursor = select_chunk(connection_handler, start, end, table_name, device_id)
+        rows = cursor.fetchall()
+        cursor.close()
+
+    except sqlite3.Error as error:
+        logger.error(f"Exception: {str(error)}")
+        return None
+
+    return concatenate([clip_chunk(device, payload, start, end) for device, _, payload in rows])
+
+
+def iterate_chunks(connection_handler, start, end=None, table_name="data", device_id=None, fetch_size=16):
+
+    """ Iterates over the compressed records of a time range in timestamp
+        order. The chunks are fetched a few at a time and decoded one by
+        one: the decoded records are held until the start time of the next
+        chunk is reached, so that only the chunks overlapping in time (one
+        per device) are in memory at once.
+
+        :param connection_handler: the Connection object
+        :param start: the range start (see utils.get_naive_timestamp)
+        :param end: the range end (excluded), None for no upper bound
+        :param table_name: the data table name
+        :param device_id: an optional device identifier filter
+        :param fetch_size: the number of chunks fetched at once
+        :return: generator of column dictionaries, sorted by timestamp
+    """
+
+    cursor = select_chunk(connection_handler, start, end, table_name, device_id)
+    pending = []
+
+    try:
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+
+            for device, start_time, payload in rows:
+                if pending:
+                    columns = concatenate(pending)
+                    ready = columns["timestamp"] < start_time
+                    pending = [{key: values[~ready] for key, values in columns.items()}]
+
+                    if ready.any():
+                        yield {key: values[ready] for key, values in columns.items()}
+
+                pending.append(clip_chunk(device, payload, start, end))
+
+        if pending:
+            yield concatenate(pending)
+
+    finally:
+        cursor.close()
+
+
+def concatenate(parts):
+
+    """ Concatenates columnar records and sorts them by timestamp
+
+        :param parts: the list of column dictionaries
+        :return: the merged column dictionary
+    """
+
+    columns = {"id": np.zeros(0, dtype=np.int64), "timestamp": np.zeros(0), "device": np.zeros(0, dtype=object)}
+    columns.update({sensor: np.zeros(0) for sensor in database.SENSORS})
+
+    if not parts:
+        return columns
+
+    for key in columns:
+        columns[key] = np.concatenate([part.get(key, np.zeros(len(part["timestamp"]), dtype=columns[key].dtype))
+                                       for part in parts])
+
+    order = np.argsort(columns["timestamp"], kind='stable')
+    return {key: values[order] for key, values in columns.items()}
+
+
+def retrieve_columns(connection_handler, start, end=None, table_name="data", device_id=None):
+
+    """ Same as database.retrieve_columns, including the compressed records
+
+        :param connection_handler: the Connection object
+        :param start: the range start (see utils.get_naive_timestamp)
+        :param end: the range end (excluded), None for no upper bound
+        :param table_name: the data table name
+        :param device_id: an optional device identifier filter
+        :return: dictionary of arrays or None if exception arises
+    """
+
+    columns = database.retrieve_columns(connection_handler, start, end, table_name, device_id)
+
+    if columns is None or not database.check_if_datatable_exists(connection_handler, f"{table_name}_chunks"):
+        return columns
+
+    compressed = retrieve_chunks(connection_handler, start, end, table_name, device_id)
+
+    if compressed is None:
+        return None
+
+    return concatenate([compressed, columns]) if len(compressed["timestamp"]) else columns
+
+
+def iterate_rows(connection_handler, start=None, end=None, table_name="data", device_id=None, chunk_size=10000):
+
+    """ Same as database.iterate_rows, including the compressed records. The
+        decoded chunks and the rows of the data table are merged by
+        timestamp as they are read, so that the memory usage does not depend
+        on the range size either.
+
+        :param connection_handler: the Connection object
+        :param start: the range start, None for no lower bound
+        :param end: the range end (excluded), None for no upper bound
+        :param table_name: the data table name
+        :param device_id: an optional device identifier filter
+        :param chunk_size: the maximum number of rows per chunk
+        :return: generator of lists of rows (EXPORT_COLUMNS values)
+    """
+
+    rows = itertools.chain.from_iterable(database.iterate_rows(connection_handler, start, end, table_name,
+                                                               device_id, chunk_size))
+
+    if database.check_if_datatable_exists(connection_handler, f"{table_name}_chunks"):
+        compressed = (to_row(columns, i)
+                      for columns in iterate_chunks(connection_handler, 0 if start is None else start, end,
+                                                    table_name, device_id)
+                      for i in range(len(columns["timestamp"])))
+
+        # The compressed records come first on equal timestamps
+        rows = heapq.merge(compressed, rows, key=lambda row: row[0])
+
+    while True:
+        batch = list(itertools.islice(rows, chunk_size))
+        if not batch:
+            break
+        yield batch
+
+
+def to_row(columns, index):
+
+    """ Converts a decoded record into an EXPORT_COLUMNS row
+
+        :param columns: the decoded columns
+        :param index: the record index
+        :return: the row tuple (None for NaN readings)
+    """
+
+    values = [None if np.isnan(columns[sensor][index]) else float(columns[sensor][index]) for sensor in database.SENSORS]
+    values[-1] = None if values[-1] is None else int(values[-1])
+
+    return (utils.format_naive_timestamp(columns["timestamp"][index]), columns["device"][index], *values)
+
+
+def report(connection_handler, table_name="data", limit=None):
+
+    """ Reports the compression ratio and the decode throughput of the chunks
+
+        :param connection_handler: the Connection object
+        :param table_name: the data table name
+        :param limit: the maximum number of decoded chunks (None for all)
+        :return: the report dictionary or None if there is no chunk table
+    """
+
+    if not database.check_if_datatable_exists(connection_handler, f"{table_name}_chunks"):
+        return None
+
+    cursor = connection_handler.cursor()
+    chunks, records, stored = cursor.execute(f"""SELECT COUNT(*), COALESCE(SUM(count), 0), COALESCE(SUM(LENGTH(payload)), 0)
+                                                 FROM {table_name}_chunks""").fetchone()
+    sql = f"SELECT payload FROM {table_name}_chunks" + (f" LIMIT {int(limit)}" if limit is not None else "")
+    payloads = [row[0] for row in cursor.execute(sql)]
+    cursor.close()
+
+    start = time.perf_counter()
+    decoded = sum(len(decode_chunk(payload)["timestamp"]) for payload in payloads)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "chunks": chunks,
+        "records": records,
+        "stored_bytes": stored,
+        "bytes_per_record": stored / records if records else None,
+        "compression_ratio": records * RECORD_SIZE / stored if stored else None,
+        "decoded_records": decoded,
+        "decode_throughput": decoded / elapsed if elapsed > 0 else None
+    }
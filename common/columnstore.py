@@ -0,0 +1,187 @@
+
+# Import custom subpackages
+from common import utils, database
+
+# Import standard packages
+import numpy as np
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.columnstore')
+
+
+class ColumnStore():
+
+    """ In-memory cache of the most recent telemetry, stored as NumPy
+        columns sorted by timestamp. Each refresh only queries the records
+        inserted since the previous one (by record identifier) and evicts
+        the records older than the cached window, so that several views of
+        the data (windows, panels) share a single incremental database scan.
+        Beyond max_records, the oldest records are evicted too.
+
+        :param window: the cached time window in seconds
+        :param table_name: the data table name
+        :param calibration: an optional Calibration applied once to the new records
+        :param commit_log: the commit log published by the Recorder (None to
+                           query the database at each refresh)
+        :param max_records: the maximum number of cached records (None for no limit)
+        :param sequence: the commit sequence number of the last refresh
+        :param columns: the cached columns dictionary (see database.retrieve_columns)
+        :param last_id: the identifier of the last cached record
+    """
+
+    def __init__(self, window, table_name="data", calibration=None, commit_log=None, max_records=None):
+
+        """ Initializes the column store
+
+            :param window: the cached time window in seconds
+            :param table_name: the data table name
+            :param calibration: an optional Calibration applied to the new records
+            :param commit_log: the commit log published by the Recorder
+            :param max_records: the maximum number of cached records
+        """
+
+        self.window = window
+        self.table_name = table_name
+        self.calibration = calibration
+        self.commit_log = commit_log
+        self.max_records = max_records
+        self.sequence = None
+        self.columns = database.rows_to_columns([])
+        self.last_id = None
+
+
+    def __len__(self):
+
+        """Returns the number of cached records"""
+
+        return len(self.columns["id"])
+
+
+    def is_current(self):
+
+        """ Checks whether no record was committed since the last refresh
+
+            :return: True if the cached records are up to date
+        """
+
+        return self.commit_log is not None and self.sequence == self.commit_log.get_sequence()
+
+
+    def resize(self, window):
+
+        """ Changes the cached time window. A larger window is backfilled by
+            the next refresh: the cached records are dropped and the whole
+            window is queried again, since the incremental refresh only
+            fetches the records inserted since the previous one.
+
+            :param window: the cached time window in seconds
+        """
+
+        if window > self.window:
+            self.columns = database.rows_to_columns([])
+            self.last_id = None
+            self.sequence = None
+
+        self.window = window
+
+
+    def refresh(self, connection_handler, now=None, current=None):
+
+        """ Fetches the new records and evicts the expired ones. The database
+            is not queried if no record was committed since the last refresh.
+
+            :param connection_handler: the Connection object (None if current)
+            :param now: the current naive timestamp (see utils.get_naive_timestamp)
+            :param current: the result of is_current when the connection was (or was not)
+                            opened, None to check it here. A commit landing after that
+                            check is fetched by the next refresh.
+            :return: the number of new records or -1 if the query fails
+        """
+
+        if now is None:
+            now = utils.get_naive_timestamp()
+
+        start = now - self.window
+
+        if current is None:
+            current = self.is_current()
+
+        if current:
+            self.evict(start)
+            return 0
+
+        # The sequence is read first, the records of a concurrent commit are fetched by the next refresh
+        sequence = self.commit_log.get_sequence() if self.commit_log is not None else None
+        data = database.retrieve_columns(connection_handler, start, table_name=self.table_name, after_id=self.last_id)
+
+        if data is None:
+            return -1
+
+        self.sequence = sequence
+        count = len(data["id"])
+
+        if count > 0:
+            if self.calibration is not None:
+                self.calibration.apply(data)
+            self.append(data)
+
+        self.evict(start)
+        return count
+
+
+    def append(self, data):
+
+        """ Appends new records, keeping the columns sorted by timestamp
+
+            :param data: the columns dictionary of the new records
+        """
+
+        if len(self) == 0:
+            columns = data
+        else:
+            columns = {key: np.concatenate((self.columns[key], values)) for key, values in data.items() if key in self.columns}
+
+        # Records may be committed out of order (late readings with a device
+        # timestamp, restored checkpoints), they are merged at their place
+        timestamps = columns["timestamp"]
+        if len(timestamps) > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+            order = np.argsort(timestamps, kind='stable')
+            columns = {key: values[order] for key, values in columns.items()}
+
+        self.columns = columns
+        self.last_id = max(self.last_id or 0, int(data["id"].max()))
+
+
+    def evict(self, start):
+
+        """ Drops the records older than a timestamp and the oldest records
+            beyond max_records
+
+            :param start: the naive timestamp of the oldest kept record
+        """
+
+        index = np.searchsorted(self.columns["timestamp"], start, side='left')
+
+        if self.max_records is not None:
+            index = max(index, len(self) - self.max_records)
+
+        if index > 0:
+            self.columns = {key: values[index:] for key, values in self.columns.items()}
+
+
+    def slice(self, start, end=None):
+
+        """ Returns the cached records of a time range (views, not copies)
+
+            :param start: the range start (naive timestamp)
+            :param end: the range end, excluded (None for no upper bound)
+            :return: the columns dictionary of the range
+        """
+
+        timestamps = self.columns["timestamp"]
+        first = np.searchsorted(timestamps, start, side='left')
+        last = len(timestamps) if end is None else np.searchsorted(timestamps, end, side='left')
+
+        return {key: values[first:last] for key, values in self.columns.items()}
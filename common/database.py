@@ -1,16 +1,38 @@
 
-from common import utils
+from common import utils, latest, metrics
 from core import telemetry
 
+from multiprocessing import Value, Array, BoundedSemaphore
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 
 import sqlite3
+import math
 import os
+import pathlib
+import sys
+import time
 import logging
 
 
 # Initialize logger for the module
-logger = logging.getLogger('voltazero_monitor')
+logger = logging.getLogger('voltazero_monitor.database')
+
+# Sensor columns returned by retrieve_columns (in the data table order)
+SENSORS = ('t0', 't1', 'th', 'ir', 'ls', 'bz')
+
+# Columns of the exported and imported rows (see iterate_rows and bulk_insert)
+EXPORT_COLUMNS = ('timestamp', 'device_id', 't0_value', 't1_value', 'th_value', 'ir_value', 'ls_value', 'bz_value')
+
+# Query cache metrics
+CACHE_HITS = metrics.counter('voltazero_query_cache_hits_total', 'Number of query results served by the query cache')
+CACHE_MISSES = metrics.counter('voltazero_query_cache_misses_total', 'Number of query results missing or invalidated in the query cache')
+CACHE_BYTES = metrics.gauge('voltazero_query_cache_bytes', 'Estimated memory size of the query cache')
+
+# Read snapshot metrics
+READ_RETRIES = metrics.counter('voltazero_read_retries_total', 'Number of read snapshots attempted again after a lock error')
+READER_WAIT_SECONDS = metrics.histogram('voltazero_reader_wait_seconds', 'Time waited for a free reader slot')
 
 
 # Initializes the database connection
@@ -41,17 +63,25 @@ def check_connection(db_filename, db_path=""):
 
 
 # Open a new connection handler to the database
-def connect(db_filename, db_path=""):
+def connect(db_filename, db_path="", readonly=False, timeout=5.0):
     """ Creates a database connection handler to the SQLite database
         specified by the db_filename
 
         :param db_filename: database filename
         :param db_path: the path to the database file
+        :param readonly: if True, the database is opened in read-only mode
+                         (it must exist)
+        :param timeout: the maximum time in seconds a statement waits for a lock
         :return: Connection object or None
     """
     try:
         db_name = os.path.join(db_path, db_filename)
-        connection_handler = sqlite3.connect(db_name)
+
+        if readonly:
+            connection_handler = sqlite3.connect(f"{pathlib.Path(db_name).absolute().as_uri()}?mode=ro", uri=True,
+                                                 timeout=timeout)
+        else:
+            connection_handler = sqlite3.connect(db_name, timeout=timeout)
         connection_handler.text_factory = sqlite3.OptimizedUnicode
 
         return connection_handler
@@ -60,6 +90,32 @@ def connect(db_filename, db_path=""):
         return None
 
 
+def enable_wal(connection_handler):
+    """ Switches the database to the write-ahead log journal mode (saved in
+        the database file). The readers then see the last commit before
+        their transaction and neither block nor are blocked by the writer.
+
+        :param connection_handler: the Connection object (writable)
+        :return: 0 if success, -1 if the connection handler is None or the mode
+                 is not supported and -2 if exception arises
+    """
+    try:
+        if connection_handler is None:
+            return -1
+
+        mode = connection_handler.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+
+        if mode.lower() != "wal":
+            logger.warning(f"The write-ahead log is not supported by the database, journal mode: {mode}")
+            return -1
+
+        return 0
+
+    except sqlite3.Error as e:
+        logger.error(f"Exception: {str(e)}")
+        return -2
+
+
 def create_datatable(connection_handler, table_name="data"):
     """ Creates a new SQLite database and datatable where the telemetry will be stored
 
@@ -78,7 +134,8 @@ def create_datatable(connection_handler, table_name="data"):
                     ls_value FLOAT DEFAULT NULL,
                     bz_value INTEGER DEFAULT NULL,
                     timestamp DATETIME,
-                    db_timestamp DATETIME DEFAULT (DATETIME(CURRENT_TIMESTAMP))
+                    db_timestamp DATETIME DEFAULT (DATETIME(CURRENT_TIMESTAMP)),
+                    device_id TEXT DEFAULT NULL
                 );
                """
 
@@ -86,6 +143,7 @@ def create_datatable(connection_handler, table_name="data"):
             return -1
 
         connection_handler.cursor().execute(sql)
+        create_indexes(connection_handler, table_name)
         return 0
 
     except Exception as e:
@@ -93,41 +151,110 @@ def create_datatable(connection_handler, table_name="data"):
         return -2
 
 
-def insert_telemetry_data(connection_handler, data, table_name="data"):
-    """ Query the database to insert a list of telemetry records in the database
+def upgrade_datatable(connection_handler, table_name="data"):
+    """ Adds the columns introduced after the creation of an existing data table
 
         :param connection_handler: the Connection object
-        :param data: the list of telemetry records
         :param table_name: the data table name
+        :return: 0 if succes, -1 if the connection handler is None and -2 if exception arises
+    """
+    try:
+        if connection_handler is None:
+            return -1
+
+        cursor = connection_handler.cursor()
+        cursor.execute(f"PRAGMA table_info({table_name})")
+        columns = [row[1] for row in cursor.fetchall()]
+
+        if 'device_id' not in columns:
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN device_id TEXT DEFAULT NULL")
+            connection_handler.commit()
+            logger.info(f"Column device_id added to the table {table_name}")
+
+        cursor.close()
+        create_indexes(connection_handler, table_name)
+        return 0
+
+    except Exception as e:
+        logger.error(f"Exception: {str(e)}")
+        return -2
+
+
+def create_indexes(connection_handler, table_name="data"):
+    """ Creates the indexes of the time range queries (if they do not exist)
+
+        :param connection_handler: the Connection object
+        :param table_name: the data table name
+        :return: 0 if succes and -2 if exception arises
+    """
+    try:
+        cursor = connection_handler.cursor()
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_timestamp ON {table_name} (timestamp)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_device ON {table_name} (device_id, timestamp)")
+        connection_handler.commit()
+        cursor.close()
+        return 0
+
+    except sqlite3.Error as error:
+        logger.error(f"Exception: {str(error)}")
+        return -2
+
+
+def drop_indexes(connection_handler, table_name="data"):
+    """ Drops the indexes of a data table (before a bulk insert)
+
+        :param connection_handler: the Connection object
+        :param table_name: the data table name
+        :return: 0 if succes and -2 if exception arises
+    """
+    try:
+        cursor = connection_handler.cursor()
+        cursor.execute(f"DROP INDEX IF EXISTS idx_{table_name}_timestamp")
+        cursor.execute(f"DROP INDEX IF EXISTS idx_{table_name}_device")
+        connection_handler.commit()
+        cursor.close()
+        return 0
+
+    except sqlite3.Error as error:
+        logger.error(f"Exception: {str(error)}")
+        return -2
+
+
+def insert_telemetry_data(connection_handler, data, table_name="data", latest_rows=None):
+    """ Query the database to insert a list of telemetry records in the database.
+        The records are inserted with a single prepared statement and committed
+        in one transaction, along with the latest values of their devices
+
+        :param connection_handler: the Connection object
+        :param data: the list of telemetry rows (see Telemetry.as_row)
+        :param table_name: the data table name
+        :param latest_rows: the optional rows of the latest values table (see latest.LatestValues)
         :return: count of inserted records or -1 if exception arises
     """
     try:
         cursor = connection_handler.cursor()
 
         sqlite_insert_query = f"""INSERT INTO `{table_name}`
-                                ('t0_value', 't1_value', 'th_value', 'ir_value', 'ls_value', 'bz_value', 'timestamp') 
-                                VALUES """
+                                ('t0_value', 't1_value', 'th_value', 'ir_value', 'ls_value', 'bz_value', 'timestamp', 'device_id')
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
 
-        # condition_if_true if condition else condition_if_false
-        for i in range(len(data)):
-            item = data[i]
+        # Missing readings are parsed as 'NULL' by the monitor
+        rows = [tuple(None if value == 'NULL' else value for value in item) for item in data]
 
-            insert = f"({item[0]}, {item[1]}, {item[2]}, {item[3]}, {item[4]}, {item[5]}, '{item[6]}')"
-            sqlite_insert_query = f"{sqlite_insert_query}{insert}"
+        cursor.executemany(sqlite_insert_query, rows)
+        count = cursor.rowcount
 
-            if i == len(data)-1:
-                sqlite_insert_query = f"{sqlite_insert_query};"
-            else:
-                sqlite_insert_query = f"{sqlite_insert_query},"
+        if latest_rows:
+            cursor.executemany(latest.get_upsert_query(table_name), latest_rows)
 
-        count = cursor.execute(sqlite_insert_query)
         connection_handler.commit()
         cursor.close()
 
-        logger.debug(f"Data rows inserted: {cursor.rowcount}")
+        logger.debug("Data rows inserted: %d", count)
         return count
 
     except sqlite3.Error as error:
+        connection_handler.rollback()
         logger.error(f"Exception: {str(error)}")
         return -1
 
@@ -161,6 +288,196 @@ def retrieve_data(connection_handler, time_window, table_name):
         return None
 
 
+def retrieve_columns(connection_handler, start, end=None, table_name="data", device_id=None, after_id=None):
+    """ Query the database to get the telemetry records of a time range as
+        NumPy columns. Timestamps are returned as seconds since 1970/01/01
+        of the stored (local) time and NULL readings as NaN
+
+        :param connection_handler: the Connection object
+        :param start: the range start (see utils.get_naive_timestamp)
+        :param end: the range end (excluded), None for no upper bound
+        :param table_name: the data table name
+        :param device_id: an optional device identifier filter
+        :param after_id: if set, only the records inserted after this record
+                         identifier are returned (incremental queries)
+        :return: dictionary of arrays (id, timestamp, device and one array per
+                 sensor) or None if exception arises
+    """
+    try:
+        sql = f"""SELECT id, CAST(strftime('%s', replace(timestamp, '/', '-')) AS REAL),
+                        t0_value, t1_value, th_value, ir_value, ls_value, bz_value, device_id
+                    FROM {table_name} WHERE timestamp >= ?"""
+        params = [utils.format_naive_timestamp(start)]
+
+        if end is not None:
+            sql = f"{sql} AND timestamp < ?"
+            params.append(utils.format_naive_timestamp(end))
+
+        if device_id is not None:
+            sql = f"{sql} AND device_id = ?"
+            params.append(device_id)
+
+        if after_id is not None:
+            sql = f"{sql} AND id > ?"
+            params.append(after_id)
+
+        cursor = connection_handler.cursor()
+        cursor.execute(f"{sql} ORDER BY timestamp ASC", params)
+        rows = cursor.fetchall()
+        cursor.close()
+
+        return rows_to_columns(rows)
+
+    except sqlite3.Error as error:
+        logger.error(f"Exception: {str(error)}")
+        return None
+
+
+def rows_to_columns(rows):
+    """ Converts the rows of a retrieve_columns query into NumPy columns
+
+        :param rows: the list of (id, timestamp, t0, t1, th, ir, ls, bz, device) rows
+        :return: dictionary of arrays
+    """
+    # NumPy is only required by the readers (not by the Recorder)
+    import numpy as np
+
+    fields = list(zip(*rows)) if rows else [()] * (len(SENSORS) + 3)
+
+    columns = {
+        "id": np.array(fields[0], dtype=np.int64),
+        "timestamp": np.array(fields[1], dtype=float),
+        "device": np.array(fields[-1], dtype=object)
+    }
+
+    # None (NULL) values are converted to NaN
+    for i, sensor in enumerate(SENSORS):
+        columns[sensor] = np.array(fields[i + 2], dtype=float)
+
+    return columns
+
+
+def iterate_rows(connection_handler, start=None, end=None, table_name="data", device_id=None, chunk_size=10000):
+    """ Iterates over the telemetry records of a time range by chunks, so
+        that the memory usage does not depend on the range size. The rows
+        hold the EXPORT_COLUMNS values.
+
+        :param connection_handler: the Connection object
+        :param start: the range start (see utils.get_naive_timestamp), None for no lower bound
+        :param end: the range end (excluded), None for no upper bound
+        :param table_name: the data table name
+        :param device_id: an optional device identifier filter
+        :param chunk_size: the maximum number of rows per chunk
+        :return: generator of lists of rows
+    """
+    conditions = []
+    params = []
+
+    if start is not None:
+        conditions.append("timestamp >= ?")
+        params.append(utils.format_naive_timestamp(start))
+
+    if end is not None:
+        conditions.append("timestamp < ?")
+        params.append(utils.format_naive_timestamp(end))
+
+    if device_id is not None:
+        conditions.append("device_id = ?")
+        params.append(device_id)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    cursor = connection_handler.cursor()
+
+    try:
+        cursor.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM {table_name} {where} ORDER BY timestamp ASC", params)
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+    finally:
+        cursor.close()
+
+
+def bulk_insert(connection_handler, chunks, table_name="data"):
+    """ Inserts chunks of rows (EXPORT_COLUMNS values) in one transaction.
+        The indexes are dropped during the insert and rebuilt afterwards, and
+        the synchronous writes are disabled until the commit.
+
+        :param connection_handler: the Connection object
+        :param chunks: an iterable of lists of rows
+        :param table_name: the data table name
+        :return: count of inserted records or -1 if exception arises (nothing is
+                 inserted and the indexes are rebuilt)
+    """
+    cursor = connection_handler.cursor()
+    synchronous = cursor.execute("PRAGMA synchronous").fetchone()[0]
+    count = 0
+
+    try:
+        drop_indexes(connection_handler, table_name)
+        cursor.execute("PRAGMA synchronous = OFF")
+
+        sql = f"""INSERT INTO `{table_name}` ({', '.join(EXPORT_COLUMNS)})
+                  VALUES ({', '.join('?' * len(EXPORT_COLUMNS))})"""
+
+        for rows in chunks:
+            cursor.executemany(sql, rows)
+            count += len(rows)
+
+        connection_handler.commit()
+        logger.debug("Data rows imported: %d", count)
+
+    except Exception as error:
+        # Database errors and malformed rows of the chunks (e.g. ValueError of an import reader)
+        logger.error(f"Exception: {str(error)}")
+        count = -1
+
+    finally:
+        # The failed insert is rolled back first: the pragma cannot be changed within a transaction
+        if connection_handler.in_transaction:
+            connection_handler.rollback()
+
+        cursor.execute(f"PRAGMA synchronous = {synchronous}")
+        cursor.close()
+        create_indexes(connection_handler, table_name)
+
+    return count
+
+
+def get_external_version(connection_handler):
+    """ Returns the version of the changes made to the database outside the
+        Recorder (see mark_external_change), stored in PRAGMA user_version
+
+        :param connection_handler: the Connection object
+        :return: the version number
+    """
+    return connection_handler.execute("PRAGMA user_version").fetchone()[0]
+
+
+def mark_external_change(connection_handler):
+    """ Signals a change of the database made outside the Recorder (e.g. an
+        import or a compaction by the archive tool) to the query caches of a
+        running application, which only follow the Recorder commits
+
+        :param connection_handler: the Connection object (writable)
+        :return: 0 if success, -1 if the connection handler is None and -2 if exception arises
+    """
+    try:
+        if connection_handler is None:
+            return -1
+
+        version = get_external_version(connection_handler)
+        connection_handler.execute(f"PRAGMA user_version = {(version + 1) % 2 ** 31}")
+        return 0
+
+    except sqlite3.Error as e:
+        logger.error(f"Exception: {str(e)}")
+        return -2
+
+
 def check_if_datatable_exists(connection_handler, table_name="data"):
     """ Query the database to check if the data table already eaxists
 
@@ -202,3 +519,461 @@ def disconnect(connection_handler):
     except sqlite3.Error as e:
         logger.error('Database disconnection error: {0}'.format(e))
         return -1
+
+
+def is_locked(error):
+    """ Checks whether a database error is a lock conflict (transient)
+
+        :param error: the sqlite3.Error
+        :return: True if the operation may succeed once the lock is released
+    """
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+class SnapshotReader():
+
+    """ Runs the reads in snapshot-consistent read transactions. Each
+        snapshot is a deferred transaction: all its queries see the database
+        as of its first read, so that a window read in several queries (rows
+        and compressed chunks, several chunks of the query cache) never
+        mixes the states before and after a commit or a compaction. In WAL
+        mode the snapshot does not block the Recorder commits. The start of
+        a snapshot refused by a lock (rollback journal, WAL recovery) is
+        attempted again after a bounded backoff. The number of concurrent
+        snapshots of the processes sharing the reader is limited by a
+        semaphore, so that the readers do not starve the writer of I/O and
+        do not hold back the WAL checkpoints indefinitely.
+
+        :param max_readers: the maximum number of concurrent snapshots (0 for no limit)
+        :param busy_timeout: the maximum time in seconds to wait for a lock or a reader slot
+        :param retries: the number of new attempts of a snapshot refused by a lock
+        :param semaphore: the reader slots shared with the child processes (None if unlimited)
+    """
+
+    # Initial and maximum delays in seconds between two attempts
+    min_backoff = 0.01
+    max_backoff = 0.5
+
+    def __init__(self, max_readers=0, busy_timeout=5.0, retries=3):
+
+        """ Initializes the reader (before the processes are started)
+
+            :param max_readers: the maximum number of concurrent snapshots (0 for no limit)
+            :param busy_timeout: the maximum time in seconds to wait for a lock or a reader slot
+            :param retries: the number of new attempts of a snapshot refused by a lock
+        """
+
+        self.max_readers = max_readers
+        self.busy_timeout = busy_timeout
+        self.retries = retries
+        self.semaphore = BoundedSemaphore(max_readers) if max_readers > 0 else None
+
+
+    @classmethod
+    def from_config(cls, appconfig):
+
+        """ Creates the reader of the application configuration
+
+            :param appconfig: the application configuration object
+            :return: the SnapshotReader object
+        """
+
+        return cls(appconfig.database_max_readers, appconfig.database_busy_timeout, appconfig.database_read_retries)
+
+
+    def connect(self, db_filename):
+
+        """ Opens a read-only connection waiting busy_timeout for the locks
+
+            :param db_filename: database filename
+            :return: Connection object or None
+        """
+
+        return connect(db_filename, readonly=True, timeout=self.busy_timeout)
+
+
+    def begin(self, connection_handler):
+
+        """ Starts a read transaction and takes its snapshot (first read),
+            attempting again while the database is locked
+
+            :param connection_handler: the Connection object
+            :raises sqlite3.OperationalError: the database is still locked after the retries
+        """
+
+        delay = self.min_backoff
+
+        for attempt in range(self.retries + 1):
+            try:
+                connection_handler.execute("BEGIN DEFERRED")
+                connection_handler.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                return
+
+            except sqlite3.OperationalError as error:
+                if connection_handler.in_transaction:
+                    connection_handler.rollback()
+
+                if not is_locked(error) or attempt == self.retries:
+                    raise
+
+                READ_RETRIES.inc()
+                logger.warning(f"Read snapshot refused ({str(error)}), new attempt in {delay:.2f}s")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+
+    @contextmanager
+    def snapshot(self, connection_handler):
+
+        """ Runs the enclosed queries in one read transaction
+
+            :param connection_handler: the Connection object (None: no transaction)
+            :raises sqlite3.OperationalError: no reader slot or the database is still locked
+        """
+
+        if connection_handler is None:
+            yield connection_handler
+            return
+
+        if self.semaphore is not None:
+            start = time.perf_counter()
+            acquired = self.semaphore.acquire(timeout=self.busy_timeout)
+            READER_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+            if not acquired:
+                raise sqlite3.OperationalError(f"database is busy: {self.max_readers} concurrent readers")
+
+        try:
+            self.begin(connection_handler)
+
+            try:
+                yield connection_handler
+            finally:
+                # The read transaction is released as soon as possible (WAL checkpoints)
+                if connection_handler.in_transaction:
+                    connection_handler.rollback()
+
+        finally:
+            if self.semaphore is not None:
+                self.semaphore.release()
+
+
+class CommitLog():
+
+    """ Commit sequence number published by the Recorder and shared with
+        the reader processes. Each commit increments the sequence and saves
+        the oldest timestamp of its records in a ring of the last commits,
+        so that a reader can tell whether the results of a time range are
+        still valid without querying the database.
+
+        :param sequence: the shared commit sequence number
+        :param lows: the shared ring of the oldest timestamp of each commit
+    """
+
+    # Number of commits kept in the ring (a reader which falls further behind invalidates everything)
+    capacity = 256
+
+    def __init__(self):
+
+        """ Initializes the shared commit log (before the processes are started) """
+
+        self.sequence = Value('q', 0)
+        self.lows = Array('d', self.capacity, lock=False)
+
+
+    def publish(self, low):
+
+        """ Records a commit (Recorder side)
+
+            :param low: the oldest naive timestamp of the committed records
+                        (0 if any time range may have changed)
+        """
+
+        with self.sequence.get_lock():
+            self.lows[(self.sequence.value + 1) % self.capacity] = low
+            self.sequence.value += 1
+
+
+    def get_sequence(self):
+
+        """ Returns the current commit sequence number """
+
+        return self.sequence.value
+
+
+    def get_changes(self, since):
+
+        """ Returns the oldest timestamp committed after a sequence number
+
+            :param since: the sequence number of the reader
+            :return: the current sequence number and the oldest committed
+                     naive timestamp (inf if nothing was committed, 0 if the
+                     commits are no longer in the ring)
+        """
+
+        with self.sequence.get_lock():
+            sequence = self.sequence.value
+
+            if sequence - since > self.capacity or sequence < since:
+                return sequence, 0
+
+            low = min((self.lows[i % self.capacity] for i in range(since + 1, sequence + 1)), default=math.inf)
+
+        return sequence, low
+
+
+def get_size(value):
+
+    """ Estimates the memory size of a cached query result
+
+        :param value: a columns dictionary, an array or a list of rows
+        :return: the size in bytes
+    """
+
+    if isinstance(value, dict):
+        return sum(get_size(item) for item in value.values())
+
+    if hasattr(value, 'nbytes'):
+        # The object arrays (device identifiers) hold references to strings
+        return value.nbytes + (64 * len(value) if value.dtype == object else 0)
+
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+
+    return sys.getsizeof(value)
+
+
+class QueryCache():
+
+    """ LRU cache of the window and aggregate query results, within a
+        memory budget. The windows are split into time chunks aligned on
+        chunk_span, cached separately, so that overlapping windows share
+        their chunks. A cached result is valid as long as no record of its
+        time range has been committed since (see CommitLog): between two
+        commits the reads do not query the database, and a commit only
+        invalidates the chunks of the range it touched (usually the last
+        one). The changes made outside the Recorder (archive tool imports
+        and compactions, see mark_external_change) are not in the commit log,
+        they invalidate the whole cache. Without commit log, any change of
+        the database (PRAGMA data_version) invalidates the whole cache.
+
+        :param budget: the memory budget in bytes
+        :param chunk_span: the time span of the cached window chunks in seconds
+        :param commit_log: the commit log published by the Recorder (None to
+                           use the database data version)
+        :param entries: dictionary mapping keys to [sequence, end, value, size] entries (LRU order)
+        :param size: the estimated memory size of the cached results
+        :param data_version: the last database data version (without commit log)
+        :param external_version: the last version of the external changes (with commit log)
+    """
+
+    def __init__(self, budget_mb=64, chunk_span=60, commit_log=None):
+
+        """ Initializes the cache
+
+            :param budget_mb: the memory budget in megabytes
+            :param chunk_span: the time span of the cached window chunks in seconds
+            :param commit_log: the commit log published by the Recorder
+        """
+
+        self.budget = budget_mb * 1024 * 1024
+        self.chunk_span = chunk_span
+        self.commit_log = commit_log
+        self.entries = OrderedDict()
+        self.size = 0
+        self.data_version = None
+        self.external_version = None
+
+
+    def __len__(self):
+
+        """ Returns the number of cached results """
+
+        return len(self.entries)
+
+
+    def get_sequence(self, connection_handler):
+
+        """ Returns the current commit sequence number. The cache is cleared
+            when the database has been modified outside the Recorder, or
+            without commit log when the database has been modified.
+
+            :param connection_handler: the Connection object (None with commit log
+                                       to skip the check of the external changes)
+            :return: the sequence number
+        """
+
+        if self.commit_log is not None:
+            if connection_handler is not None:
+                external_version = get_external_version(connection_handler)
+
+                if external_version != self.external_version:
+                    self.clear()
+                    self.external_version = external_version
+
+            return self.commit_log.get_sequence()
+
+        data_version = connection_handler.execute("PRAGMA data_version").fetchone()[0]
+
+        if data_version != self.data_version:
+            self.clear()
+            self.data_version = data_version
+
+        return 0
+
+
+    def lookup(self, key, sequence):
+
+        """ Returns a cached result if no record of its range was committed
+            since it was cached
+
+            :param key: the result key
+            :param sequence: the current commit sequence number
+            :return: the cached result or None
+        """
+
+        entry = self.entries.get(key)
+
+        if entry is None:
+            CACHE_MISSES.inc()
+            return None
+
+        if entry[0] != sequence:
+            low = self.commit_log.get_changes(entry[0])[1] if self.commit_log is not None else 0
+
+            if low < entry[1]:
+                self.remove(key)
+                CACHE_MISSES.inc()
+                return None
+
+            # The commits did not touch the range of the result
+            entry[0] = sequence
+
+        self.entries.move_to_end(key)
+        CACHE_HITS.inc()
+        return entry[2]
+
+
+    def store(self, key, end, value, sequence):
+
+        """ Caches a result and evicts the least recently used ones beyond
+            the memory budget
+
+            :param key: the result key
+            :param end: the end of the time range of the result (inf for an open range)
+            :param value: the result
+            :param sequence: the commit sequence number read before the query
+        """
+
+        self.remove(key)
+        size = get_size(value)
+
+        if size > self.budget:
+            return
+
+        self.entries[key] = [sequence, end, value, size]
+        self.size += size
+
+        while self.size > self.budget:
+            self.remove(next(iter(self.entries)))
+
+        CACHE_BYTES.set(self.size)
+
+
+    def remove(self, key):
+
+        """ Removes a cached result
+
+            :param key: the result key
+        """
+
+        entry = self.entries.pop(key, None)
+
+        if entry is not None:
+            self.size -= entry[3]
+
+
+    def clear(self):
+
+        """ Removes all the cached results """
+
+        self.entries.clear()
+        self.size = 0
+        CACHE_BYTES.set(0)
+
+
+    def memoize(self, connection_handler, key, end, compute):
+
+        """ Returns the cached result of a query or computes and caches it
+            (e.g. aggregates)
+
+            :param connection_handler: the Connection object
+            :param key: the result key (it must identify the query and its range)
+            :param end: the end of the time range of the query (None for no upper bound)
+            :param compute: the function computing the result (None results are not cached)
+            :return: the result
+        """
+
+        sequence = self.get_sequence(connection_handler)
+        value = self.lookup(key, sequence)
+
+        if value is None:
+            value = compute()
+
+            if value is not None:
+                self.store(key, math.inf if end is None else end, value, sequence)
+
+        return value
+
+
+    def retrieve_columns(self, connection_handler, start, end=None, table_name="data", device_id=None, fetch=None):
+
+        """ Same as retrieve_columns, assembled from the cached chunks
+
+            :param connection_handler: the Connection object
+            :param start: the range start (see utils.get_naive_timestamp)
+            :param end: the range end (excluded), None for no upper bound
+            :param table_name: the data table name
+            :param device_id: an optional device identifier filter
+            :param fetch: the query function of a chunk (default: retrieve_columns,
+                          e.g. chunks.retrieve_columns to include the compressed records)
+            :return: dictionary of arrays or None if a query fails
+        """
+
+        # NumPy is only required by the readers (not by the Recorder)
+        import numpy as np
+
+        fetch = fetch or retrieve_columns
+        span = self.chunk_span
+        parts = []
+        lower = math.floor(start / span) * span
+
+        while end is None or lower < end:
+            upper = lower + span
+
+            # The chunk of the current time is open (records may be committed later in it)
+            if end is None and upper > utils.get_naive_timestamp():
+                upper = None
+
+            part = self.memoize(connection_handler, (fetch.__module__, table_name, device_id, lower, upper), upper,
+                                lambda: fetch(connection_handler, lower, upper, table_name, device_id))
+
+            if part is None:
+                return None
+
+            parts.append(part)
+
+            if upper is None:
+                break
+
+            lower = upper
+
+        columns = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+        # The bounds are compared at the resolution of the stored timestamps
+        timestamps = columns["timestamp"]
+        first = np.searchsorted(timestamps, math.floor(start), side='left')
+        last = len(timestamps) if end is None else np.searchsorted(timestamps, math.floor(end), side='left')
+
+        return {key: values[first:last] for key, values in columns.items()}
@@ -0,0 +1,152 @@
+
+# Import custom subpackages
+from common import metrics
+
+# Import standard packages
+from collections import OrderedDict
+
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.dedup')
+
+# Deduplication metrics
+DUPLICATES_DROPPED = metrics.counter('voltazero_duplicates_dropped_total', 'Number of duplicate telemetry records filtered before insertion')
+LATE_RECORDS = metrics.counter('voltazero_late_records_total', 'Number of telemetry records received after a more recent reading of the same device')
+
+
+class DedupIndex():
+
+    """ Bounded in-memory index of the recently ingested readings of each
+        device, used to filter the duplicates (QoS 1 redeliveries, several
+        Monitor instances) without database lookups. A reading is identified
+        by its device sequence number and device timestamp or, failing that,
+        by its device timestamp: the readings stamped on arrival cannot be
+        told apart from a constant sensor and are never filtered. Each device
+        keeps its last capacity keys (least recently seen first out), and the
+        least recently active devices are evicted beyond max_devices. When
+        the sequence of a device restarts (reboot), its keys are cleared.
+
+        :param capacity: the number of keys kept per device
+        :param max_devices: the maximum number of indexed devices
+        :param devices: the per-device entries (keys, latest order value and
+                        the device timestamp of the latest reading)
+    """
+
+    def __init__(self, capacity=1024, max_devices=10000):
+
+        """ Initializes the index
+
+            :param capacity: the number of keys kept per device
+            :param max_devices: the maximum number of indexed devices
+        """
+
+        self.capacity = capacity
+        self.max_devices = max_devices
+        self.devices = OrderedDict()
+
+
+    def get_key(self, tlm):
+
+        """ Returns the identifier of a reading within its device
+
+            :param tlm: the telemetry record
+            :return: the key or None if the reading cannot be identified
+        """
+
+        # The device timestamp tells apart the readings of a sequence restarted by a reboot
+        if tlm.seq is not None:
+            return ('seq', tlm.seq, tlm.device_ts)
+
+        if tlm.device_ts is not None:
+            return ('ts', tlm.device_ts)
+
+        return None
+
+
+    def check(self, tlm):
+
+        """ Checks a reading and adds it to the index
+
+            :param tlm: the telemetry record
+            :return: True if the reading is a duplicate, False otherwise
+        """
+
+        key = self.get_key(tlm)
+
+        if key is None:
+            return False
+
+        entry = self.devices.get(tlm.id)
+
+        if entry is None:
+            entry = {"keys": OrderedDict(), "last": None, "ts": None}
+            self.devices[tlm.id] = entry
+
+            if len(self.devices) > self.max_devices:
+                self.devices.popitem(last=False)
+        else:
+            self.devices.move_to_end(tlm.id)
+
+        keys = entry["keys"]
+
+        if key in keys:
+            keys.move_to_end(key)
+            return True
+
+        if key[0] == 'seq' and entry["last"] is not None and tlm.seq < entry["last"] and self.is_restart(entry, tlm):
+            logger.info(f"Sequence of device {tlm.id} restarted at {tlm.seq}")
+            keys.clear()
+            entry["last"] = None
+
+        keys[key] = None
+        if len(keys) > self.capacity:
+            keys.popitem(last=False)
+
+        # Out-of-order readings are kept (and stored with their own timestamp)
+        order = key[1]
+        if entry["last"] is not None and order < entry["last"]:
+            LATE_RECORDS.inc()
+        else:
+            entry["last"] = order
+            entry["ts"] = tlm.device_ts
+
+        return False
+
+
+    def is_restart(self, entry, tlm):
+
+        """ Checks whether a reading numbered below the latest one of its
+            device starts a new sequence (device reboot) rather than being
+            a late delivery: its device timestamp is more recent than the
+            one of the latest reading or, without device timestamps, its
+            sequence number is lower by more than the index capacity
+
+            :param entry: the device entry
+            :param tlm: the telemetry record
+            :return: True if the sequence restarted
+        """
+
+        if tlm.device_ts is not None and entry["ts"] is not None:
+            return tlm.device_ts > entry["ts"]
+
+        return entry["last"] - tlm.seq > self.capacity
+
+
+    def filter(self, records):
+
+        """ Removes the duplicates from a list of records
+
+            :param records: the list of telemetry records
+            :return: the list of the first occurrences
+        """
+
+        kept = [tlm for tlm in records if not self.check(tlm)]
+        dropped = len(records) - len(kept)
+
+        if dropped > 0:
+            DUPLICATES_DROPPED.inc(dropped)
+            logger.debug("Duplicate records dropped: %d", dropped)
+
+        return kept
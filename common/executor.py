@@ -0,0 +1,340 @@
+
+# Import custom subpackages
+from common import database, chunks, resample, utils
+
+# Import standard packages
+from concurrent.futures import ProcessPoolExecutor
+
+import math
+import os
+import logging
+
+import numpy as np
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.executor')
+
+# Aggregates returned by the executor (the partial aggregates are count, sum, min and max)
+AGGREGATES = ('count', 'sum', 'min', 'max', 'mean')
+
+
+def split_range(start, end, step, partitions):
+
+    """ Splits a time range into partitions aligned on the aggregation step,
+        so that each bucket is computed by one partition
+
+        :param start: the range start (see utils.get_naive_timestamp)
+        :param end: the range end (excluded)
+        :param step: the aggregation step in seconds
+        :param partitions: the desired number of partitions
+        :return: the list of (start, end) partition ranges
+    """
+
+    buckets = max(math.ceil((end - math.floor(start / step) * step) / step), 1)
+    size = math.ceil(buckets / max(partitions, 1)) * step
+    bounds = []
+    lower = start
+
+    while lower < end:
+        upper = min((math.floor(lower / step) * step) + size, end)
+        bounds.append((lower, upper))
+        lower = upper
+
+    return bounds
+
+
+def merge(partial, key, values):
+
+    """ Merges partial aggregates (count, sum, min, max) into a dictionary
+
+        :param partial: dictionary mapping keys to partial aggregates
+        :param key: the (bucket, device, sensor) key
+        :param values: the (count, sum, min, max) tuple
+    """
+
+    current = partial.get(key)
+
+    if current is None:
+        partial[key] = values
+    else:
+        partial[key] = (current[0] + values[0], current[1] + values[1],
+                        min(current[2], values[2]), max(current[3], values[3]))
+
+
+def aggregate_rows(connection_handler, start, end, step, sensors, table_name="data", device_id=None, by_device=False):
+
+    """ Computes the partial aggregates of the uncompressed records of a
+        range in SQLite (GROUP BY bucket and, optionally, device)
+
+        :param connection_handler: the Connection object
+        :param start: the range start
+        :param end: the range end (excluded)
+        :param step: the aggregation step in whole seconds
+        :param sensors: the aggregated sensors
+        :param table_name: the data table name
+        :param device_id: an optional device identifier filter
+        :param by_device: if True, the records are grouped by device too
+        :return: dictionary mapping (bucket, device, sensor) keys to (count, sum, min, max)
+    """
+
+    bucket = f"CAST(strftime('%s', replace(timestamp, '/', '-')) AS INTEGER) / {int(step)} * {int(step)}"
+    device = "device_id" if by_device else "NULL"
+    fields = ', '.join(f"COUNT({s}_value), TOTAL({s}_value), MIN({s}_value), MAX({s}_value)" for s in sensors)
+
+    sql = f"SELECT {bucket}, {device}, {fields} FROM {table_name} WHERE timestamp >= ? AND timestamp < ?"
+    params = [utils.format_naive_timestamp(start), utils.format_naive_timestamp(end)]
+
+    if device_id is not None:
+        sql = f"{sql} AND device_id = ?"
+        params.append(device_id)
+
+    cursor = connection_handler.cursor()
+    rows = cursor.execute(f"{sql} GROUP BY 1, 2", params).fetchall()
+    cursor.close()
+
+    partial = {}
+
+    for row in rows:
+        for i, sensor in enumerate(sensors):
+            values = row[2 + 4 * i:6 + 4 * i]
+            if values[0]:
+                merge(partial, (float(row[0]), row[1], sensor), values)
+
+    return partial
+
+
+def aggregate_columns(columns, step, sensors, by_device=False):
+
+    """ Computes the partial aggregates of columnar records (vectorized)
+
+        :param columns: dictionary of arrays sorted by timestamp (see chunks.retrieve_chunks)
+        :param step: the aggregation step in seconds
+        :param sensors: the aggregated sensors
+        :param by_device: if True, the records are grouped by device too
+        :return: dictionary mapping (bucket, device, sensor) keys to (count, sum, min, max)
+    """
+
+    partial = {}
+    buckets = np.floor(columns["timestamp"] / step) * step
+    devices = dict.fromkeys(columns["device"].tolist()) if by_device else [None]
+
+    for device in devices:
+        selected = columns["device"] == device if by_device else np.ones(len(buckets), dtype=bool)
+
+        for sensor in sensors:
+            values = columns[sensor]
+            valid = selected & ~np.isnan(values)
+
+            if not valid.any():
+                continue
+
+            # The records are sorted by timestamp: each bucket is a contiguous segment
+            sorted_buckets = buckets[valid]
+            sorted_values = values[valid]
+            first = np.flatnonzero(np.concatenate(([True], sorted_buckets[1:] != sorted_buckets[:-1])))
+            keys = sorted_buckets[first]
+
+            counts = np.diff(np.append(first, len(sorted_values)))
+            sums = np.add.reduceat(sorted_values, first)
+            lows = np.minimum.reduceat(sorted_values, first)
+            highs = np.maximum.reduceat(sorted_values, first)
+
+            for i, key in enumerate(keys.tolist()):
+                merge(partial, (key, device, sensor), (int(counts[i]), float(sums[i]), float(lows[i]), float(highs[i])))
+
+    return partial
+
+
+def aggregate_partition(database_path, start, end, step, sensors, table_name="data", device_id=None, by_device=False,
+                        busy_timeout=5.0, retries=3):
+
+    """ Computes the partial aggregates of a partition (worker process side)
+        through a read-only connection, including the compressed chunks. The
+        rows and the chunks are read in one snapshot, so that a concurrent
+        compaction neither hides nor duplicates records.
+
+        :param database_path: the database file
+        :param start: the partition start
+        :param end: the partition end (excluded)
+        :param step: the aggregation step in whole seconds
+        :param sensors: the aggregated sensors
+        :param table_name: the data table name
+        :param device_id: an optional device identifier filter
+        :param by_device: if True, the records are grouped by device too
+        :param busy_timeout: the maximum time in seconds to wait for a lock
+        :param retries: the number of new attempts of a snapshot refused by a lock
+        :return: dictionary mapping (bucket, device, sensor) keys to (count, sum, min, max)
+        :raises RuntimeError: the database cannot be opened
+    """
+
+    # The number of workers bounds the concurrent readers of the executor
+    reader = database.SnapshotReader(0, busy_timeout, retries)
+    connection_handler = reader.connect(database_path)
+
+    if connection_handler is None:
+        raise RuntimeError(f"The database {database_path} cannot be opened")
+
+    try:
+        with reader.snapshot(connection_handler):
+            partial = aggregate_rows(connection_handler, start, end, step, sensors, table_name, device_id, by_device)
+
+            if database.check_if_datatable_exists(connection_handler, f"{table_name}_chunks"):
+                compressed = chunks.retrieve_chunks(connection_handler, start, end, table_name, device_id)
+
+                for key, values in aggregate_columns(compressed, step, sensors, by_device).items():
+                    merge(partial, key, values)
+
+        return partial
+
+    finally:
+        database.disconnect(connection_handler)
+
+
+class QueryExecutor():
+
+    """ Runs long range aggregations in parallel. The range is split into
+        partitions aligned on the aggregation step, each partition is
+        aggregated by a worker process through its own read-only connection
+        (SQLite GROUP BY for the rows, NumPy for the compressed chunks) and
+        the partial aggregates (count, sum, min, max) are merged.
+
+        :param database_path: the database file
+        :param table_name: the data table name
+        :param workers: the number of worker processes (default: the number of CPUs)
+        :param cache: an optional cache of the aggregation results (see database.QueryCache)
+        :param reader: the snapshot reader providing the lock timeout and retries of the workers
+        :param pool: the process pool (created on first use)
+        :param connection_handler: the connection checking the database version for the
+                                   cache (opened on first use)
+    """
+
+    # Number of partitions per worker, for load balancing
+    partitions_per_worker = 4
+
+    def __init__(self, database_path, table_name="data", workers=None, cache=None, reader=None):
+
+        """ Initializes the executor
+
+            :param database_path: the database file
+            :param table_name: the data table name
+            :param workers: the number of worker processes (default: the number of CPUs)
+            :param cache: an optional cache of the aggregation results
+            :param reader: an optional snapshot reader (see database.SnapshotReader)
+        """
+
+        self.database_path = database_path
+        self.table_name = table_name
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache
+        self.reader = reader if reader is not None else database.SnapshotReader()
+        self.pool = None
+        self.connection_handler = None
+
+
+    def aggregate(self, start, end, step, sensors=database.SENSORS, device_id=None, by_device=False):
+
+        """ Aggregates the readings of a time range per step (and device)
+
+            :param start: the range start (see utils.get_naive_timestamp)
+            :param end: the range end (excluded)
+            :param step: the step in seconds or as a string (e.g. '1h', '1d'), at least 1s
+            :param sensors: the aggregated sensors
+            :param device_id: an optional device identifier filter
+            :param by_device: if True, the readings are grouped by device too
+            :return: dictionary with the 'timestamp' (bucket start) and 'device'
+                     arrays and the <sensor>_<aggregate> arrays (see AGGREGATES)
+                     of the non-empty buckets
+            :raises ValueError: Invalid step
+        """
+
+        step = resample.parse_step(step)
+
+        if step < 1 or step != int(step):
+            raise ValueError(f"The aggregation step must be a whole number of seconds: {step}")
+
+        if self.cache is not None:
+            if self.connection_handler is None:
+                self.connection_handler = self.reader.connect(self.database_path)
+
+            key = ('aggregate', self.table_name, start, end, step, tuple(sensors), device_id, by_device)
+            return self.cache.memoize(self.connection_handler, key, end,
+                                      lambda: self.compute(start, end, step, sensors, device_id, by_device))
+
+        return self.compute(start, end, step, sensors, device_id, by_device)
+
+
+    def compute(self, start, end, step, sensors=database.SENSORS, device_id=None, by_device=False):
+
+        """ Runs an aggregation on the worker processes (see aggregate)
+
+            :param start: the range start
+            :param end: the range end (excluded)
+            :param step: the step in whole seconds
+            :param sensors: the aggregated sensors
+            :param device_id: an optional device identifier filter
+            :param by_device: if True, the readings are grouped by device too
+            :return: the columns dictionary
+        """
+
+        partitions = split_range(start, end, step, self.workers * self.partitions_per_worker)
+        arguments = (step, tuple(sensors), self.table_name, device_id, by_device, self.reader.busy_timeout, self.reader.retries)
+
+        if self.workers > 1:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+            futures = [self.pool.submit(aggregate_partition, self.database_path, lower, upper, *arguments)
+                       for lower, upper in partitions]
+            partials = [future.result() for future in futures]
+        else:
+            partials = [aggregate_partition(self.database_path, lower, upper, *arguments) for lower, upper in partitions]
+
+        merged = {}
+        for partial in partials:
+            for key, values in partial.items():
+                merge(merged, key, values)
+
+        return self.to_columns(merged, sensors)
+
+
+    def to_columns(self, merged, sensors):
+
+        """ Converts merged aggregates into columns sorted by bucket and device
+
+            :param merged: dictionary mapping (bucket, device, sensor) keys to (count, sum, min, max)
+            :param sensors: the aggregated sensors
+            :return: the columns dictionary
+        """
+
+        groups = sorted({key[:2] for key in merged}, key=lambda group: (group[0], str(group[1])))
+        columns = {
+            "timestamp": np.array([group[0] for group in groups], dtype=float),
+            "device": np.array([group[1] for group in groups], dtype=object)
+        }
+
+        for sensor in sensors:
+            values = np.array([merged.get((*group, sensor), (0, 0.0, np.nan, np.nan)) for group in groups],
+                              dtype=float).reshape(len(groups), 4)
+
+            columns[f"{sensor}_count"] = values[:, 0].astype(np.int64)
+            columns[f"{sensor}_sum"] = values[:, 1]
+            columns[f"{sensor}_min"] = values[:, 2]
+            columns[f"{sensor}_max"] = values[:, 3]
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                columns[f"{sensor}_mean"] = values[:, 1] / values[:, 0]
+
+        return columns
+
+
+    def close(self):
+
+        """ Stops the worker processes """
+
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+        database.disconnect(self.connection_handler)
+        self.connection_handler = None
@@ -0,0 +1,495 @@
+
+# Import standard packages
+from multiprocessing import shared_memory, resource_tracker
+
+import json
+import math
+import os
+import sqlite3
+import struct
+import zlib
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.latest')
+
+# Shared memory layout: a header (sequence number, capacity, owner process
+# identifier) followed by the slots of an open addressing hash table of the devices
+HEADER = struct.Struct('<QII')
+MAX_DEVICE_ID_BYTES = 32
+SLOT = struct.Struct(f'<{MAX_DEVICE_ID_BYTES}s20s4x6d')
+
+# Columns of the latest values table (in the slot order)
+LATEST_COLUMNS = ('device_id', 'timestamp', 't0_value', 't1_value', 'th_value', 'ir_value', 'ls_value', 'bz_value')
+
+
+def get_slot(device, capacity):
+
+    """ Returns the first slot of a device in the hash table
+
+        :param device: the device identifier
+        :param capacity: the number of slots
+        :return: the slot index
+    """
+
+    return zlib.crc32(device.encode('utf-8')) % capacity
+
+
+def to_latest_row(tlm):
+
+    """ Converts a telemetry record into a latest values row
+
+        :param tlm: the telemetry record
+        :return: the row tuple (LATEST_COLUMNS values, None for missing readings)
+    """
+
+    values = [None if value == 'NULL' else value for value in (tlm.t0, tlm.t1, tlm.th, tlm.ir, tlm.ls, tlm.bz)]
+    return (str(tlm.id), tlm.timestamp, *values)
+
+
+def is_running(pid):
+
+    """ Checks whether a process is running
+
+        :param pid: the process identifier
+        :return: True if the process exists
+    """
+
+    if pid <= 0:
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def create_latesttable(connection_handler, table_name="data"):
+
+    """ Creates the latest values table of a data table (<table>_latest)
+
+        :param connection_handler: the Connection object
+        :param table_name: the data table name
+        :return: 0 if success, -1 if the connection handler is None and -2 if exception arises
+    """
+
+    try:
+        if connection_handler is None:
+            return -1
+
+        connection_handler.cursor().execute(f"""CREATE TABLE IF NOT EXISTS {table_name}_latest (
+                                                    device_id TEXT PRIMARY KEY,
+                                                    timestamp DATETIME,
+                                                    t0_value FLOAT DEFAULT NULL,
+                                                    t1_value FLOAT DEFAULT NULL,
+                                                    th_value FLOAT DEFAULT NULL,
+                                                    ir_value FLOAT DEFAULT NULL,
+                                                    ls_value FLOAT DEFAULT NULL,
+                                                    bz_value INTEGER DEFAULT NULL
+                                                )""")
+        return 0
+
+    except Exception as e:
+        logger.error(f"Exception: {str(e)}")
+        return -2
+
+
+def retrieve_latest(connection_handler, table_name="data", device_id=None):
+
+    """ Query the latest values table
+
+        :param connection_handler: the Connection object
+        :param table_name: the data table name
+        :param device_id: an optional device identifier
+        :return: list of rows (LATEST_COLUMNS values) or None if exception arises
+    """
+
+    try:
+        sql = f"SELECT {', '.join(LATEST_COLUMNS)} FROM {table_name}_latest"
+        params = []
+
+        if device_id is not None:
+            sql = f"{sql} WHERE device_id = ?"
+            params.append(device_id)
+
+        cursor = connection_handler.cursor()
+        rows = cursor.execute(sql, params).fetchall()
+        cursor.close()
+        return rows
+
+    except sqlite3.Error as error:
+        logger.error(f"Exception: {str(error)}")
+        return None
+
+
+def get_upsert_query(table_name="data"):
+
+    """ Returns the statement saving a latest values row, unless the stored
+        row is more recent (late records)
+
+        :param table_name: the data table name
+        :return: the SQL statement
+    """
+
+    updates = ', '.join(f"{column} = excluded.{column}" for column in LATEST_COLUMNS[1:])
+
+    return f"""INSERT INTO {table_name}_latest ({', '.join(LATEST_COLUMNS)})
+               VALUES ({', '.join('?' * len(LATEST_COLUMNS))})
+               ON CONFLICT(device_id) DO UPDATE SET {updates}
+               WHERE excluded.timestamp >= {table_name}_latest.timestamp"""
+
+
+class LatestValues():
+
+    """ In-memory store of the latest record of each device, kept by the
+        Recorder. The rows are saved to the <table>_latest table in the
+        transaction of each commit (see database.insert_telemetry_data), so
+        that the store is loaded at once after a restart, and published in
+        a shared memory segment (see LatestReader) for the other processes.
+        The records without device identifier are ignored.
+
+        :param rows: dictionary mapping device identifiers to their latest row
+        :param segment: the shared memory publisher (None if disabled)
+    """
+
+    def __init__(self, segment=None):
+
+        """ Initializes the store
+
+            :param segment: the shared memory publisher (None if disabled)
+        """
+
+        self.rows = {}
+        self.segment = segment
+
+
+    def __len__(self):
+
+        """ Returns the number of devices """
+
+        return len(self.rows)
+
+
+    def get(self, device_id):
+
+        """ Returns the latest row of a device
+
+            :param device_id: the device identifier
+            :return: the row tuple (LATEST_COLUMNS values) or None
+        """
+
+        return self.rows.get(device_id)
+
+
+    def collect(self, records):
+
+        """ Selects the records of a batch newer than the stored rows. The
+            store is only updated once they are committed (see apply).
+
+            :param records: the list of telemetry records
+            :return: the list of new latest rows (one per device at most)
+        """
+
+        newest = {}
+
+        for tlm in records:
+            if tlm.id is None:
+                continue
+
+            row = to_latest_row(tlm)
+            current = newest.get(row[0]) or self.rows.get(row[0])
+
+            if current is None or row[1] >= current[1]:
+                newest[row[0]] = row
+
+        return list(newest.values())
+
+
+    def apply(self, rows):
+
+        """ Updates the store (and the shared memory) with committed rows
+
+            :param rows: the list of latest rows
+        """
+
+        for row in rows:
+            self.rows[row[0]] = row
+
+        if self.segment is not None and rows:
+            self.segment.publish(rows)
+
+
+    def render(self):
+
+        """ Renders the latest rows for the /latest metrics server path
+
+            :return: the content type and the JSON body
+        """
+
+        rows = {device: dict(zip(LATEST_COLUMNS[1:], row[1:])) for device, row in self.rows.items()}
+        return 'application/json', json.dumps(rows).encode('utf-8')
+
+
+    def load(self, connection_handler, table_name="data"):
+
+        """ Loads the latest values table (created if required)
+
+            :param connection_handler: the Connection object
+            :param table_name: the data table name
+            :return: the number of loaded devices or -1 if the table cannot be read
+        """
+
+        if create_latesttable(connection_handler, table_name) != 0:
+            return -1
+
+        rows = retrieve_latest(connection_handler, table_name)
+
+        if rows is None:
+            return -1
+
+        self.apply([tuple(row) for row in rows])
+        logger.info(f"Latest values loaded: {len(rows)} devices")
+        return len(rows)
+
+
+class LatestSegment():
+
+    """ Publishes the latest rows in a named shared memory segment: a hash
+        table of capacity slots (device identifier up to MAX_DEVICE_ID_BYTES
+        UTF-8 bytes, timestamp and readings, NaN for missing readings). The
+        devices with a longer identifier are not published, rather than
+        truncated into the slot of another device. A sequence number, odd
+        while a write is in progress, lets the readers detect torn reads and
+        retry. The header also holds the identifier of the owner process, so
+        that the segment of a running Recorder is never replaced.
+
+        :param name: the shared memory segment name
+        :param capacity: the maximum number of devices
+        :param shm: the SharedMemory object
+        :param slots: dictionary mapping device identifiers to their slot
+        :param rejected: the identifiers too long to be published (reported once)
+        :param sequence: the current sequence number
+        :param pid: the identifier of the owner process
+    """
+
+    def __init__(self, name, capacity=1024):
+
+        """ Creates the shared memory segment (a stale segment of the same
+            name, left by a process which no longer runs, is replaced)
+
+            :param name: the shared memory segment name
+            :param capacity: the maximum number of devices
+            :raises FileExistsError: the segment belongs to a running process
+        """
+
+        size = HEADER.size + capacity * SLOT.size
+
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name=name)
+            owner = HEADER.unpack_from(stale.buf, 0)[2] if stale.size >= HEADER.size else 0
+
+            if is_running(owner):
+                stale.close()
+                resource_tracker.unregister(stale._name, 'shared_memory')
+                raise FileExistsError(f"The shared memory segment {name} is used by the process {owner}")
+
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        self.name = name
+        self.capacity = capacity
+        self.slots = {}
+        self.rejected = set()
+        self.sequence = 0
+        self.pid = os.getpid()
+        self.shm.buf[:size] = bytes(size)
+        HEADER.pack_into(self.shm.buf, 0, self.sequence, capacity, self.pid)
+
+
+    def find_slot(self, device):
+
+        """ Returns the slot of a device (linear probing)
+
+            :param device: the device identifier
+            :return: the slot index or None if the table is full
+        """
+
+        slot = self.slots.get(device)
+
+        if slot is not None or len(self.slots) >= self.capacity:
+            return slot
+
+        slot = get_slot(device, self.capacity)
+        used = set(self.slots.values())
+
+        while slot in used:
+            slot = (slot + 1) % self.capacity
+
+        self.slots[device] = slot
+        return slot
+
+
+    def publish(self, rows):
+
+        """ Writes rows in their slots
+
+            :param rows: the list of latest rows
+        """
+
+        buf = self.shm.buf
+
+        self.sequence += 1
+        HEADER.pack_into(buf, 0, self.sequence, self.capacity, self.pid)
+
+        for row in rows:
+            device = row[0].encode('utf-8')
+
+            if len(device) > MAX_DEVICE_ID_BYTES:
+                if row[0] not in self.rejected and len(self.rejected) < self.capacity:
+                    self.rejected.add(row[0])
+                    logger.warning(f"Device identifier {row[0]} longer than {MAX_DEVICE_ID_BYTES} bytes, "
+                                   "not published in the latest values segment")
+                continue
+
+            slot = self.find_slot(row[0])
+
+            if slot is None:
+                logger.warning(f"Latest values segment full, device {row[0]} not published")
+                continue
+
+            readings = [math.nan if value is None else float(value) for value in row[2:]]
+            SLOT.pack_into(buf, HEADER.size + slot * SLOT.size, device, str(row[1]).encode('ascii'), *readings)
+
+        self.sequence += 1
+        HEADER.pack_into(buf, 0, self.sequence, self.capacity, self.pid)
+
+
+    def close(self):
+
+        """ Releases and removes the shared memory segment """
+
+        self.shm.close()
+        self.shm.unlink()
+
+
+class LatestReader():
+
+    """ Reads the latest values published by the Recorder from another
+        process, without database access
+
+        :param name: the shared memory segment name
+        :param shm: the SharedMemory object
+        :param capacity: the number of slots
+    """
+
+    # Number of attempts of a read overlapping a write
+    max_retries = 100
+
+    def __init__(self, name):
+
+        """ Attaches to the shared memory segment
+
+            :param name: the shared memory segment name
+            :raises FileNotFoundError: the segment does not exist (Recorder not started)
+        """
+
+        self.name = name
+        self.shm = shared_memory.SharedMemory(name=name)
+
+        # The segment belongs to the Recorder, it must not be removed when this process exits
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self.capacity = HEADER.unpack_from(self.shm.buf, 0)[1]
+
+
+    def read(self, start, count):
+
+        """ Copies consistent slots of the segment
+
+            :param start: the first slot
+            :param count: the number of slots
+            :return: the slots bytes
+            :raises RuntimeError: No consistent read
+        """
+
+        buf = self.shm.buf
+        offset = HEADER.size + start * SLOT.size
+
+        for _ in range(self.max_retries):
+            before = HEADER.unpack_from(buf, 0)[0]
+            data = bytes(buf[offset:offset + count * SLOT.size])
+
+            if before % 2 == 0 and HEADER.unpack_from(buf, 0)[0] == before:
+                return data
+
+        raise RuntimeError("The latest values segment is continuously updated")
+
+
+    def to_row(self, data, index=0):
+
+        """ Decodes a slot
+
+            :param data: the slots bytes
+            :param index: the slot index within the bytes
+            :return: the row tuple (LATEST_COLUMNS values) or None if the slot is empty
+        """
+
+        device, timestamp, *readings = SLOT.unpack_from(data, index * SLOT.size)
+
+        if not device.strip(b'\0'):
+            return None
+
+        readings = [None if math.isnan(value) else value for value in readings]
+        readings[-1] = None if readings[-1] is None else int(readings[-1])
+        return (device.rstrip(b'\0').decode('utf-8'), timestamp.rstrip(b'\0').decode('ascii'), *readings)
+
+
+    def get(self, device_id):
+
+        """ Returns the latest row of a device
+
+            :param device_id: the device identifier
+            :return: the row tuple (LATEST_COLUMNS values) or None
+        """
+
+        slot = get_slot(device_id, self.capacity)
+
+        for _ in range(self.capacity):
+            row = self.to_row(self.read(slot, 1))
+
+            if row is None:
+                return None
+            if row[0] == device_id:
+                return row
+
+            slot = (slot + 1) % self.capacity
+
+        return None
+
+
+    def get_all(self):
+
+        """ Returns the latest rows of all the devices
+
+            :return: dictionary mapping device identifiers to their row
+        """
+
+        data = self.read(0, self.capacity)
+        rows = [self.to_row(data, index) for index in range(self.capacity)]
+
+        return {row[0]: row for row in rows if row is not None}
+
+
+    def close(self):
+
+        """ Detaches from the shared memory segment """
+
+        self.shm.close()
@@ -1,26 +1,155 @@
 import sys
+import time
 import logging
+import multiprocessing
 from logging import handlers
 
 
+# Logging queues and listeners of the main process (by label)
+_queues = {}
+_listeners = {}
+
+
 # Create and return a logging object
 def get_logger(label):
 
-    """This function creates and returns a logging object
+    """This function creates and returns a logging object. The records are
+       handed over to a queue and written to the console and the log file
+       by a listener thread, so that formatting and I/O never block the
+       caller. The queue is shared with the worker processes.
 
         :param label: The label that will be added to the name of the log file
     """
 
     logger = logging.getLogger(label)
     logger.setLevel(logging.DEBUG)
-    format = logging.Formatter("%(asctime)s [%(relativeCreated)5d - %(name)-5s] [%(levelname)-6s] => %(message)s")
 
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setFormatter(format)
-    logger.addHandler(ch)
+    if label not in _listeners:
+        format = logging.Formatter("%(asctime)s [%(relativeCreated)5d - %(name)-5s] [%(levelname)-6s] => %(message)s")
+
+        ch = logging.StreamHandler(sys.stdout)
+        ch.setFormatter(format)
+
+        fh = handlers.RotatingFileHandler(f'./log_{label}.txt', maxBytes=(1048576*10), backupCount=10)
+        fh.setFormatter(format)
 
-    fh = handlers.RotatingFileHandler(f'./log_{label}.txt', maxBytes=(1048576*10), backupCount=10)
-    fh.setFormatter(format)
-    logger.addHandler(fh)
+        _queues[label] = multiprocessing.Queue(-1)
+        _listeners[label] = handlers.QueueListener(_queues[label], ch, fh, respect_handler_level=True)
+        _listeners[label].start()
+
+        logger.addHandler(handlers.QueueHandler(_queues[label]))
 
     return logger
+
+
+def get_queue(label='voltazero_monitor'):
+
+    """ Returns the logging queue of a label, to be handed over to the
+        worker processes
+
+        :param label: the logger label
+        :return: the logging queue or None if the logger is not initialized
+    """
+
+    return _queues.get(label)
+
+
+def configure_worker(log_queue, levels=None, label='voltazero_monitor'):
+
+    """ Attaches the logger of a worker process to the main process logging
+        queue. Forked workers inherit the queue handler, while spawned workers
+        start with an unconfigured logger.
+
+        :param log_queue: the main process logging queue
+        :param levels: the per-module logging levels
+        :param label: the logger label
+    """
+
+    logger = logging.getLogger(label)
+
+    if log_queue is not None and not logger.handlers:
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handlers.QueueHandler(log_queue))
+
+    set_levels(levels, label)
+
+
+def set_levels(levels, label='voltazero_monitor'):
+
+    """ Sets the logging levels per module (e.g. {"monitor": "INFO"})
+
+        :param levels: dictionary mapping module names to level names
+        :param label: the logger label
+    """
+
+    for module, level in (levels or {}).items():
+        logging.getLogger(f'{label}.{module}').setLevel(level.upper())
+
+
+def stop_listeners():
+
+    """Flushes the pending records and stops the listener threads"""
+
+    for label in list(_listeners):
+        _listeners.pop(label).stop()
+
+
+class RateLimiter():
+
+    """ Token bucket used to sample high-frequency log lines (e.g. one line
+        per received message)
+
+        :param rate: the maximum number of lines per second (0 silences the
+                     lines, None disables the limit)
+        :param capacity: the maximum number of tokens (burst size)
+        :param tokens: the available tokens
+        :param suppressed: the number of lines suppressed since the last
+                           allowed line
+    """
+
+    def __init__(self, rate):
+
+        """ Initializes the rate limiter
+
+            :param rate: the maximum number of lines per second
+        """
+
+        self.rate = rate
+        self.capacity = max(rate, 1) if rate else 0
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.suppressed = 0
+
+
+    def allow(self):
+
+        """ Checks if a line can be logged now
+
+            :return: True if the line should be logged, False otherwise
+        """
+
+        if self.rate is None:
+            return True
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+
+        self.suppressed += 1
+        return False
+
+
+    def pop_suppressed(self):
+
+        """ Returns and resets the number of suppressed lines
+
+            :return: the number of suppressed lines
+        """
+
+        suppressed = self.suppressed
+        self.suppressed = 0
+        return suppressed
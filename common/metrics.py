@@ -0,0 +1,474 @@
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import gc
+import math
+import os
+import tracemalloc
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.metrics')
+
+
+# Default Prometheus buckets for latencies (seconds) and sizes (items)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# Port offsets of the per-process metrics endpoints
+PORT_OFFSETS = {"main": 0, "monitor": 1, "viewer": 2, "writer": 3}
+
+
+class Registry():
+
+    """ Holds the metrics of the current process. Updates are no-ops
+        unless the registry is enabled, so instrumentation costs a
+        single attribute lookup when metrics are not scraped
+
+        :param metrics: the registered metrics, by name
+        :param enabled: a flag indicating if the metrics are collected
+        :param component: the component label added to every sample
+        :param collectors: the functions updating gauges before each rendering
+    """
+
+    def __init__(self):
+
+        """Initializes the registry"""
+
+        self.metrics = {}
+        self.enabled = False
+        self.component = "main"
+        self.collectors = []
+
+
+    def register(self, metric):
+
+        """ Registers a metric, or returns the already registered metric
+            with the same name
+
+            :param metric: the metric object
+            :return: the registered metric
+        """
+
+        if metric.name not in self.metrics:
+            self.metrics[metric.name] = metric
+        return self.metrics[metric.name]
+
+
+    def reset(self):
+
+        """Resets the value of every registered metric"""
+
+        for metric in self.metrics.values():
+            metric.reset()
+
+
+    def render(self):
+
+        """ Renders all the metrics in the Prometheus text exposition format
+
+            :return: the exposition text
+        """
+
+        for collect in self.collectors:
+            collect()
+
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render(self.component))
+        return "\n".join(lines) + "\n"
+
+
+class Counter():
+
+    """ A monotonically increasing counter
+
+        :param name: the metric name
+        :param help: the metric description
+        :param registry: the owning registry
+        :param value: the current value
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, registry):
+
+        """ Initializes the counter
+
+            :param name: the metric name
+            :param help: the metric description
+            :param registry: the owning registry
+        """
+
+        self.name = name
+        self.help = help
+        self.registry = registry
+        self.value = 0
+
+
+    def inc(self, amount=1):
+
+        """ Increments the counter
+
+            :param amount: the increment
+        """
+
+        if self.registry.enabled:
+            self.value += amount
+
+
+    def reset(self):
+
+        """Resets the counter"""
+
+        self.value = 0
+
+
+    def render(self, component):
+
+        """ Renders the metric samples
+
+            :param component: the component label value
+            :return: the list of exposition lines
+        """
+
+        return [f"# HELP {self.name} {self.help}",
+                f"# TYPE {self.name} {self.kind}",
+                f'{self.name}{{component="{component}"}} {self.value}']
+
+
+class Gauge(Counter):
+
+    """A value that can go up and down"""
+
+    kind = "gauge"
+
+    def set(self, value):
+
+        """ Sets the gauge value
+
+            :param value: the new value
+        """
+
+        if self.registry.enabled:
+            self.value = value
+
+
+    def dec(self, amount=1):
+
+        """ Decrements the gauge
+
+            :param amount: the decrement
+        """
+
+        if self.registry.enabled:
+            self.value -= amount
+
+
+class Histogram():
+
+    """ An HDR-style histogram: values are counted in log-linear bins
+        (each power of two is split into sub_buckets linear bins), which
+        bounds the relative error of the reported percentiles whatever the
+        magnitude of the values
+
+        :param name: the metric name
+        :param help: the metric description
+        :param registry: the owning registry
+        :param buckets: the cumulative buckets exposed to Prometheus
+        :param lowest: the lowest discernible value
+        :param sub_buckets: the number of linear bins per power of two
+        :param counts: the number of values per bin index
+        :param count: the number of recorded values
+        :param sum: the sum of the recorded values
+        :param max: the maximum recorded value
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, registry, buckets=LATENCY_BUCKETS, lowest=1e-6, sub_buckets=64):
+
+        """ Initializes the histogram
+
+            :param name: the metric name
+            :param help: the metric description
+            :param registry: the owning registry
+            :param buckets: the cumulative buckets exposed to Prometheus
+            :param lowest: the lowest discernible value
+            :param sub_buckets: the number of linear bins per power of two
+        """
+
+        self.name = name
+        self.help = help
+        self.registry = registry
+        self.buckets = buckets
+        self.lowest = lowest
+        self.sub_buckets = sub_buckets
+        self.reset()
+
+
+    def reset(self):
+
+        """Resets the histogram"""
+
+        self.counts = {}
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+
+    def observe(self, value):
+
+        """ Records a value
+
+            :param value: the value to record
+        """
+
+        if not self.registry.enabled:
+            return
+
+        if value <= self.lowest:
+            index = 0
+        else:
+            mantissa, exponent = math.frexp(value / self.lowest)
+            index = exponent * self.sub_buckets + int((mantissa - 0.5) * 2 * self.sub_buckets)
+
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+
+    def upper_bound(self, index):
+
+        """ Returns the upper bound of a bin
+
+            :param index: the bin index
+            :return: the bin upper bound
+        """
+
+        if index == 0:
+            return self.lowest
+
+        exponent, sub_index = divmod(index, self.sub_buckets)
+        return self.lowest * 2 ** (exponent - 1) * (1 + (sub_index + 1) / self.sub_buckets)
+
+
+    def percentile(self, p):
+
+        """ Returns an estimate of the given percentile
+
+            :param p: the percentile (between 0 and 100)
+            :return: the percentile value or None if no value was recorded
+        """
+
+        if self.count == 0:
+            return None
+
+        rank = max(1, math.ceil(p * self.count / 100))
+        seen = 0
+
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.upper_bound(index), self.max)
+
+        return self.max
+
+
+    def render(self, component):
+
+        """ Renders the metric samples
+
+            :param component: the component label value
+            :return: the list of exposition lines
+        """
+
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.kind}"]
+
+        # A bin is counted in a bucket when its upper bound is within the bucket, so
+        # that a bucket never counts values above its bound (cumulative 'le' semantics)
+        bins = sorted((min(self.upper_bound(index), self.max), n) for index, n in list(self.counts.items()))
+        cumulative = 0
+        position = 0
+
+        for le in self.buckets:
+            while position < len(bins) and bins[position][0] <= le:
+                cumulative += bins[position][1]
+                position += 1
+            lines.append(f'{self.name}_bucket{{component="{component}",le="{le}"}} {cumulative}')
+
+        lines.append(f'{self.name}_bucket{{component="{component}",le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum{{component="{component}"}} {self.sum}')
+        lines.append(f'{self.name}_count{{component="{component}"}} {self.count}')
+
+        return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    """Serves the registry content on the /metrics path and the extra ROUTES"""
+
+    def do_GET(self):
+
+        """Handles the scrape requests"""
+
+        path = self.path.split('?')[0]
+
+        if path == '/metrics':
+            content_type, body = 'text/plain; version=0.0.4; charset=utf-8', REGISTRY.render().encode('utf-8')
+        elif path in ROUTES:
+            content_type, body = ROUTES[path]()
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+
+        """Silences the per-request access logs"""
+
+        pass
+
+
+# The metrics registry of the current process
+REGISTRY = Registry()
+
+# Extra paths of the metrics server, mapped to functions returning the
+# content type and the body of the response
+ROUTES = {}
+
+
+def counter(name, help):
+
+    """ Creates (or returns) a counter of the process registry
+
+        :param name: the metric name
+        :param help: the metric description
+        :return: the counter
+    """
+
+    return REGISTRY.register(Counter(name, help, REGISTRY))
+
+
+def gauge(name, help):
+
+    """ Creates (or returns) a gauge of the process registry
+
+        :param name: the metric name
+        :param help: the metric description
+        :return: the gauge
+    """
+
+    return REGISTRY.register(Gauge(name, help, REGISTRY))
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, lowest=1e-6):
+
+    """ Creates (or returns) a histogram of the process registry
+
+        :param name: the metric name
+        :param help: the metric description
+        :param buckets: the cumulative buckets exposed to Prometheus
+        :param lowest: the lowest discernible value
+        :return: the histogram
+    """
+
+    return REGISTRY.register(Histogram(name, help, REGISTRY, buckets=buckets, lowest=lowest))
+
+
+def get_rss():
+
+    """ Returns the resident set size of the current process (Linux)
+
+        :return: the size in bytes or None if not available
+    """
+
+    try:
+        with open('/proc/self/statm', 'r') as fid:
+            return int(fid.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def collect_process():
+
+    """ Updates the memory gauges of the process (on scrape only, counting
+        the objects takes a few milliseconds)
+    """
+
+    rss = get_rss()
+    if rss is not None:
+        PROCESS_RSS.set(rss)
+
+    GC_OBJECTS.set(len(gc.get_objects()))
+
+    if tracemalloc.is_tracing():
+        TRACED_MEMORY.set(tracemalloc.get_traced_memory()[0])
+
+
+# Memory metrics of every process
+PROCESS_RSS = gauge('voltazero_process_rss_bytes', 'Resident set size of the process')
+GC_OBJECTS = gauge('voltazero_gc_objects', 'Number of objects tracked by the garbage collector')
+TRACED_MEMORY = gauge('voltazero_traced_memory_bytes', 'Memory allocated since the start of a memory profile (tracemalloc)')
+REGISTRY.collectors.append(collect_process)
+
+
+def add_route(path, handler):
+
+    """ Serves an extra path on the metrics server of the current process
+
+        :param path: the path (e.g. '/latest')
+        :param handler: the function returning the content type and the body bytes
+    """
+
+    ROUTES[path] = handler
+
+
+def start_server(port, component, host='127.0.0.1'):
+
+    """ Enables metrics collection in the current process and exposes them
+        on http://host:(port + component offset)/metrics. Each process
+        (main, monitor, viewer) has its own endpoint.
+
+        :param port: the base metrics port (0 disables the metrics)
+        :param component: the component name
+        :param host: the listening address
+        :return: the HTTP server or None if metrics are disabled or
+                 an exception arises
+    """
+
+    # Values inherited from the parent process are not relevant
+    REGISTRY.reset()
+    REGISTRY.component = component
+    REGISTRY.enabled = False
+
+    if not port:
+        return None
+
+    try:
+        server = ThreadingHTTPServer((host, port + PORT_OFFSETS.get(component, 0)), MetricsHandler)
+        server.daemon_threads = True
+
+        thread = Thread(target=server.serve_forever, name=f'metrics-{component}', daemon=True)
+        thread.start()
+
+        REGISTRY.enabled = True
+        logger.info(f'Metrics of {component} exposed on http://{host}:{server.server_address[1]}/metrics')
+        return server
+
+    except Exception as e:
+        logger.error(f'Exception: {str(e)}')
+        return None
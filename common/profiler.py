@@ -0,0 +1,401 @@
+
+from common import metrics
+
+from threading import Thread, Event, get_ident
+from datetime import datetime
+
+import cProfile
+import os
+import signal
+import sys
+import time
+import tracemalloc
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.profiler')
+
+# Startup metrics
+STARTUP_SECONDS = metrics.gauge('voltazero_startup_seconds', 'Duration of the process startup, from its creation to its main loop')
+
+
+class StackSampler(Thread):
+
+    """ Sampling profiler: periodically records the call stack of a thread
+        and counts the identical stacks (collapsed stacks format, which can
+        be rendered as a flame graph)
+
+        :param thread_id: the identifier of the sampled thread
+        :param interval: the sampling interval in seconds
+        :param counts: the number of samples per collapsed stack
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+
+        """ Initializes the sampler
+
+            :param thread_id: the identifier of the sampled thread
+            :param interval: the sampling interval in seconds
+        """
+
+        Thread.__init__(self, name='profiler-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self.stopped = Event()
+
+
+    def run(self):
+
+        """Samples the thread stack until stopped"""
+
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+
+            if stack:
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+
+    def stop(self):
+
+        """Stops the sampler"""
+
+        self.stopped.set()
+        self.join()
+
+
+    def dump_stats(self, filename):
+
+        """ Writes the collapsed stacks to a file
+
+            :param filename: the output file
+        """
+
+        with open(filename, 'w') as fid:
+            for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+                fid.write(f"{stack} {count}\n")
+
+
+class MemoryTracer():
+
+    """ Memory profiler: traces the allocations of the process with
+        tracemalloc, then reports the allocation sites which grew the most
+        over the profile duration (leak candidates) and the largest ones
+
+        :param frames: the number of frames stored per allocation
+        :param top: the number of reported allocation sites
+        :param owner: a flag indicating if the tracer started tracemalloc
+        :param first: the snapshot at the start of the profile
+        :param last: the snapshot at the end of the profile
+    """
+
+    # Allocations of the profiling machinery itself
+    filters = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+               tracemalloc.Filter(False, "<unknown>"))
+
+    def __init__(self, frames=10, top=50):
+
+        """ Initializes the tracer
+
+            :param frames: the number of frames stored per allocation
+            :param top: the number of reported allocation sites
+        """
+
+        self.frames = frames
+        self.top = top
+        self.owner = False
+        self.first = None
+        self.last = None
+
+
+    def start(self):
+
+        """Starts tracing the allocations and takes the first snapshot"""
+
+        self.owner = not tracemalloc.is_tracing()
+
+        if self.owner:
+            tracemalloc.start(self.frames)
+
+        self.first = tracemalloc.take_snapshot().filter_traces(self.filters)
+
+
+    def stop(self):
+
+        """Takes the last snapshot and stops tracing"""
+
+        self.last = tracemalloc.take_snapshot().filter_traces(self.filters)
+
+        if self.owner:
+            tracemalloc.stop()
+
+
+    def dump_stats(self, filename):
+
+        """ Writes the allocation growth and the largest allocation sites to a file
+
+            :param filename: the output file
+        """
+
+        growth = self.last.compare_to(self.first, 'lineno')
+        largest = self.last.statistics('lineno')
+
+        with open(filename, 'w') as fid:
+            fid.write(f"Traced memory: {sum(stat.size for stat in largest) / 1024:.1f} KiB "
+                      f"in {sum(stat.count for stat in largest)} blocks\n\n")
+
+            fid.write(f"Top {self.top} allocation growths over the profile:\n")
+            for stat in growth[:self.top]:
+                fid.write(f"{stat}\n")
+
+            fid.write(f"\nTop {self.top} allocation sites:\n")
+            for stat in largest[:self.top]:
+                fid.write(f"{stat}\n")
+
+            # The full traceback of the site which grew the most
+            if growth and growth[0].size_diff > 0:
+                fid.write("\nTraceback of the largest growth:\n")
+                for trace in self.last.filter_traces((tracemalloc.Filter(True, growth[0].traceback[0].filename,
+                                                                         growth[0].traceback[0].lineno),)).statistics('traceback')[:1]:
+                    fid.write("\n".join(trace.traceback.format()) + "\n")
+
+
+class Profiler():
+
+    """ Runtime-toggleable profiler of a component loop. A profile is
+        requested by creating the control file profile_<component>.request
+        in the profile directory (its optional content is the duration in
+        seconds followed by the mode, 'cprofile', 'sample' or 'memory'), or by sending
+        SIGUSR1 to the process. The profile is written to disk with the
+        component name and the PID, then the profiler turns itself off.
+
+        :param component: the profiled component name
+        :param profile_dir: the directory of the control files and profiles
+        :param duration: the default profile duration in seconds
+        :param check_interval: the minimum interval between two control file checks
+        :param active: the running profiler (cProfile or sampler) or None
+    """
+
+    def __init__(self, component, profile_dir='.', duration=30, check_interval=1.0):
+
+        """ Initializes the profiler
+
+            :param component: the profiled component name
+            :param profile_dir: the directory of the control files and profiles
+            :param duration: the default profile duration in seconds
+            :param check_interval: the minimum interval between two control file checks
+        """
+
+        self.component = component
+        self.profile_dir = profile_dir
+        self.duration = duration
+        self.check_interval = check_interval
+        self.control_file = os.path.join(profile_dir, f'profile_{component}.request')
+        self.active = None
+        self.mode = None
+        self.deadline = 0
+        self.next_check = 0
+        self.signaled = False
+
+
+    def install_signal_handler(self):
+
+        """ Requests a profile of the component when the process receives
+            SIGUSR1 (must be called from the main thread of the process)
+
+            :return: 0 if success or -1 if signals are not supported
+        """
+
+        try:
+            signal.signal(signal.SIGUSR1, self.on_signal)
+            return 0
+
+        except (AttributeError, ValueError) as e:
+            logger.error(f"Exception: {str(e)}")
+            return -1
+
+
+    def on_signal(self, signum, frame):
+
+        """ The SIGUSR1 handler only flags the request, the profile is
+            started by the next poll of the component loop
+        """
+
+        self.signaled = True
+
+
+    def poll(self):
+
+        """ Starts or stops the profile if required. This method is called
+            at each iteration of the component loop, from the profiled thread.
+        """
+
+        now = time.monotonic()
+
+        if self.active is not None:
+            if now >= self.deadline:
+                self.stop()
+            return
+
+        if self.signaled:
+            self.signaled = False
+            self.start(self.duration, 'cprofile')
+            return
+
+        if now < self.next_check:
+            return
+
+        self.next_check = now + self.check_interval
+
+        if os.path.exists(self.control_file):
+            duration, mode = self.read_request()
+            self.start(duration, mode)
+
+
+    def read_request(self):
+
+        """ Reads and removes the control file
+
+            :return: the requested duration and mode
+        """
+
+        duration = self.duration
+        mode = 'cprofile'
+
+        try:
+            with open(self.control_file, 'r') as fid:
+                fields = fid.read().split()
+
+            os.remove(self.control_file)
+
+            if len(fields) > 0:
+                duration = float(fields[0])
+            if len(fields) > 1 and fields[1] in ('cprofile', 'sample', 'memory'):
+                mode = fields[1]
+
+        except Exception as e:
+            logger.error(f"Exception: {str(e)}")
+
+        return duration, mode
+
+
+    def start(self, duration, mode='cprofile'):
+
+        """ Starts profiling the calling thread
+
+            :param duration: the profile duration in seconds
+            :param mode: 'cprofile' (deterministic), 'sample' (statistical) or
+                         'memory' (allocations of the whole process)
+        """
+
+        if mode == 'sample':
+            self.active = StackSampler(get_ident())
+            self.active.start()
+        elif mode == 'memory':
+            self.active = MemoryTracer()
+            self.active.start()
+        else:
+            self.active = cProfile.Profile()
+            self.active.enable()
+
+        self.mode = mode
+        self.deadline = time.monotonic() + duration
+        logger.info(f'Profiling {self.component} (PID {os.getpid()}) for {duration}s ({mode})')
+
+
+    def stop(self):
+
+        """ Stops the running profile and writes it to disk
+
+            :return: the profile filename or None if an exception arises
+        """
+
+        profile = self.active
+        self.active = None
+
+        try:
+            if self.mode == 'sample':
+                profile.stop()
+                extension = 'folded'
+            elif self.mode == 'memory':
+                profile.stop()
+                extension = 'memory'
+            else:
+                profile.disable()
+                extension = 'prof'
+
+            os.makedirs(self.profile_dir, exist_ok=True)
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            filename = os.path.join(self.profile_dir, f'profile_{self.component}_{os.getpid()}_{timestamp}.{extension}')
+            profile.dump_stats(filename)
+
+            logger.info(f'Profile of {self.component} written to {filename}')
+            return filename
+
+        except Exception as e:
+            logger.error(f"Exception: {str(e)}")
+            return None
+
+
+class StartupTimer():
+
+    """ Measures the startup phases of a process (imports, logging, metrics,
+        connections...) and reports them once the process enters its loop
+
+        :param component: the component name
+        :param phases: the list of (phase, duration in seconds) tuples
+        :param last: the end of the last measured phase
+    """
+
+    def __init__(self, component, created=None, phase='spawn'):
+
+        """ Initializes the timer
+
+            :param component: the component name
+            :param created: the wall clock time of the process creation (None
+                            to start measuring now)
+            :param phase: the name of the phase between the creation and now
+        """
+
+        self.component = component
+        self.phases = []
+        self.last = time.perf_counter()
+
+        if created is not None:
+            self.phases.append((phase, max(time.time() - created, 0)))
+
+
+    def mark(self, phase):
+
+        """ Ends a startup phase
+
+            :param phase: the phase name
+        """
+
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+
+    def report(self):
+
+        """ Logs the startup report and exposes its total duration
+
+            :return: the startup duration in seconds
+        """
+
+        total = sum(duration for _, duration in self.phases)
+        STARTUP_SECONDS.set(total)
+
+        details = ", ".join(f"{phase} {duration * 1000:.1f} ms" for phase, duration in self.phases)
+        logger.info(f"Startup of {self.component}: {total * 1000:.1f} ms ({details})")
+
+        return total
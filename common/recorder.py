@@ -1,14 +1,29 @@
 
-from common import database
+from common import database, metrics, profiler, adaptive, dedup, latest, reduction, utils
+from core import telemetry
 
 from threading import Thread, Event, currentThread
+from datetime import datetime
 
+import json
+import os
+import queue
 import time
 import logging
 
 
 # Initialize logger for the module
-logger = logging.getLogger('voltazero_monitor')
+logger = logging.getLogger('voltazero_monitor.recorder')
+
+# Recording metrics
+QUEUE_DEPTH = metrics.gauge('voltazero_queue_depth', 'Number of telemetry records waiting in the queue')
+QUEUE_AGE = metrics.gauge('voltazero_queue_age_seconds', 'Time spent in the queue by the oldest record of the last batch')
+BATCH_SIZE = metrics.histogram('voltazero_batch_size', 'Number of records per inserted batch (after the deduplication and the ingest mode reduction)', buckets=metrics.SIZE_BUCKETS, lowest=1)
+BATCH_FETCHED = metrics.histogram('voltazero_batch_fetched', 'Number of records fetched from the queue per batch', buckets=metrics.SIZE_BUCKETS, lowest=1)
+COMMIT_SECONDS = metrics.histogram('voltazero_commit_seconds', 'Time spent inserting and committing a batch')
+RECORDS_COMMITTED = metrics.counter('voltazero_records_committed_total', 'Number of committed telemetry records')
+RECORDS_DROPPED = metrics.counter('voltazero_records_dropped_total', 'Number of telemetry records lost on insertion failures')
+RECORDS_CHECKPOINTED = metrics.counter('voltazero_records_checkpointed_total', 'Number of telemetry records saved to the checkpoint file')
 
 
 class Recorder(Thread):
@@ -17,26 +32,72 @@ class Recorder(Thread):
         at regular time intervals
 
         :param running: an event controlling the process operation
+        :param stopped: an event set when the recorder is asked to stop
+        :param producers_done: an event set once no more records will be queued
         :param appconfig: the application configuration object
         :param q: the telemetry data queue
         :param id: the recorder thread identifier
         :param enabled: a flag indicating if the monitor is enabled
+        :param pending: the records dequeued but not committed yet
+        :param failures: the number of consecutive insertion failures
+        :param deadline: the time limit of the shutdown drain
+        :param on_commit: an optional callback invoked with the list of
+                          telemetry records once they are committed
+        :param profiler: the runtime-toggleable profiler of the recorder loop
+        :param controller: the adaptive batch size and interval controller (None if disabled)
+        :param dedup: the index of the recently recorded readings (None if disabled)
+        :param reducer: the deadband filter or summary aggregator of the ingest mode (None in raw mode)
+        :param fetched: the number of records fetched from the queue by the last batch
+        :param commit_seconds: the commit duration of the last batch
+        :param queue_age: the queue time of the oldest record of the last batch
+        :param last_compaction: the time of the last storage compaction
+        :param latest: the latest record of each device
+        :param commit_log: the commit log shared with the readers (None if disabled)
+        :param acks: the queue of the acknowledgement tokens sent back to the Monitor once
+                     their records are committed or checkpointed (None if disabled)
+        :param unacked: the acknowledgement tokens of the fetched records not stored yet
     """
 
-    def __init__(self, q, appconfig):
+    # Number of insertion attempts before the pending records are checkpointed
+    max_failures = 3
+
+    # Interval in seconds between two storage compactions
+    compaction_interval = 3600
+
+    def __init__(self, q, appconfig, commit_log=None, acks=None):
 
         """ Initializes the recorder object
 
         :param q: the telemetry data queue
         :param appconfig: the application configuration object
+        :param commit_log: the commit log shared with the readers (see database.CommitLog)
+        :param acks: the queue of the acknowledgement tokens (see Monitor.poll_acks)
         """
 
         Thread.__init__(self)
         self.running = Event()
+        self.stopped = Event()
+        self.producers_done = Event()
         self.id = currentThread().getName()
         self.q = q
         self.appconfig = appconfig
         self.enabled = False
+        self.pending = []
+        self.failures = 0
+        self.deadline = None
+        self.on_commit = None
+        self.profiler = profiler.Profiler('recorder', appconfig.profile_dir, appconfig.profile_duration)
+        self.controller = adaptive.BatchController(appconfig) if appconfig.recorder_adaptive else None
+        self.dedup = dedup.DedupIndex(appconfig.dedup_capacity) if appconfig.dedup_capacity > 0 else None
+        self.reducer = reduction.create_reducer(appconfig)
+        self.fetched = 0
+        self.commit_seconds = 0
+        self.queue_age = None
+        self.last_compaction = None
+        self.latest = latest.LatestValues()
+        self.commit_log = commit_log
+        self.acks = acks
+        self.unacked = []
 
 
     def init_connection(self):
@@ -45,15 +106,22 @@ class Recorder(Thread):
 
         try:
             # Attempt to connect to database (create database if does not already exist)
-            self.connection_handler = database.connect(db_filename=self.appconfig.database_filename)
+            self.connection_handler = database.connect(db_filename=self.appconfig.database_filename,
+                                                       timeout=self.appconfig.database_busy_timeout)
 
             # If no connection handler, then give up
             if self.connection_handler is None:
                 return -1
             else:
+                # The readers do not block the commits in WAL mode
+                if self.appconfig.database_wal:
+                    database.enable_wal(self.connection_handler)
+
                 # Create the datatable if it does not already exist
                 if not database.check_if_datatable_exists(connection_handler=self.connection_handler, table_name=self.appconfig.table_name):
                     database.create_datatable(connection_handler=self.connection_handler, table_name=self.appconfig.table_name)
+                else:
+                    database.upgrade_datatable(connection_handler=self.connection_handler, table_name=self.appconfig.table_name)
 
             return 0
 
@@ -62,6 +130,41 @@ class Recorder(Thread):
             return -2
 
 
+    def init_latest(self):
+
+        """ Loads the latest values saved by the previous run and publishes
+            them in shared memory (latest_shared_memory) and on the /latest
+            path of the metrics server
+        """
+
+        if self.appconfig.latest_shared_memory:
+            try:
+                self.latest.segment = latest.LatestSegment(self.appconfig.latest_shared_memory,
+                                                           self.appconfig.latest_capacity)
+            except Exception as e:
+                logger.error(f"The latest values cannot be shared: {str(e)}")
+
+        self.latest.load(self.connection_handler, self.appconfig.table_name)
+        metrics.add_route('/latest', self.latest.render)
+
+
+    def apply_config(self, changes):
+
+        """ Applies reloaded configuration parameters (the batch size and
+            intervals are used from the next iteration of the loop)
+
+            :param changes: dictionary mapping parameter names to their new values
+            :return: 0 if success
+        """
+
+        self.appconfig.update(changes)
+
+        if "profile_duration" in changes:
+            self.profiler.duration = self.appconfig.profile_duration
+
+        return 0
+
+
     def start(self):
 
         """Starts the recorder thread"""
@@ -79,45 +182,223 @@ class Recorder(Thread):
         rcode = self.init_connection()
 
         if rcode == 0:
+            self.init_latest()
+
+            # Resume the records saved by the previous shutdown
+            self.restore_checkpoint()
+
             # insert data in database
             while (self.running.isSet()):
-                self.insert_batch(self.appconfig.recorder_batch_size)
-                time.sleep(self.appconfig.recorder_interval)
+                batch_size = self.appconfig.recorder_batch_size
+                interval = self.appconfig.recorder_interval
+
+                if self.controller is not None:
+                    batch_size = self.controller.batch_size
+                    interval = self.controller.interval
+
+                if self.appconfig.recorder_commit_window > 0:
+                    # Group commit: every record received during the commit
+                    # window (from all producers) goes in one transaction
+                    data = self.insert_batch(batch_size, timeout=1.0,
+                                             window=self.appconfig.recorder_commit_window)
+                else:
+                    data = self.insert_batch(batch_size)
+
+                # The controller follows the arrivals: the fetched records, not the stored ones
+                if self.controller is not None:
+                    self.controller.update(self.fetched, self.commit_seconds, self.queue_age, self.q.qsize())
+
+                if self.appconfig.recorder_commit_window <= 0:
+                    self.stopped.wait(interval)
+
+                self.compact()
+                self.profiler.poll()
 
             # Store the remaning telemetry records in queue before
             # closing connection
-            if(self.enabled and not self.q.empty()):
-                self.insert_batch(1000)
+            if(self.enabled):
+                self.drain()
 
             # close data connection
             database.disconnect(self.connection_handler)
             self.enabled = False
+
+            if self.latest.segment is not None:
+                self.latest.segment.close()
         else:
             logger.error("Failed to initialize database connection")
 
 
-    def insert_batch(self, size):
+    def compact(self):
+
+        """ Moves the closed chunk spans older than storage_compress_after
+            into compressed chunks, at most once per compaction_interval
+
+            :return: the number of compacted records, -1 if the compaction fails
+        """
+
+        if self.appconfig.storage_compress_after <= 0:
+            return 0
+
+        now = time.monotonic()
+        if self.last_compaction is not None and now - self.last_compaction < self.compaction_interval:
+            return 0
 
-        """ Checks if it is possible to establish a connection to the database
+        self.last_compaction = now
+
+        # NumPy is only loaded when the compressed storage is enabled
+        from common import chunks
+
+        span = self.appconfig.storage_chunk_span
+        before = (utils.get_naive_timestamp() - self.appconfig.storage_compress_after) // span * span
+
+        count = chunks.compact(self.connection_handler, before, self.appconfig.table_name, span)
+
+        # The compacted records are no longer in the data table
+        if count > 0:
+            self.publish_commit(None)
+
+        return count
+
+
+    def publish_commit(self, records):
+
+        """ Publishes a commit to the readers (see database.CommitLog)
+
+            :param records: the committed telemetry records (None if any time
+                            range may have changed)
+        """
+
+        if self.commit_log is None:
+            return
+
+        low = 0
+
+        try:
+            # The timestamps are formatted so that the string order is the time order
+            oldest = min(tlm.timestamp for tlm in records or [])
+            low = utils.get_naive_timestamp(datetime.strptime(oldest, utils.TIMESTAMP_FORMAT))
+        except (TypeError, ValueError):
+            pass
+
+        self.commit_log.publish(low)
+
+
+    def fetch(self, size, timeout=0, window=0):
+
+        """ Gets up to size records from the queue. Producers may queue single
+            telemetry records or lists of records (batches)
+
+        :param size: maximum number of records
+        :param timeout: time to wait for the first record (0: do not wait)
+        :param window: time to keep collecting records after the first one
+                       (0: only take the records already queued)
+        :return: list of telemetry records
+        """
+
+        records = []
+        window_end = None
+
+        try:
+            while len(records) < size:
+                if records == [] and timeout > 0:
+                    item = self.q.get(timeout=timeout)
+                    window_end = time.monotonic() + window
+                elif window > 0:
+                    if window_end is None:
+                        window_end = time.monotonic() + window
+                    remaining = window_end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    item = self.q.get(timeout=remaining)
+                else:
+                    item = self.q.get_nowait()
+
+                if isinstance(item, list):
+                    records.extend(item)
+                else:
+                    records.append(item)
+
+        except queue.Empty:
+            pass
+
+        return records
+
+
+    def insert_batch(self, size, timeout=0, window=0):
+
+        """ Gets a batch of records from the queue and saves it in the database,
+            along with the records of previously failed attempts
 
         :param size: maximum number of items to save in the database at once
+        :param timeout: time to wait for the first record (0: do not wait)
+        :param window: time to keep collecting records after the first one
         :return: list of telemetry records to insert in the database
                  if success or None if failure or an exception arises
         """
 
         try:
-            i = 0
-            data = []
-            while(i < size and not self.q.empty()):
-                tlm = self.q.get()
-                arr = (tlm.t0, tlm.t1, tlm.th, tlm.ir, tlm.ls, tlm.bz, tlm.timestamp)
-                data.append(arr)
-                i = i + 1
+            self.fetched = 0
+            records = self.fetch(size, timeout, window)
+            self.fetched = len(records)
+            self.track(records)
+
+            if records:
+                BATCH_FETCHED.observe(len(records))
+
+            # Drop the duplicates of the records queued by all the producers
+            if self.dedup is not None:
+                records = self.dedup.filter(records)
+
+            # The latest values are taken from all the readings, before the ingest mode reduction
+            latest_rows = self.latest.collect(self.pending + records)
+
+            if self.reducer is not None:
+                records = self.reducer.filter(records) + self.reducer.flush(utils.get_naive_timestamp())
+
+            records = self.pending + records
+            self.pending = []
+            data = [tlm.as_row() for tlm in records]
+
+            self.commit_seconds = 0
+            self.queue_age = None
 
             if data != []:
-                database.insert_telemetry_data(self.connection_handler, data, table_name=self.appconfig.table_name)
+                if records[0].received_at is not None:
+                    self.queue_age = time.time() - records[0].received_at
+                    QUEUE_AGE.set(self.queue_age)
+
+                start = time.perf_counter()
+                count = database.insert_telemetry_data(self.connection_handler, data, table_name=self.appconfig.table_name,
+                                                       latest_rows=latest_rows)
+                self.commit_seconds = time.perf_counter() - start
+                COMMIT_SECONDS.observe(self.commit_seconds)
+                BATCH_SIZE.observe(len(data))
+
+                if count == -1:
+                    self.on_failure(records)
+                else:
+                    self.failures = 0
+                    RECORDS_COMMITTED.inc(len(data))
+                    self.latest.apply(latest_rows)
+                    self.publish_commit(records)
+                    self.acknowledge()
+
+                    # Notify the listener (e.g. load harness) of the committed records
+                    if self.on_commit is not None:
+                        self.on_commit(records)
+
+            else:
+                # All the readings were duplicates or reduced: nothing is left to store
+                self.acknowledge()
+
+                # The latest values are published (and saved by a later commit)
+                if latest_rows:
+                    self.latest.apply(latest_rows)
 
-            logger.debug(f'Current queue size: {self.q.qsize()}')
+            qsize = self.q.qsize()
+            QUEUE_DEPTH.set(qsize)
+            logger.debug('Current queue size: %d', qsize)
             return data
 
         except Exception as inst:
@@ -125,8 +406,161 @@ class Recorder(Thread):
             return []
 
 
-    def stop(self):
+    def track(self, records):
+
+        """ Keeps the acknowledgement tokens of fetched records until they are stored
+
+        :param records: the list of telemetry records
+        """
+
+        if self.acks is not None:
+            self.unacked.extend(tlm.ack for tlm in records if tlm.ack is not None)
+
+
+    def acknowledge(self):
+
+        """ Sends the tokens of the stored records back to the Monitor. The
+            records fetched so far are either committed, checkpointed, or
+            not stored on purpose (duplicates, deadband and summary ingest
+            modes). A failed insertion keeps the tokens until the records
+            are committed or checkpointed, so that the broker redelivers
+            them after a crash.
+        """
+
+        if self.acks is not None and self.unacked != []:
+            self.acks.put(self.unacked)
+            self.unacked = []
+
+
+    def on_failure(self, records):
+
+        """ Keeps the records of a failed insertion for the next attempt.
+            After max_failures consecutive failures, the records are moved
+            to the checkpoint file so that the recorder can move on.
+
+        :param records: the list of telemetry records
+        """
+
+        self.failures += 1
+
+        if self.failures < self.max_failures:
+            self.pending = records
+        else:
+            self.failures = 0
+            self.checkpoint(records)
+
+
+    def drain(self):
+
+        """ Inserts the queued records until the queue is empty and the producers
+            are stopped, or until the shutdown deadline. The records that could
+            not be committed in time are saved to the checkpoint file.
+        """
+
+        size = max(self.appconfig.recorder_batch_size, 1000)
+
+        while self.deadline is None or time.monotonic() < self.deadline:
+            data = self.insert_batch(size, timeout=0.1)
+
+            # The fetched records may all be duplicates or reduced
+            if self.fetched == 0 and self.pending == [] and self.producers_done.is_set():
+                break
+
+        # The open summaries are stored with the last batch
+        if self.reducer is not None:
+            self.pending.extend(self.reducer.flush())
+
+            if self.pending != [] and (self.deadline is None or time.monotonic() < self.deadline):
+                self.insert_batch(size)
+
+        fetched = self.fetch(float('inf'))
+        self.track(fetched)
+        remaining = self.pending + fetched
+        self.pending = []
+
+        if remaining != []:
+            logger.warning(f'Shutdown deadline reached with {len(remaining)} uncommitted records')
+            self.checkpoint(remaining)
+
+
+    def checkpoint(self, records):
+
+        """ Appends records to the checkpoint file
+
+        :param records: the list of telemetry records
+        :return: 0 if success or -1 if an exception arises
+        """
+
+        try:
+            with open(self.appconfig.checkpoint_file, 'a') as fid:
+                for tlm in records:
+                    # The acknowledgement tokens are only valid for the current connection to the broker
+                    fid.write(json.dumps({key: value for key, value in vars(tlm).items() if key != 'ack'}) + "\n")
+                fid.flush()
+                os.fsync(fid.fileno())
+
+            RECORDS_CHECKPOINTED.inc(len(records))
+            self.acknowledge()
+            logger.info(f'{len(records)} records saved to {self.appconfig.checkpoint_file}')
+            return 0
+
+        except Exception as e:
+            RECORDS_DROPPED.inc(len(records))
+            logger.error(f"Exception: {str(e)}")
+            return -1
+
+
+    def restore_checkpoint(self):
+
+        """ Inserts the records of the checkpoint file, then removes the file
+
+        :return: the number of restored records or -1 if an exception arises
+        """
+
+        try:
+            if not os.path.exists(self.appconfig.checkpoint_file):
+                return 0
+
+            with open(self.appconfig.checkpoint_file, 'r') as fid:
+                records = [telemetry.Telemetry(**json.loads(line)) for line in fid if line.strip()]
+
+            data = [tlm.as_row() for tlm in records]
+            latest_rows = self.latest.collect(records)
+
+            if data != []:
+                count = database.insert_telemetry_data(self.connection_handler, data, table_name=self.appconfig.table_name,
+                                                       latest_rows=latest_rows)
+                if count == -1:
+                    return -1
+
+                self.latest.apply(latest_rows)
+                self.publish_commit(records)
+
+            os.remove(self.appconfig.checkpoint_file)
+            logger.info(f'{len(records)} records restored from {self.appconfig.checkpoint_file}')
+            return len(records)
+
+        except Exception as e:
+            logger.error(f"Exception: {str(e)}")
+            return -1
+
+
+    def stop(self, timeout=None, wait_producers=False):
+
+        """ Stops the recorder thread. The queue is drained before the thread exits.
+
+        :param timeout: the maximum drain duration in seconds
+                        (default: the shutdown_timeout parameter)
+        :param wait_producers: if True, the drain goes on until producers_done is set
+        """
+
+        if timeout is None:
+            timeout = self.appconfig.shutdown_timeout
+
+        self.deadline = time.monotonic() + timeout
 
-        """Stops the recorder thread"""
+        if not wait_producers:
+            self.producers_done.set()
 
         self.running.clear()
+        self.stopped.set()
@@ -0,0 +1,290 @@
+
+# Import custom subpackages
+from common import utils, metrics
+from core import telemetry
+
+# Import standard packages
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.reduction')
+
+# Ingest modes: every reading, readings beyond a per-sensor tolerance, or periodic means
+INGEST_MODES = ('raw', 'deadband', 'summary')
+
+# Readings of the record (in the data table order), bz is an event and is never approximated
+READINGS = ('t0', 't1', 'th', 'ir', 'ls', 'bz')
+
+# Reduction metrics
+RECORDS_REDUCED = metrics.counter('voltazero_records_reduced_total', 'Number of telemetry readings not stored as received (deadband or summary ingest mode)')
+
+
+@lru_cache(maxsize=4096)
+def to_seconds(timestamp):
+
+    """ Converts a record timestamp into a naive timestamp (the consecutive
+        records mostly share their timestamp, the conversions are cached)
+
+        :param timestamp: the record timestamp (see utils.TIMESTAMP_FORMAT)
+        :return: the naive timestamp in seconds
+    """
+
+    return utils.get_naive_timestamp(datetime.strptime(timestamp, utils.TIMESTAMP_FORMAT))
+
+
+def get_values(tlm):
+
+    """ Returns the readings of a record as floats
+
+        :param tlm: the telemetry record
+        :return: the tuple of readings (READINGS order, None for missing readings)
+    """
+
+    return tuple(None if value is None or value == 'NULL' else float(value)
+                 for value in (tlm.t0, tlm.t1, tlm.th, tlm.ir, tlm.ls, tlm.bz))
+
+
+def create_reducer(appconfig):
+
+    """ Creates the reducer of the configured ingest mode
+
+        :param appconfig: the application configuration object
+        :return: a DeadbandFilter, a SummaryAggregator or None (raw mode)
+    """
+
+    if appconfig.ingest_mode == 'deadband':
+        return DeadbandFilter(appconfig.deadband, appconfig.deadband_max_interval)
+
+    if appconfig.ingest_mode == 'summary':
+        return SummaryAggregator(appconfig.summary_interval)
+
+    return None
+
+
+class DeadbandFilter():
+
+    """ Stores a reading only when one of its values moved away from the
+        last stored reading of the device by more than the sensor tolerance.
+        Any change of bz and any reading appearing or disappearing is
+        stored, as well as one reading every max_interval seconds at least,
+        so that the stored series can be reconstructed as steps (see
+        resample.resample, fill 'step') and a silent device is not mistaken
+        for a stable one.
+
+        :param tolerances: dictionary mapping sensors to their tolerance (0 if missing)
+        :param max_interval: the maximum time in seconds between two stored readings of a device
+        :param max_devices: the maximum number of tracked devices (the least recently
+                            stored device is forgotten, its next reading is stored)
+        :param stored: dictionary mapping devices to the time and values of their last stored reading
+        :param reduced: the number of readings not stored
+    """
+
+    def __init__(self, tolerances, max_interval=300, max_devices=10000):
+
+        """ Initializes the filter
+
+            :param tolerances: dictionary mapping sensors to their tolerance
+            :param max_interval: the maximum time in seconds between two stored readings
+            :param max_devices: the maximum number of tracked devices
+        """
+
+        self.tolerances = tuple(0 if sensor == 'bz' else tolerances.get(sensor, 0) for sensor in READINGS)
+        self.max_interval = max_interval
+        self.max_devices = max_devices
+        self.stored = OrderedDict()
+        self.reduced = 0
+
+
+    def changed(self, previous, values):
+
+        """ Checks whether a reading moved away from the stored one
+
+            :param previous: the values of the stored reading
+            :param values: the values of the reading
+            :return: True if a value changed by more than its tolerance
+        """
+
+        for old, new, tolerance in zip(previous, values, self.tolerances):
+            if (old is None) != (new is None):
+                return True
+            if old is not None and abs(new - old) > tolerance:
+                return True
+
+        return False
+
+
+    def filter(self, records):
+
+        """ Selects the records to store
+
+            :param records: the list of telemetry records
+            :return: the list of records to store
+        """
+
+        kept = []
+
+        for tlm in records:
+            seconds = to_seconds(tlm.timestamp)
+            values = get_values(tlm)
+            last = self.stored.get(tlm.id)
+
+            # The late records are stored as they are
+            if last is None or seconds < last[0] or seconds - last[0] >= self.max_interval \
+                    or self.changed(last[1], values):
+                if last is None or seconds >= last[0]:
+                    self.stored[tlm.id] = (seconds, values)
+                    self.stored.move_to_end(tlm.id)
+
+                    if len(self.stored) > self.max_devices:
+                        self.stored.popitem(last=False)
+
+                kept.append(tlm)
+
+        self.reduced += len(records) - len(kept)
+        RECORDS_REDUCED.inc(len(records) - len(kept))
+        return kept
+
+
+    def flush(self, now=None):
+
+        """ Returns the records held by the filter (none)
+
+            :param now: the current naive timestamp
+            :return: an empty list
+        """
+
+        return []
+
+
+class SummaryAggregator():
+
+    """ Stores the mean of the readings of each device per interval instead
+        of every reading. The summary record is stamped with the interval
+        start and holds the bz state at that time, while every bz change is
+        stored as the received record, so that the buzzer events are kept
+        exactly. The late records of a closed interval are stored as they
+        are.
+
+        :param interval: the summary interval in seconds
+        :param buckets: dictionary mapping devices to their open interval
+                        [start, counts, sums, bz state at the start, first record]
+        :param states: dictionary mapping devices to their last bz state
+        :param max_devices: the maximum number of devices of which the bz state is kept
+        :param reduced: the decrease of the number of stored records
+    """
+
+    def __init__(self, interval=60, max_devices=10000):
+
+        """ Initializes the aggregator
+
+            :param interval: the summary interval in seconds
+            :param max_devices: the maximum number of devices of which the bz state is kept
+        """
+
+        self.interval = interval
+        self.max_devices = max_devices
+        self.buckets = {}
+        self.states = OrderedDict()
+        self.reduced = 0
+
+
+    def filter(self, records):
+
+        """ Adds records to the open intervals
+
+            :param records: the list of telemetry records
+            :return: the list of records to store (bz changes, late records and
+                     the summaries of the intervals closed by the records)
+        """
+
+        kept = []
+        absorbed = 0
+
+        for tlm in records:
+            seconds = to_seconds(tlm.timestamp)
+            start = seconds // self.interval * self.interval
+            values = get_values(tlm)
+            bucket = self.buckets.get(tlm.id)
+
+            if bucket is not None and start < bucket[0]:
+                kept.append(tlm)
+                continue
+
+            if bucket is not None and start > bucket[0]:
+                kept.append(self.close(tlm.id))
+                bucket = None
+
+            if bucket is None:
+                # The state at the interval start is the new one if it changed at that second
+                state = values[-1] if seconds == start and values[-1] is not None else self.states.get(tlm.id, values[-1])
+                bucket = [start, [0] * len(READINGS), [0.0] * len(READINGS), state, tlm]
+                self.buckets[tlm.id] = bucket
+
+            for i, value in enumerate(values):
+                if value is not None:
+                    bucket[1][i] += 1
+                    bucket[2][i] += value
+
+            if values[-1] is not None and values[-1] != self.states.get(tlm.id, values[-1]):
+                kept.append(tlm)
+            else:
+                absorbed += 1
+
+            if values[-1] is not None:
+                self.states[tlm.id] = values[-1]
+                self.states.move_to_end(tlm.id)
+
+                if len(self.states) > self.max_devices:
+                    self.states.popitem(last=False)
+
+        self.account(absorbed, len(kept) - (len(records) - absorbed))
+        return kept
+
+
+    def close(self, device):
+
+        """ Closes the open interval of a device
+
+            :param device: the device identifier
+            :return: the summary record
+        """
+
+        start, counts, sums, state, first = self.buckets.pop(device)
+        means = [sums[i] / counts[i] if counts[i] else 'NULL' for i in range(len(READINGS))]
+        means[-1] = 'NULL' if state is None else int(state)
+
+        return telemetry.Telemetry(timestamp=utils.format_naive_timestamp(start), id=device,
+                                   t0=means[0], t1=means[1], th=means[2], ir=means[3], ls=means[4], bz=means[5],
+                                   received_at=first.received_at)
+
+
+    def flush(self, now=None):
+
+        """ Closes the intervals ended before a time
+
+            :param now: the current naive timestamp (None to close all the intervals)
+            :return: the list of summary records
+        """
+
+        closed = [self.close(device) for device, bucket in list(self.buckets.items())
+                  if now is None or bucket[0] + self.interval <= now]
+
+        self.account(0, len(closed))
+        return closed
+
+
+    def account(self, absorbed, summaries):
+
+        """ Updates the reduction count
+
+            :param absorbed: the number of readings added to the intervals only
+            :param summaries: the number of summary records
+        """
+
+        self.reduced += absorbed - summaries
+        RECORDS_REDUCED.inc(absorbed)
@@ -0,0 +1,224 @@
+
+# Import custom subpackages
+from common import database, chunks
+
+# Import standard packages
+import numpy as np
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.resample')
+
+# Fill modes of the empty bins
+FILL_MODES = ('none', 'ffill', 'linear', 'step')
+
+# Step units (in seconds)
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_step(step):
+
+    """ Parses a resampling step
+
+        :param step: the step in seconds or as a string (e.g. '1s', '10s', '1m', '1h')
+        :return: the step in seconds
+        :raises ValueError: Invalid step
+    """
+
+    if isinstance(step, str):
+        step = step.strip().lower()
+        if step and step[-1] in UNITS:
+            step = float(step[:-1]) * UNITS[step[-1]]
+        else:
+            step = float(step)
+
+    if step <= 0:
+        raise ValueError(f"Invalid resampling step: {step}")
+
+    return float(step)
+
+
+def get_grid(start, end, step):
+
+    """ Returns the regular time grid of a window (the bins start times).
+        The grid is aligned on multiples of the step.
+
+        :param start: the window start timestamp
+        :param end: the window end timestamp (excluded)
+        :param step: the step in seconds
+        :return: the array of bin start timestamps
+    """
+
+    first = np.floor(start / step) * step
+    count = max(int(np.ceil((end - first) / step)), 0)
+    return first + step * np.arange(count)
+
+
+def resample(columns, step, start=None, end=None, fill='none', max_gap=None, sensors=database.SENSORS):
+
+    """ Resamples columnar telemetry (see database.retrieve_columns) on a
+        regular time grid. The value of a bin is the mean of its valid (non
+        NaN) readings. The empty bins are left as NaN ('none'), filled with
+        the last reading ('ffill') or linearly interpolated between the
+        neighbouring bins ('linear'). The 'step' mode reconstructs the held
+        values of the deadband and summary ingest modes: the value of every
+        bin is the last reading before its end. Readings farther than
+        max_gap seconds are never used to fill a bin, and values are never
+        extrapolated before the first reading.
+
+        :param columns: dictionary of arrays sorted by timestamp
+        :param step: the step in seconds or as a string (e.g. '10s')
+        :param start: the window start (default: the first timestamp)
+        :param end: the window end, excluded (default: after the last timestamp)
+        :param fill: the fill mode of the empty bins ('none', 'ffill', 'linear' or 'step')
+        :param max_gap: the maximum filled gap in seconds (None for no limit)
+        :param sensors: the resampled columns
+        :return: dictionary with the 'timestamp' grid, one array per sensor,
+                 a <sensor>_gap mask of the bins without reading and the
+                 <sensor>_count number of readings per bin
+        :raises ValueError: Invalid step or fill mode
+    """
+
+    if fill not in FILL_MODES:
+        raise ValueError(f"Invalid fill mode: {fill}")
+
+    step = parse_step(step)
+    timestamps = np.asarray(columns["timestamp"], dtype=float)
+
+    if start is None:
+        start = timestamps[0] if len(timestamps) else 0
+    if end is None:
+        end = np.nextafter(timestamps[-1], np.inf) if len(timestamps) else start
+
+    grid = get_grid(start, end, step)
+    nbins = len(grid)
+
+    # Bin index of each reading (readings outside the window are ignored)
+    index = np.floor((timestamps - grid[0]) / step).astype(np.int64) if nbins else np.zeros(0, dtype=np.int64)
+    in_window = (index >= 0) & (index < nbins) & (timestamps >= start)
+
+    result = {"timestamp": grid}
+
+    for sensor in sensors:
+        if sensor not in columns:
+            continue
+
+        values = np.asarray(columns[sensor], dtype=float)
+        valid = in_window & ~np.isnan(values)
+
+        counts = np.bincount(index[valid], minlength=nbins)
+        sums = np.bincount(index[valid], weights=values[valid], minlength=nbins)
+
+        resampled = np.full(nbins, np.nan)
+        filled = counts > 0
+        resampled[filled] = sums[filled] / counts[filled]
+
+        if fill == 'step':
+            resampled[:] = np.nan
+            fill_forward(resampled, timestamps[valid], values[valid], grid, step, max_gap)
+        elif fill == 'ffill':
+            fill_forward(resampled, timestamps[valid], values[valid], grid, step, max_gap)
+        elif fill == 'linear':
+            fill_linear(resampled, filled, grid, max_gap)
+
+        result[sensor] = resampled
+        result[f"{sensor}_gap"] = ~filled
+        result[f"{sensor}_count"] = counts
+
+    return result
+
+
+def fill_forward(resampled, timestamps, values, grid, step, max_gap=None):
+
+    """ Fills the empty bins with the last reading before the bin end (in place)
+
+        :param resampled: the array of bin values (NaN for empty bins)
+        :param timestamps: the sorted timestamps of the valid readings
+        :param values: the valid readings
+        :param grid: the bin start timestamps
+        :param step: the step in seconds
+        :param max_gap: the maximum distance in seconds between the reading and the bin end
+    """
+
+    empty = np.isnan(resampled)
+    if not empty.any() or len(timestamps) == 0:
+        return
+
+    ends = grid[empty] + step
+    position = np.searchsorted(timestamps, ends, side='left') - 1
+    usable = position >= 0
+
+    if max_gap is not None:
+        usable &= (ends - timestamps[np.maximum(position, 0)]) <= max_gap
+
+    filled = np.full(len(ends), np.nan)
+    filled[usable] = values[position[usable]]
+    resampled[empty] = filled
+
+
+def fill_linear(resampled, filled, grid, max_gap=None):
+
+    """ Interpolates the empty bins between the neighbouring non-empty bins (in place)
+
+        :param resampled: the array of bin values (NaN for empty bins)
+        :param filled: the mask of the non-empty bins
+        :param grid: the bin start timestamps
+        :param max_gap: the maximum distance in seconds between the neighbouring bins
+    """
+
+    known = grid[filled]
+    empty = ~filled
+
+    if len(known) < 2 or not empty.any():
+        return
+
+    targets = grid[empty]
+    interpolated = np.interp(targets, known, resampled[filled])
+
+    # No extrapolation outside the readings and no interpolation over long gaps
+    after = np.searchsorted(known, targets, side='right')
+    inside = (after > 0) & (after < len(known))
+
+    if max_gap is not None:
+        after = np.clip(after, 1, len(known) - 1)
+        inside &= (known[after] - known[after - 1]) <= max_gap
+
+    interpolated[~inside] = np.nan
+    resampled[empty] = interpolated
+
+
+def query(connection_handler, start, end, step, table_name="data", device_id=None,
+          fill='none', max_gap=None, calibration=None, cache=None):
+
+    """ Retrieves (including the compressed chunks) and resamples the
+        telemetry of a time window
+
+        :param connection_handler: the Connection object
+        :param start: the window start (see utils.get_naive_timestamp)
+        :param end: the window end (excluded)
+        :param step: the step in seconds or as a string (e.g. '10s')
+        :param table_name: the data table name
+        :param device_id: an optional device identifier filter
+        :param fill: the fill mode of the empty bins ('none', 'ffill', 'linear' or 'step')
+        :param max_gap: the maximum filled gap in seconds (None for no limit)
+        :param calibration: an optional Calibration applied before resampling
+        :param cache: an optional query cache of the retrieved records (see database.QueryCache)
+        :return: the resampled columns dictionary or None if the query fails
+    """
+
+    if cache is not None:
+        columns = cache.retrieve_columns(connection_handler, start, end, table_name, device_id, chunks.retrieve_columns)
+    else:
+        columns = chunks.retrieve_columns(connection_handler, start, end, table_name, device_id)
+
+    if columns is None:
+        return None
+
+    sensors = database.SENSORS
+
+    if calibration is not None:
+        calibration.apply(columns)
+        sensors = tuple(sensors) + tuple(f"{sensor}_cal" for sensor in calibration.get_sensors() if sensor in sensors)
+
+    return resample(columns, step, start, end, fill, max_gap, sensors)
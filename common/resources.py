@@ -0,0 +1,224 @@
+
+# Import standard packages
+import os
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.resources')
+
+# Components with their own resource limits (the Recorder thread belongs to
+# the main process unless it runs in the writer process)
+COMPONENTS = ('main', 'monitor', 'writer', 'viewer')
+
+
+def validate_limits(resources):
+
+    """ Checks the resource limits of the components
+
+        :param resources: dictionary mapping component names to their limits
+        :return: the list of errors (empty if the limits are valid)
+    """
+
+    if not isinstance(resources, dict):
+        return ["resources must be a dictionary"]
+
+    errors = []
+
+    for component, limits in resources.items():
+        if component not in COMPONENTS or not isinstance(limits, dict):
+            errors.append(f"resources: {component} must be one of {', '.join(COMPONENTS)} with a dictionary of limits")
+            continue
+
+        cpus = limits.get("cpus")
+        if cpus is not None and (not isinstance(cpus, list) or not cpus or
+                                 not all(isinstance(cpu, int) and cpu >= 0 for cpu in cpus)):
+            errors.append(f"resources: {component} cpus must be a non-empty list of CPU numbers")
+
+        nice = limits.get("nice")
+        if nice is not None and (not isinstance(nice, int) or not -20 <= nice <= 19):
+            errors.append(f"resources: {component} nice must be an integer between -20 and 19")
+
+        memory = limits.get("memory_mb")
+        if memory is not None and (not isinstance(memory, (int, float)) or memory <= 0):
+            errors.append(f"resources: {component} memory_mb must be a positive number")
+
+    return errors
+
+
+def get_threads(pid):
+
+    """ Returns the thread identifiers of a process (Linux). The CPU affinity
+        and the nice level are thread attributes: set through the process
+        identifier, they only apply to its main thread (and to the threads
+        it starts afterwards).
+
+        :param pid: the process identifier
+        :return: the list of thread identifiers (the process identifier only
+                 if they cannot be listed)
+    """
+
+    try:
+        return [int(tid) for tid in os.listdir(f'/proc/{pid}/task')]
+
+    except (OSError, ValueError):
+        return [pid]
+
+
+def set_thread_attribute(threads, component, attribute, apply):
+
+    """ Sets a scheduling attribute of each thread of a process
+
+        :param threads: the thread identifiers
+        :param component: the component name
+        :param attribute: the attribute name (for the logs)
+        :param apply: the function setting the attribute of a thread identifier
+        :return: 0 if success or -1 if the attribute cannot be set
+    """
+
+    for tid in threads:
+        try:
+            apply(tid)
+        except AttributeError:
+            logger.warning(f"The {attribute} of the {component} is not supported on this platform")
+            return 0
+        except ProcessLookupError:
+            # The thread exited in the meantime
+            continue
+        except OSError as e:
+            logger.error(f"The {attribute} of the {component} cannot be set: {str(e)}")
+            return -1
+
+    return 0
+
+
+def apply_limits(pid, component, limits):
+
+    """ Applies the resource limits of a component to a process: the CPU
+        affinity ('cpus', list of CPU numbers) and the nice level ('nice',
+        -20 to 19, lowering it requires privileges) of each of its running
+        threads, which the threads started afterwards inherit, and the data
+        segment size cap of the process ('memory_mb', soft limit, a process
+        allocating beyond it gets a MemoryError). The unsupported limits are
+        logged and ignored.
+
+        :param pid: the process identifier
+        :param component: the component name
+        :param limits: the limits dictionary (None or empty for no limit)
+        :return: 0 if success or -1 if a limit cannot be applied
+    """
+
+    if not limits:
+        return 0
+
+    rcode = 0
+    threads = get_threads(pid)
+
+    if limits.get("cpus") is not None:
+        rcode = min(rcode, set_thread_attribute(threads, component, "CPU affinity",
+                                                lambda tid: os.sched_setaffinity(tid, limits["cpus"])))
+
+    if limits.get("nice") is not None:
+        rcode = min(rcode, set_thread_attribute(threads, component, "nice level",
+                                                lambda tid: os.setpriority(os.PRIO_PROCESS, tid, limits["nice"])))
+
+    if limits.get("memory_mb") is not None:
+        try:
+            import resource
+
+            # Only the soft limit is set, so that it can be raised by a reload
+            hard = resource.prlimit(pid, resource.RLIMIT_DATA)[1]
+            soft = int(limits["memory_mb"] * 1024 * 1024)
+            resource.prlimit(pid, resource.RLIMIT_DATA, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+        except (ImportError, AttributeError):
+            logger.warning(f"The memory cap of the {component} is not supported on this platform")
+        except (OSError, ValueError) as e:
+            logger.error(f"The memory cap of the {component} cannot be set: {str(e)}")
+            rcode = -1
+
+    if rcode == 0:
+        logger.info(f"Resource limits of the {component} (PID {pid}, {len(threads)} threads): {limits}")
+
+    return rcode
+
+
+def get_defaults():
+
+    """ Returns the limits of the current process before any is applied (its
+        CPU affinity, nice level and data segment soft limit), inherited by
+        the processes it starts, so that the limits removed from the
+        configuration can be restored
+
+        :return: dictionary of the supported defaults ('cpus', 'nice', 'memory')
+    """
+
+    defaults = {}
+
+    try:
+        defaults["cpus"] = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        pass
+
+    try:
+        defaults["nice"] = os.getpriority(os.PRIO_PROCESS, 0)
+    except AttributeError:
+        pass
+
+    try:
+        import resource
+        defaults["memory"] = resource.getrlimit(resource.RLIMIT_DATA)[0]
+    except (ImportError, AttributeError):
+        pass
+
+    return defaults
+
+
+def reset_limits(pid, component, names, defaults):
+
+    """ Restores limits of a component removed from the configuration. A nice
+        level can only be restored without privileges when it was lowered
+        (higher priority) by the removed limit, otherwise the process keeps
+        its level until the application is restarted.
+
+        :param pid: the process identifier
+        :param component: the component name
+        :param names: the removed limit names ('cpus', 'nice', 'memory_mb')
+        :param defaults: the defaults returned by get_defaults
+        :return: 0 if success or -1 if a limit cannot be restored
+    """
+
+    rcode = 0
+    threads = get_threads(pid)
+
+    if "cpus" in names and "cpus" in defaults:
+        rcode = min(rcode, set_thread_attribute(threads, component, "CPU affinity",
+                                                lambda tid: os.sched_setaffinity(tid, defaults["cpus"])))
+
+    if "nice" in names and "nice" in defaults:
+        for tid in threads:
+            try:
+                os.setpriority(os.PRIO_PROCESS, tid, defaults["nice"])
+            except ProcessLookupError:
+                # The thread exited in the meantime
+                continue
+            except OSError as e:
+                logger.warning(f"The nice level of the {component} cannot be restored ({str(e)}), "
+                               "it is reset when the application is restarted")
+                rcode = -1
+                break
+
+    if "memory_mb" in names and "memory" in defaults:
+        try:
+            import resource
+
+            # The hard limit is never changed, the initial soft limit is within it
+            hard = resource.prlimit(pid, resource.RLIMIT_DATA)[1]
+            resource.prlimit(pid, resource.RLIMIT_DATA, (defaults["memory"], hard))
+        except (OSError, ValueError) as e:
+            logger.error(f"The memory cap of the {component} cannot be removed: {str(e)}")
+            rcode = -1
+
+    if rcode == 0:
+        logger.info(f"Resource limits of the {component} removed (PID {pid}): {', '.join(sorted(names))}")
+
+    return rcode
@@ -1,11 +1,15 @@
 from os import system, name
-from datetime import datetime
+from datetime import datetime, timedelta
 
+import signal
 import sys
 import logging
 
 # Initialize logger for the module
-logger = logging.getLogger('voltazero_monitor')
+logger = logging.getLogger('voltazero_monitor.utils')
+
+# Format of the timestamps stored in the database
+TIMESTAMP_FORMAT = '%Y/%m/%d %H:%M:%S'
 
 
 def clear_console():
@@ -67,3 +71,68 @@ def get_datetime_with_offset(date, offset=300):
 
     else:
         raise Exception("Invalid parameters.")
+
+
+def get_percentiles(values, percentiles=(50, 90, 99)):
+
+    """ Returns the requested percentiles of a list of values using
+        the nearest-rank method
+
+        :param values: the list of numeric values
+        :param percentiles: the percentiles to compute (between 0 and 100)
+        :return: dictionary mapping each percentile to its value,
+                 or None values if the list is empty
+    """
+
+    if len(values) == 0:
+        return {p: None for p in percentiles}
+
+    ordered = sorted(values)
+    n = len(ordered)
+    result = {}
+
+    for p in percentiles:
+        rank = max(1, int(-(-p * n // 100)))
+        result[p] = ordered[min(rank, n) - 1]
+
+    return result
+
+
+def set_worker_signal_handlers(stop_event):
+
+    """ Sets the signal handlers of a worker process: SIGINT is ignored since
+        the shutdown sequence is driven by the main process, and SIGTERM
+        requests a graceful stop
+
+        :param stop_event: the event stopping the worker loop
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+
+def get_naive_timestamp(date=None):
+
+    """ Returns the number of seconds elapsed between 1970/01/01 00:00:00
+        and a naive (local) datetime. This is the time scale of the
+        timestamps returned by the columnar database queries.
+
+        :param date: the datetime (default: now)
+        :return: the naive timestamp in seconds
+    """
+
+    if date is None:
+        date = datetime.now()
+
+    return (date - datetime(1970, 1, 1)).total_seconds()
+
+
+def format_naive_timestamp(timestamp):
+
+    """ Formats a naive timestamp as stored in the database
+
+        :param timestamp: the naive timestamp in seconds
+        :return: the formatted timestamp
+    """
+
+    return (datetime(1970, 1, 1) + timedelta(seconds=timestamp)).strftime(TIMESTAMP_FORMAT)
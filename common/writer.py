@@ -0,0 +1,167 @@
+
+from common import utils, recorder, metrics, profiler, logger as applog
+
+from multiprocessing import Process, Event, Value, Queue
+from threading import Thread
+
+import os
+import time
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.writer')
+
+
+class Writer(Process):
+
+    """ Dedicated database writer process. It owns the only write connection
+        and runs the Recorder loop outside of the main process, so that the
+        SQLite commits do not compete for the GIL with the other components.
+        With a commit window (recorder_commit_window), the records and batches
+        queued by all the producers during the window are committed in a
+        single transaction (group commit).
+
+        :param q: the telemetry data queue (shared by all the producers)
+        :param appconfig: the application configuration object
+        :param stop_event: an event shared with the parent process to request a stop
+        :param producers_done: an event set once no more records will be queued
+        :param drain_timeout: the maximum drain duration requested by the parent
+        :param log_queue: the main process logging queue
+        :param recorder: the Recorder running in the writer process
+        :param created: the wall clock time at which the process was started
+        :param control: the queue of the reloaded configuration parameters
+        :param commit_log: the commit log shared with the readers (None if disabled)
+        :param acks: the queue of the acknowledgement tokens of the stored records (None if disabled)
+    """
+
+    def __init__(self, q, appconfig, commit_log=None, acks=None):
+
+        """ Initializes the writer process
+
+            :param q: the telemetry data queue
+            :param appconfig: the application configuration object
+            :param commit_log: the commit log shared with the readers (see database.CommitLog)
+            :param acks: the queue of the acknowledgement tokens (see Monitor.poll_acks)
+        """
+
+        super(Writer, self).__init__()
+
+        self.q = q
+        self.appconfig = appconfig
+        self.stop_event = Event()
+        self.producers_done = Event()
+        self.drain_timeout = Value('d', appconfig.shutdown_timeout)
+        self.log_queue = applog.get_queue()
+        self.recorder = None
+        self.created = None
+        self.control = Queue()
+        self.commit_log = commit_log
+        self.acks = acks
+
+
+    def start(self):
+
+        """Starts the writer process"""
+
+        self.created = time.time()
+        super(Writer, self).start()
+
+
+    def run(self):
+
+        """ Runs the Recorder loop in the writer process
+
+            :return: 0 if success or -1 if an exception is raised
+        """
+
+        try:
+            startup = profiler.StartupTimer('writer', self.created)
+            applog.configure_worker(self.log_queue, self.appconfig.log_levels)
+
+            self.PID = os.getpid()
+            logger.info(f'Writer PID: {os.getpid()}')
+            startup.mark('logging')
+
+            metrics.start_server(self.appconfig.metrics_port, 'writer')
+            utils.set_worker_signal_handlers(self.stop_event)
+            startup.mark('metrics')
+
+            self.recorder = recorder.Recorder(self.q, self.appconfig, self.commit_log, self.acks)
+            self.recorder.producers_done = self.producers_done
+            self.recorder.profiler.install_signal_handler()
+            startup.mark('recorder')
+            startup.report()
+
+            # Forward the stop request and the reloaded parameters of the parent process to the recorder
+            Thread(target=self.wait_stop, name='writer-stop', daemon=True).start()
+            Thread(target=self.wait_control, name='writer-control', daemon=True).start()
+
+            self.recorder.running.set()
+            self.recorder.enabled = True
+            self.recorder.run()
+            return 0
+
+        except Exception as e:
+            logger.error(f"Exception: {str(e)}")
+            return -1
+
+
+    def wait_stop(self):
+
+        """Stops the recorder loop once the parent process requests it"""
+
+        self.stop_event.wait()
+        self.recorder.stop(timeout=self.drain_timeout.value, wait_producers=True)
+
+
+    def wait_control(self):
+
+        """Applies the reloaded configuration parameters sent by the parent process"""
+
+        while True:
+            changes = self.control.get()
+            applog.set_levels(changes.get("log_levels"))
+            self.recorder.apply_config(changes)
+
+
+    def apply_config(self, changes):
+
+        """ Sends reloaded configuration parameters to the writer process
+
+            :param changes: dictionary mapping parameter names to their new values
+            :return: 0 if success or -1 if an exception is raised
+        """
+
+        try:
+            self.control.put(changes)
+            return 0
+
+        except Exception as e:
+            logger.error(f"Exception: {str(e)}")
+            return -1
+
+
+    def stop(self, timeout=None, wait_producers=False):
+
+        """ Requests the writer process to stop once the queue is drained
+
+            :param timeout: the maximum drain duration in seconds
+                            (default: the shutdown_timeout parameter)
+            :param wait_producers: if True, the drain goes on until producers_done is set
+            :return: 0 if success or -1 if an exception is raised
+        """
+
+        try:
+            if timeout is not None:
+                self.drain_timeout.value = timeout
+
+            if not wait_producers:
+                self.producers_done.set()
+
+            self.stop_event.set()
+            return 0
+
+        except Exception as e:
+            logger.error(f"Exception: {str(e)}")
+            return -1
@@ -0,0 +1,503 @@
+
+# Import custom subpackages
+from common import utils, database, chunks, executor
+
+# Import standard packages
+from datetime import datetime
+
+import argparse
+import csv
+import glob
+import gzip
+import json
+import os
+import sys
+import time
+import logging
+
+import numpy as np
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.archive')
+
+# Supported file formats
+FORMATS = ('csv', 'jsonl', 'parquet', 'npz')
+
+# Sensor columns of the exported rows
+VALUE_COLUMNS = database.EXPORT_COLUMNS[2:]
+
+
+def guess_format(path):
+
+    """ Guesses the file format from a file name
+
+        :param path: the file or directory path
+        :return: the format name or None if unknown
+    """
+
+    name = path[:-3] if path.endswith('.gz') else path
+
+    for fmt in FORMATS:
+        if name.endswith(f'.{fmt}'):
+            return fmt
+
+    return 'npz' if os.path.isdir(path) else None
+
+
+def open_text(path, mode):
+
+    """ Opens a text file, gzip-compressed if its name ends with .gz
+
+        :param path: the file path
+        :param mode: 'r' or 'w'
+        :return: the file object
+    """
+
+    if path.endswith('.gz'):
+        return gzip.open(path, f'{mode}t', newline='')
+
+    return open(path, mode, newline='')
+
+
+def to_value(value, column):
+
+    """ Converts an imported field into a database value
+
+        :param value: the field (string, number or None)
+        :param column: the column name
+        :return: the database value (None for missing readings)
+    """
+
+    if value is None or value == '' or value == 'NULL':
+        return None
+
+    if column in ('timestamp', 'device_id'):
+        return str(value)
+
+    value = float(value)
+
+    if np.isnan(value):
+        return None
+
+    return int(value) if column == 'bz_value' else value
+
+
+def to_row(values):
+
+    """ Converts the imported fields of a record into a database row
+
+        :param values: the fields in EXPORT_COLUMNS order
+        :return: the row tuple
+    """
+
+    return tuple(to_value(value, column) for value, column in zip(values, database.EXPORT_COLUMNS))
+
+
+def write_csv(chunks, path):
+
+    """ Writes chunks of rows to a CSV file (empty fields for NULL)
+
+        :param chunks: an iterable of lists of rows
+        :param path: the output file (gzip-compressed if it ends with .gz)
+        :return: the number of written rows
+    """
+
+    count = 0
+
+    with open_text(path, 'w') as fid:
+        writer = csv.writer(fid)
+        writer.writerow(database.EXPORT_COLUMNS)
+
+        for rows in chunks:
+            writer.writerows(rows)
+            count += len(rows)
+
+    return count
+
+
+def read_csv(path, chunk_size=10000):
+
+    """ Reads a CSV export by chunks
+
+        :param path: the input file
+        :param chunk_size: the number of rows per chunk
+        :return: generator of lists of rows
+    """
+
+    with open_text(path, 'r') as fid:
+        reader = csv.reader(fid)
+        header = next(reader)
+        order = [header.index(column) for column in database.EXPORT_COLUMNS]
+        rows = []
+
+        for record in reader:
+            rows.append(to_row([record[i] for i in order]))
+
+            if len(rows) >= chunk_size:
+                yield rows
+                rows = []
+
+        if rows:
+            yield rows
+
+
+def write_jsonl(chunks, path):
+
+    """ Writes chunks of rows to a JSON Lines file (null for NULL)
+
+        :param chunks: an iterable of lists of rows
+        :param path: the output file (gzip-compressed if it ends with .gz)
+        :return: the number of written rows
+    """
+
+    count = 0
+
+    with open_text(path, 'w') as fid:
+        for rows in chunks:
+            fid.writelines(json.dumps(dict(zip(database.EXPORT_COLUMNS, row))) + '\n' for row in rows)
+            count += len(rows)
+
+    return count
+
+
+def read_jsonl(path, chunk_size=10000):
+
+    """ Reads a JSON Lines export by chunks
+
+        :param path: the input file
+        :param chunk_size: the number of rows per chunk
+        :return: generator of lists of rows
+    """
+
+    with open_text(path, 'r') as fid:
+        rows = []
+
+        for line in fid:
+            if not line.strip():
+                continue
+
+            record = json.loads(line)
+            rows.append(to_row([record.get(column) for column in database.EXPORT_COLUMNS]))
+
+            if len(rows) >= chunk_size:
+                yield rows
+                rows = []
+
+        if rows:
+            yield rows
+
+
+def get_arrow():
+
+    """ Imports pyarrow, which is only required by the Parquet format
+
+        :return: the pyarrow and pyarrow.parquet modules
+        :raises RuntimeError: pyarrow is not installed
+    """
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        return pyarrow, pyarrow.parquet
+
+    except ImportError:
+        raise RuntimeError("The Parquet format requires the pyarrow package (pip install pyarrow)")
+
+
+def write_parquet(chunks, path):
+
+    """ Writes chunks of rows to a Parquet file (one row group per chunk)
+
+        :param chunks: an iterable of lists of rows
+        :param path: the output file
+        :return: the number of written rows
+    """
+
+    pa, pq = get_arrow()
+
+    schema = pa.schema([("timestamp", pa.string()), ("device_id", pa.string())] +
+                       [(column, pa.int64() if column == 'bz_value' else pa.float64()) for column in VALUE_COLUMNS])
+    count = 0
+
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for rows in chunks:
+            fields = list(zip(*rows))
+            arrays = [pa.array(values, type=field.type) for values, field in zip(fields, schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            count += len(rows)
+
+    return count
+
+
+def read_parquet(path, chunk_size=10000):
+
+    """ Reads a Parquet export by chunks
+
+        :param path: the input file
+        :param chunk_size: the number of rows per chunk
+        :return: generator of lists of rows
+    """
+
+    pa, pq = get_arrow()
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=list(database.EXPORT_COLUMNS)):
+        fields = [batch.column(column).to_pylist() for column in database.EXPORT_COLUMNS]
+        yield [to_row(values) for values in zip(*fields)]
+
+
+def write_npz(chunks, path):
+
+    """ Writes chunks of rows as compressed NumPy files (chunk_<n>.npz) in
+        a directory. Timestamps and device identifiers are stored as
+        strings (empty for NULL) and readings as floats (NaN for NULL).
+
+        :param chunks: an iterable of lists of rows
+        :param path: the output directory
+        :return: the number of written rows
+    """
+
+    os.makedirs(path, exist_ok=True)
+    count = 0
+
+    for index, rows in enumerate(chunks):
+        fields = list(zip(*rows))
+        arrays = {
+            "timestamp": np.array(fields[0], dtype=str),
+            "device_id": np.array(['' if value is None else value for value in fields[1]], dtype=str)
+        }
+
+        for column, values in zip(VALUE_COLUMNS, fields[2:]):
+            arrays[column] = np.array(values, dtype=float)
+
+        np.savez_compressed(os.path.join(path, f'chunk_{index:06d}.npz'), **arrays)
+        count += len(rows)
+
+    return count
+
+
+def read_npz(path, chunk_size=None):
+
+    """ Reads the compressed NumPy chunks of a directory (one list of rows per file)
+
+        :param path: the input directory (or a single .npz file)
+        :param chunk_size: unused, the chunks of the export are kept
+        :return: generator of lists of rows
+    """
+
+    files = sorted(glob.glob(os.path.join(path, 'chunk_*.npz'))) if os.path.isdir(path) else [path]
+
+    for filename in files:
+        with np.load(filename) as data:
+            fields = [data[column].tolist() for column in database.EXPORT_COLUMNS]
+        yield [to_row(values) for values in zip(*fields)]
+
+
+WRITERS = {"csv": write_csv, "jsonl": write_jsonl, "parquet": write_parquet, "npz": write_npz}
+READERS = {"csv": read_csv, "jsonl": read_jsonl, "parquet": read_parquet, "npz": read_npz}
+
+
+def export_data(connection_handler, path, fmt=None, start=None, end=None, table_name="data", device_id=None, chunk_size=10000):
+
+    """ Streams the records of a time range (and device) to a file,
+        including the compressed chunks, from one read snapshot (a
+        concurrent compaction neither hides nor duplicates records)
+
+        :param connection_handler: the Connection object
+        :param path: the output file or directory
+        :param fmt: the format (default: guessed from the path)
+        :param start: the range start (see utils.get_naive_timestamp)
+        :param end: the range end (excluded)
+        :param table_name: the data table name
+        :param device_id: an optional device identifier filter
+        :param chunk_size: the number of rows fetched at once
+        :return: the number of exported rows
+        :raises ValueError: Unknown format
+    """
+
+    fmt = fmt or guess_format(path)
+
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    with database.SnapshotReader().snapshot(connection_handler):
+        rows = chunks.iterate_rows(connection_handler, start, end, table_name, device_id, chunk_size)
+        return WRITERS[fmt](rows, path)
+
+
+def import_data(connection_handler, path, fmt=None, table_name="data", chunk_size=10000):
+
+    """ Bulk imports an export file into a data table (created if required)
+
+        :param connection_handler: the Connection object
+        :param path: the input file or directory
+        :param fmt: the format (default: guessed from the path)
+        :param table_name: the data table name
+        :param chunk_size: the number of rows inserted at once
+        :return: the number of imported rows or -1 if the insert fails
+        :raises ValueError: Unknown format
+    """
+
+    fmt = fmt or guess_format(path)
+
+    if fmt not in READERS:
+        raise ValueError(f"Unknown import format: {fmt}")
+
+    if not database.check_if_datatable_exists(connection_handler, table_name):
+        database.create_datatable(connection_handler, table_name)
+    else:
+        database.upgrade_datatable(connection_handler, table_name)
+
+    return database.bulk_insert(connection_handler, READERS[fmt](path, chunk_size), table_name)
+
+
+def write_aggregates(columns, sensors, path):
+
+    """ Writes aggregated columns (see executor.QueryExecutor) to a CSV file
+
+        :param columns: the aggregated columns
+        :param sensors: the aggregated sensors
+        :param path: the output file ('-' for the standard output)
+        :return: the number of written buckets
+    """
+
+    names = [f"{sensor}_{aggregate}" for sensor in sensors for aggregate in executor.AGGREGATES]
+    fid = sys.stdout if path == '-' else open_text(path, 'w')
+
+    try:
+        writer = csv.writer(fid)
+        writer.writerow(['timestamp', 'device_id'] + names)
+
+        for i, timestamp in enumerate(columns["timestamp"].tolist()):
+            writer.writerow([utils.format_naive_timestamp(timestamp), columns["device"][i]] +
+                            [columns[name][i] for name in names])
+
+    finally:
+        if fid is not sys.stdout:
+            fid.close()
+
+    return len(columns["timestamp"])
+
+
+def parse_date(text):
+
+    """ Parses a command line date ('2020/05/01 10:00:00', ISO format or a
+        number of seconds before now)
+
+        :param text: the date argument
+        :return: the naive timestamp or None
+    """
+
+    if text is None:
+        return None
+
+    try:
+        return utils.get_naive_timestamp() - float(text)
+    except ValueError:
+        return utils.get_naive_timestamp(datetime.fromisoformat(text.replace('/', '-')))
+
+
+def main(argv=None):
+
+    """ Runs the export and import tools from the command line
+
+        :param argv: the command line arguments
+        :return: 0 if success, -1 otherwise
+    """
+
+    parser = argparse.ArgumentParser(description='VoltaZero Monitor data export, import and compression')
+    parser.add_argument('--database', default='voltazero_database.db', help='database file')
+    parser.add_argument('--table', default='data', help='data table name')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    # Options shared by the commands
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--format', choices=FORMATS, default=None, help='file format (default: from the file name)')
+    common.add_argument('--chunk-size', dest='chunk_size', type=int, default=10000, help='rows per chunk')
+
+    export_parser = commands.add_parser('export', parents=[common], help='export a time range to a file')
+    export_parser.add_argument('output', help='output file (.csv, .jsonl, optionally .gz, .parquet) or npz directory')
+    export_parser.add_argument('--start', default=None, help="range start ('2020/05/01 10:00:00' or seconds before now)")
+    export_parser.add_argument('--end', default=None, help='range end (excluded)')
+    export_parser.add_argument('--device', default=None, help='device identifier')
+
+    import_parser = commands.add_parser('import', parents=[common], help='bulk import an export file')
+    import_parser.add_argument('input', help='input file or npz directory')
+
+    compact_parser = commands.add_parser('compact', help='move the records older than a date into compressed chunks')
+    compact_parser.add_argument('--before', required=True, help="range end ('2020/05/01 10:00:00' or seconds before now)")
+    compact_parser.add_argument('--span', type=float, default=86400, help='time span of a chunk in seconds')
+
+    commands.add_parser('report', help='report the compression ratio and decode throughput of the chunks')
+
+    aggregate_parser = commands.add_parser('aggregate', help='aggregate the readings per step with parallel workers')
+    aggregate_parser.add_argument('--start', required=True, help="range start ('2020/05/01 10:00:00' or seconds before now)")
+    aggregate_parser.add_argument('--end', default=None, help='range end, excluded (default: now)')
+    aggregate_parser.add_argument('--step', default='1d', help="aggregation step (e.g. '1h', '1d')")
+    aggregate_parser.add_argument('--sensor', action='append', default=None, choices=database.SENSORS,
+                                  help='aggregated sensor (repeatable, default: all)')
+    aggregate_parser.add_argument('--device', default=None, help='device identifier')
+    aggregate_parser.add_argument('--by-device', dest='by_device', action='store_true', help='one bucket per device')
+    aggregate_parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    aggregate_parser.add_argument('--output', default='-', help='CSV output file (default: standard output)')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    connection_handler = database.connect(args.database)
+    if connection_handler is None:
+        return -1
+
+    try:
+        start = time.perf_counter()
+
+        if args.command == 'report':
+            result = chunks.report(connection_handler, args.table)
+            print(json.dumps(result, indent=4) if result is not None else "No compressed chunk")
+            return 0
+
+        if args.command == 'export':
+            count = export_data(connection_handler, args.output, args.format, parse_date(args.start), parse_date(args.end),
+                                args.table, args.device, args.chunk_size)
+        elif args.command == 'aggregate':
+            sensors = args.sensor or database.SENSORS
+            query = executor.QueryExecutor(args.database, args.table, args.workers)
+            try:
+                end = parse_date(args.end) if args.end is not None else utils.get_naive_timestamp()
+                columns = query.aggregate(parse_date(args.start), end, args.step, sensors, args.device, args.by_device)
+            finally:
+                query.close()
+            count = write_aggregates(columns, sensors, args.output)
+        elif args.command == 'compact':
+            count = chunks.compact(connection_handler, parse_date(args.before), args.table, args.span)
+        else:
+            count = import_data(connection_handler, args.input, args.format, args.table, args.chunk_size)
+
+        elapsed = time.perf_counter() - start
+
+        # The caches of a running application do not see the changes in the commit log
+        # (a failed compaction may have committed some spans)
+        if args.command in ('compact', 'import'):
+            database.mark_external_change(connection_handler)
+
+        if count < 0:
+            return -1
+
+        if args.command == 'aggregate':
+            logger.info(f'{count} buckets aggregated in {elapsed:.2f}s')
+            return 0
+
+        logger.info(f'{count} records {args.command}ed in {elapsed:.2f}s ({count / elapsed if elapsed > 0 else 0:.0f} records/s)')
+        return 0
+
+    except (OSError, RuntimeError, ValueError) as e:
+        logger.error(f"Exception: {str(e)}")
+        return -1
+
+    finally:
+        database.disconnect(connection_handler)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,20 @@
+from common import resources, reduction
+
+from threading import Thread, Event
+
 import json
 import os
 import logging
 
 
 # Initialize logger for the module
-logger = logging.getLogger('voltazero_monitor')
+logger = logging.getLogger('voltazero_monitor.config')
+
+# Parameters applied to the running components without restart (see ConfigWatcher)
+TUNABLES = ("topic", "recorder_batch_size", "recorder_interval", "recorder_commit_window",
+            "recorder_max_latency", "recorder_min_batch_size", "recorder_max_batch_size", "recorder_min_interval",
+            "device_timestamps", "device_time_max_skew", "viewer_interval", "viewer_max_fps", "time_window",
+            "log_levels", "log_sample_rate", "profile_duration", "resources")
 
 
 class AppConfig():
@@ -18,16 +28,80 @@ class AppConfig():
         :param secret: the password used to connect to the MQTT server
         :param mac_address: the Helium device MAC address (might be used in
                             connection string)
-        :param topic: MQTT topic
+        :param topic: MQTT topic (or list of topics)
+        :param mqtt_qos: the QoS level of the subscription
+        :param mqtt_clean_session: if False, the broker keeps the session (subscription
+                                   and unacknowledged messages) across reconnections
+        :param device_timestamps: if True, the timestamp sent by a device ('ts') is used
+                                  instead of the reception time
+        :param device_time_max_skew: the maximum advance in seconds of a device timestamp
+                                     over the reception time
+        :param dedup_capacity: the number of recent readings per device kept by the
+                               duplicate filter (0 disables the filter)
+        :param queue_max_size: the maximum number of items of the telemetry queue (0 for no limit)
+        :param ingest_mode: the stored readings: 'raw' (all), 'deadband' (changes beyond
+                            the sensor tolerances) or 'summary' (means per interval)
+        :param deadband: the tolerance of each sensor in the deadband mode
+        :param deadband_max_interval: the maximum time in seconds between two stored
+                                      readings of a device in the deadband mode
+        :param summary_interval: the summary interval in seconds
+        :param storage_compress_after: the age in seconds after which the records
+                                       are moved into compressed chunks (0 disables it)
+        :param storage_chunk_span: the time span in seconds of a compressed chunk
+        :param latest_shared_memory: the name of the shared memory segment publishing
+                                     the latest record of each device (null disables it).
+                                     Device identifiers are limited to 32 UTF-8 bytes there
+        :param latest_capacity: the maximum number of devices of the shared memory segment
+        :param viewer_max_fps: the maximum number of viewer draws per second (0 for no limit)
+        :param resources: the CPU affinity, nice level and memory cap of each component
+                          (main, monitor, writer, viewer)
+        :param reconnect_min_delay: the initial reconnection backoff cap in seconds
+        :param reconnect_max_delay: the maximum reconnection backoff cap in seconds
         :param database_filename: the SQlite database filename
         :param table_name: the data table name where the telemetry data is stored
+        :param database_wal: if True, the database uses the write-ahead log journal mode
+                             (the readers do not block the Recorder commits)
+        :param database_busy_timeout: the maximum time in seconds a connection waits for a lock
+        :param database_read_retries: the number of attempts of a read snapshot refused by a lock
+        :param database_max_readers: the maximum number of concurrent read snapshots (0 for no limit)
         :param time_window: the time interval for telemetry display
         :param recorder_batch_size: the maximum number of telemetry records
                                     saved at once (used by the Recorder)
         :param recorder_interval: the recorder time interval
+        :param recorder_process: if True, the Recorder runs in a dedicated writer process
+        :param recorder_commit_window: the group commit window in seconds (0 disables
+                                       the group commit and uses recorder_interval)
+        :param recorder_adaptive: if True, the batch size and flush interval are tuned
+                                  from the arrival rate, queue age and commit latency
+        :param recorder_max_latency: the target maximum time in seconds between the
+                                     reception and the commit of a record (adaptive mode)
+        :param recorder_min_batch_size: the minimum batch size (adaptive mode)
+        :param recorder_max_batch_size: the maximum batch size (adaptive mode)
+        :param recorder_min_interval: the minimum flush interval in seconds (adaptive
+                                      mode, the maximum is recorder_interval)
         :param viewer_interval: the viewer plot update interval
                                 (used by the Viewer)
         :param no_viewer: if a flag indicating whether the viewer should start
+        :param viewer_max_records: the maximum number of records cached by the viewer
+        :param viewer_resample_step: the viewer resampling step (e.g. '10s', 0 plots the raw readings)
+        :param viewer_resample_fill: the fill mode of the empty bins ('none', 'ffill', 'linear' or 'step')
+        :param viewer_resample_max_gap: the maximum filled gap in seconds (None for no limit)
+        :param viewer_panels: the viewer windows, each with its own title, time_window,
+                              sensors and resample_* properties (all the panels share
+                              the same cached data)
+        :param metrics_port: the base port of the Prometheus metrics endpoints
+                             (0 disables the metrics)
+        :param log_levels: the logging levels per module (e.g. {"monitor": "INFO"})
+        :param log_sample_rate: the maximum number of per-message log lines per second
+        :param profile_dir: the directory of the profiling control files and profiles
+        :param profile_duration: the default profile duration in seconds
+        :param shutdown_timeout: the maximum duration of the shutdown sequence in seconds
+        :param checkpoint_file: the file where the records that could not be
+                                committed are saved (restored at the next start)
+        :param config_reload_interval: the interval in seconds between two checks of
+                                       the configuration file (0 disables the reload)
+        :param calibration: the sensor calibration models per device identifier
+                            (or "default"), see common.calibration
     """
 
     def __init__(self, config_filename):
@@ -44,13 +118,56 @@ class AppConfig():
         self.secret = None
         self.mac_address = None
         self.topic = None
+        self.mqtt_qos = None
+        self.mqtt_clean_session = None
+        self.device_timestamps = None
+        self.device_time_max_skew = None
+        self.dedup_capacity = None
+        self.queue_max_size = None
+        self.ingest_mode = None
+        self.deadband = None
+        self.deadband_max_interval = None
+        self.summary_interval = None
+        self.storage_compress_after = None
+        self.storage_chunk_span = None
+        self.latest_shared_memory = None
+        self.latest_capacity = None
+        self.viewer_max_fps = None
+        self.resources = None
+        self.reconnect_min_delay = None
+        self.reconnect_max_delay = None
         self.database_filename = None
         self.table_name = None
+        self.database_wal = None
+        self.database_busy_timeout = None
+        self.database_read_retries = None
+        self.database_max_readers = None
         self.time_window = None
         self.recorder_batch_size = None
         self.recorder_interval = None
+        self.recorder_process = None
+        self.recorder_commit_window = None
+        self.recorder_adaptive = None
+        self.recorder_max_latency = None
+        self.recorder_min_batch_size = None
+        self.recorder_max_batch_size = None
+        self.recorder_min_interval = None
         self.viewer_interval = None
         self.no_viewer = None
+        self.viewer_max_records = None
+        self.viewer_resample_step = None
+        self.viewer_resample_fill = None
+        self.viewer_resample_max_gap = None
+        self.viewer_panels = None
+        self.metrics_port = None
+        self.log_levels = None
+        self.log_sample_rate = None
+        self.profile_dir = None
+        self.profile_duration = None
+        self.shutdown_timeout = None
+        self.checkpoint_file = None
+        self.config_reload_interval = None
+        self.calibration = None
 
 
     def load_app_config(self):
@@ -92,22 +209,247 @@ class AppConfig():
             self.secret = data["secret"]
             self.mac_address = data["mac_address"]
             self.topic = data["topic"]
+            self.mqtt_qos = data.get("mqtt_qos", 1)
+            self.mqtt_clean_session = data.get("mqtt_clean_session", False)
+            self.device_timestamps = data.get("device_timestamps", True)
+            self.device_time_max_skew = data.get("device_time_max_skew", 300)
+            self.dedup_capacity = data.get("dedup_capacity", 1024)
+            self.queue_max_size = data.get("queue_max_size", 100000)
+            self.ingest_mode = data.get("ingest_mode", "raw")
+            self.deadband = data.get("deadband", {})
+            self.deadband_max_interval = data.get("deadband_max_interval", 300)
+            self.summary_interval = data.get("summary_interval", 60)
+            self.storage_compress_after = data.get("storage_compress_after", 0)
+            self.storage_chunk_span = data.get("storage_chunk_span", 86400)
+            self.latest_shared_memory = data.get("latest_shared_memory", "voltazero_latest")
+            self.latest_capacity = data.get("latest_capacity", 1024)
+            self.viewer_max_fps = data.get("viewer_max_fps", 0)
+            self.resources = data.get("resources", {})
+            self.reconnect_min_delay = data.get("reconnect_min_delay", 1)
+            self.reconnect_max_delay = data.get("reconnect_max_delay", 60)
 
             # Database parameters
             self.database_filename = data["database"]
             self.table_name = data["table_name"]
+            self.database_wal = data.get("database_wal", True)
+            self.database_busy_timeout = data.get("database_busy_timeout", 5)
+            self.database_read_retries = data.get("database_read_retries", 3)
+            self.database_max_readers = data.get("database_max_readers", 4)
 
             # Recorder parameters
             self.recorder_batch_size = data["recorder_batch_size"]
             self.recorder_interval = data["recorder_interval"]
+            self.recorder_process = data.get("recorder_process", True)
+            self.recorder_commit_window = data.get("recorder_commit_window", 0)
+            self.recorder_adaptive = data.get("recorder_adaptive", False)
+            self.recorder_max_latency = data.get("recorder_max_latency", 5)
+            self.recorder_min_batch_size = data.get("recorder_min_batch_size", 10)
+            self.recorder_max_batch_size = data.get("recorder_max_batch_size", 5000)
+            self.recorder_min_interval = data.get("recorder_min_interval", 0.1)
+
+            self.shutdown_timeout = data.get("shutdown_timeout", 30)
+            self.checkpoint_file = data.get("checkpoint_file", "recorder_checkpoint.jsonl")
+            self.config_reload_interval = data.get("config_reload_interval", 5)
 
             # Viewer parameters
             self.viewer_interval = data["viewer_interval"]
             self.time_window = data["time_window"]
             self.no_viewer = data["no_viewer"]
+            self.viewer_max_records = data.get("viewer_max_records", 1000000)
+            self.viewer_resample_step = data.get("viewer_resample_step", 0)
+            self.viewer_resample_fill = data.get("viewer_resample_fill", "none")
+            self.viewer_resample_max_gap = data.get("viewer_resample_max_gap", None)
+            self.viewer_panels = data.get("viewer_panels", [])
+
+            # Calibration parameters
+            self.calibration = data.get("calibration", {})
+
+            # Metrics parameters
+            self.metrics_port = data.get("metrics_port", 0)
+
+            # Logging parameters
+            self.log_levels = data.get("log_levels", {})
+            self.log_sample_rate = data.get("log_sample_rate", 10)
+
+            # Profiling parameters
+            self.profile_dir = data.get("profile_dir", ".")
+            self.profile_duration = data.get("profile_duration", 30)
 
             return 0
 
         except Exception as e:
             logger.error(f'Exception: {str(e)}')
             return -1
+
+
+    def validate(self):
+
+        """ Checks the values of the parameters which can be reloaded. The
+            device identifiers are not configured but received: the ones
+            longer than 32 UTF-8 bytes (latest.MAX_DEVICE_ID_BYTES) are stored
+            but not published in the latest_shared_memory segment.
+
+            :return: the list of errors (empty if the configuration is valid)
+        """
+
+        errors = []
+
+        def is_number(value, minimum, strict=False):
+            return isinstance(value, (int, float)) and not isinstance(value, bool) and \
+                (value > minimum if strict else value >= minimum)
+
+        topics = self.topic if isinstance(self.topic, list) else [self.topic]
+        if not topics or not all(isinstance(topic, str) and topic for topic in topics):
+            errors.append("topic must be a non-empty string or list of strings")
+
+        if not isinstance(self.recorder_batch_size, int) or self.recorder_batch_size < 1:
+            errors.append("recorder_batch_size must be a positive integer")
+
+        for key in ("recorder_min_batch_size", "recorder_max_batch_size"):
+            if not isinstance(getattr(self, key), int) or getattr(self, key) < 1:
+                errors.append(f"{key} must be a positive integer")
+
+        for key in ("recorder_interval", "recorder_max_latency", "recorder_min_interval", "viewer_interval", "time_window",
+                    "deadband_max_interval", "summary_interval"):
+            if not is_number(getattr(self, key), 0, strict=True):
+                errors.append(f"{key} must be a positive number")
+
+        for key in ("recorder_commit_window", "profile_duration", "viewer_max_fps"):
+            if not is_number(getattr(self, key), 0):
+                errors.append(f"{key} must be a number greater or equal to 0")
+
+        if self.log_sample_rate is not None and not is_number(self.log_sample_rate, 0):
+            errors.append("log_sample_rate must be a number greater or equal to 0 or null")
+
+        if not isinstance(self.log_levels, dict):
+            errors.append("log_levels must be a dictionary")
+
+        if self.ingest_mode not in reduction.INGEST_MODES:
+            errors.append(f"ingest_mode must be one of {', '.join(reduction.INGEST_MODES)}")
+
+        if not isinstance(self.deadband, dict) or \
+                not all(sensor in reduction.READINGS and is_number(value, 0) for sensor, value in self.deadband.items()):
+            errors.append("deadband must be a dictionary mapping sensors to tolerances greater or equal to 0")
+
+        errors.extend(resources.validate_limits(self.resources))
+
+        return errors
+
+
+    def update(self, changes):
+
+        """ Applies reloaded parameters
+
+            :param changes: dictionary mapping parameter names to their new values
+        """
+
+        for key, value in changes.items():
+            setattr(self, key, value)
+
+
+class ConfigWatcher(Thread):
+
+    """ Watches the configuration file and applies the changes of the
+        tunable parameters (TUNABLES) without restarting the application.
+        A modified file is parsed and validated first: an invalid file is
+        ignored and the changes of the other parameters are only reported,
+        as they require a restart.
+
+        :param appconfig: the application configuration object (updated in place)
+        :param on_change: the callback invoked with the dictionary of applied changes
+        :param interval: the interval in seconds between two checks
+        :param mtime: the modification time of the last loaded file
+    """
+
+    def __init__(self, appconfig, on_change, interval=None):
+
+        """ Initializes the watcher
+
+            :param appconfig: the application configuration object
+            :param on_change: the callback invoked with the applied changes
+            :param interval: the check interval (default: config_reload_interval)
+        """
+
+        Thread.__init__(self, name='config-watcher', daemon=True)
+        self.appconfig = appconfig
+        self.on_change = on_change
+        self.interval = interval if interval is not None else appconfig.config_reload_interval
+        self.stopped = Event()
+        self.mtime = self.get_mtime()
+
+
+    def get_mtime(self):
+
+        """ Returns the modification time of the configuration file
+
+            :return: the modification time in nanoseconds or None if the file does not exist
+        """
+
+        try:
+            return os.stat(self.appconfig.config_filename).st_mtime_ns
+
+        except (OSError, TypeError):
+            return None
+
+
+    def run(self):
+
+        """Checks the configuration file until stopped"""
+
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+
+            except Exception as e:
+                logger.error(f'Exception: {str(e)}')
+
+
+    def stop(self):
+
+        """Stops the watcher"""
+
+        self.stopped.set()
+
+
+    def check(self):
+
+        """ Reloads the configuration file if it was modified
+
+            :return: the dictionary of applied changes or None if the file
+                     is unchanged or invalid
+        """
+
+        mtime = self.get_mtime()
+
+        if mtime is None or mtime == self.mtime:
+            return None
+
+        self.mtime = mtime
+
+        reloaded = AppConfig(self.appconfig.config_filename)
+        if reloaded.load_app_config() != 0:
+            logger.error('The modified configuration file cannot be parsed and is ignored.')
+            return None
+
+        errors = reloaded.validate()
+        if errors:
+            logger.error(f'The modified configuration file is invalid and is ignored: {"; ".join(errors)}')
+            return None
+
+        changes = {}
+
+        for key, value in vars(reloaded).items():
+            if key == 'config_filename' or getattr(self.appconfig, key, None) == value:
+                continue
+
+            if key in TUNABLES:
+                changes[key] = value
+            else:
+                logger.warning(f'The {key} parameter was modified, the change requires a restart.')
+
+        if changes:
+            self.appconfig.update(changes)
+            logger.info(f'Configuration reloaded: {", ".join(f"{key}={value}" for key, value in changes.items())}')
+            self.on_change(changes)
+
+        return changes
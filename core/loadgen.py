@@ -0,0 +1,453 @@
+
+# Import custom subpackages
+from core import config, monitor
+from common import utils, recorder, reduction
+from common.logger import get_logger, stop_listeners
+
+# Import standard packages
+from multiprocessing import Queue
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.loadgen')
+
+
+class FakeMessage():
+
+    """ A minimal stand-in for a paho-mqtt MQTTMessage, used to inject
+        payloads directly into Monitor.on_message
+
+        :param topic: the MQTT topic
+        :param payload: the encoded message payload
+    """
+
+    def __init__(self, topic, payload):
+
+        """ Initializes the fake message
+
+            :param topic: the MQTT topic
+            :param payload: the encoded message payload
+        """
+
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+        self.retain = False
+
+
+class TelemetryGenerator():
+
+    """ Generates realistic VoltaZero Sensing Unit payloads for a fleet of
+        simulated devices
+
+        :param devices: the number of simulated devices
+        :param null_ratio: the probability of a sensor reporting 'null'
+        :param seed: the random generator seed
+        :param sequence: if True, the payloads carry a device timestamp ('ts')
+                         and a sequence number ('seq')
+        :param duplicate_ratio: the probability of sending the previous message again
+        :param states: the last emitted readings per device
+        :param duplicates: the number of generated duplicates
+    """
+
+    def __init__(self, devices=1, null_ratio=0.05, seed=None, sequence=False, duplicate_ratio=0.0):
+
+        """ Initializes the generator
+
+            :param devices: the number of simulated devices
+            :param null_ratio: the probability of a sensor reporting 'null'
+            :param seed: the random generator seed
+            :param sequence: if True, the payloads carry a device timestamp and a sequence number
+            :param duplicate_ratio: the probability of sending the previous message again
+        """
+
+        self.devices = devices
+        self.null_ratio = null_ratio
+        self.random = random.Random(seed)
+        self.sequence = sequence
+        self.duplicate_ratio = duplicate_ratio
+        self.states = []
+        self.duplicates = 0
+        self.last_message = None
+
+        for i in range(devices):
+            self.states.append({
+                "id": str(100 + i),
+                "t0": self.random.uniform(18, 26),
+                "t1": self.random.uniform(15, 30),
+                "th": self.random.uniform(20, 60),
+                "ir": self.random.uniform(0, 5),
+                "lg": self.random.uniform(0, 5),
+                "bz": 0,
+                "seq": 0
+            })
+
+
+    def next_payload(self, index):
+
+        """ Returns the next payload of a given device as a dictionary.
+            Readings follow a bounded random walk and the buzzer is
+            triggered when the light sensor drops below 2.5V, as in the
+            garage case study
+
+            :param index: the device index
+            :return: the telemetry payload
+        """
+
+        state = self.states[index % self.devices]
+
+        state["t0"] = min(max(state["t0"] + self.random.gauss(0, 0.05), -10), 50)
+        state["t1"] = min(max(state["t1"] + self.random.gauss(0, 0.1), -20), 100)
+        state["th"] = min(max(state["th"] + self.random.gauss(0, 0.2), 0), 100)
+        state["ir"] = min(max(state["ir"] + self.random.gauss(0, 0.05), 0), 5)
+        state["lg"] = min(max(state["lg"] + self.random.gauss(0, 0.1), 0), 5)
+        state["bz"] = 1 if state["lg"] < 2.5 else 0
+
+        payload = {"id": state["id"]}
+
+        for key in ("t0", "t1", "th", "ir", "lg"):
+            if self.random.random() < self.null_ratio:
+                payload[key] = 'null'
+            else:
+                payload[key] = round(state[key], 3)
+
+        if self.random.random() < self.null_ratio:
+            payload["bz"] = 'null'
+        else:
+            payload["bz"] = state["bz"]
+
+        if self.sequence:
+            state["seq"] += 1
+            payload["seq"] = state["seq"]
+            payload["ts"] = round(time.time(), 3)
+
+        return payload
+
+
+    def next_message(self, index, topic=""):
+
+        """ Returns the next payload of a given device as an encoded message,
+            or a redelivery of the previous message (see duplicate_ratio)
+
+            :param index: the device index
+            :param topic: the MQTT topic
+            :return: the fake MQTT message
+        """
+
+        if self.last_message is not None and self.random.random() < self.duplicate_ratio:
+            self.duplicates += 1
+            return self.last_message
+
+        payload = json.dumps(self.next_payload(index)).encode('ascii')
+        self.last_message = FakeMessage(topic, payload)
+        return self.last_message
+
+
+class LoadHarness():
+
+    """ Drives the ingestion pipeline with synthetic telemetry and measures
+        the end-to-end (ingest to commit) latency and the sustained throughput
+
+        :param appconfig: the application configuration object
+        :param generator: the telemetry generator
+        :param rate: the total number of messages per second (0: unthrottled)
+        :param duration: the load duration in seconds
+        :param mode: 'inject' to call Monitor.on_message directly or
+                     'publish' to go through an MQTT broker
+        :param latencies: the measured ingest to commit latencies (seconds)
+        :param committed: the number of committed records
+        :param sent: the number of sent messages
+        :param reducer: the reducer of the ingest mode (None in raw mode)
+    """
+
+    def __init__(self, appconfig, generator, rate=100, duration=10, mode='inject'):
+
+        """ Initializes the load harness
+
+            :param appconfig: the application configuration object
+            :param generator: the telemetry generator
+            :param rate: the total number of messages per second (0: unthrottled)
+            :param duration: the load duration in seconds
+            :param mode: 'inject' or 'publish'
+        """
+
+        self.appconfig = appconfig
+        self.generator = generator
+        self.rate = rate
+        self.duration = duration
+        self.mode = mode
+        self.latencies = []
+        self.committed = 0
+        self.sent = 0
+        self.reducer = None
+        self.last_commit = None
+        self.lock = threading.Lock()
+
+
+    def on_commit(self, records):
+
+        """ Collects the latencies of the committed records
+
+            :param records: the list of committed telemetry records
+        """
+
+        now = time.time()
+
+        with self.lock:
+            for tlm in records:
+                if tlm.received_at is not None:
+                    self.latencies.append(now - tlm.received_at)
+            self.committed += len(records)
+            self.last_commit = now
+
+
+    def run(self, drain_timeout=30):
+
+        """ Runs the load and waits for the pipeline to commit all records
+
+            :param drain_timeout: the maximum time to wait for the queue to drain
+            :return: the summary dictionary
+        """
+
+        q = Queue()
+
+        trecorder = recorder.Recorder(q, self.appconfig)
+        trecorder.on_commit = self.on_commit
+        self.reducer = trecorder.reducer
+        trecorder.start()
+
+        if self.mode == 'publish':
+            publisher, pmonitor = self.start_publisher(q)
+        else:
+            publisher = None
+            pmonitor = monitor.Monitor(self.appconfig, q, client_id="loadgen")
+
+        start = time.time()
+
+        try:
+            while time.time() - start < self.duration:
+                # Pace the messages to match the requested rate
+                if self.rate > 0:
+                    delay = start + self.sent / self.rate - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                message = self.generator.next_message(self.sent, self.appconfig.topic)
+
+                if publisher is None:
+                    pmonitor.on_message(None, None, message)
+                else:
+                    publisher.publish(self.appconfig.topic, message.payload)
+
+                self.sent += 1
+
+            send_end = time.time()
+
+            # Wait for the recorder to commit the whole load (without the duplicates and the reduced readings)
+            while self.committed < self.sent - self.generator.duplicates - self.get_reduced() \
+                    and time.time() - send_end < drain_timeout:
+                time.sleep(0.01)
+
+        finally:
+            if publisher is not None:
+                publisher.loop_stop()
+                publisher.disconnect()
+                pmonitor.stop()
+                pmonitor.join()
+
+            trecorder.stop()
+            trecorder.join()
+
+        return self.summary(start, send_end)
+
+
+    def get_reduced(self):
+
+        """ Returns the decrease of the number of stored records by the ingest mode
+
+            :return: the number of reduced records
+        """
+
+        return self.reducer.reduced if self.reducer is not None else 0
+
+
+    def start_publisher(self, q):
+
+        """ Starts the Monitor process and a publisher client connected to
+            the local stand-in broker
+
+            :param q: the telemetry data queue
+            :return: the publisher client and the Monitor process
+        """
+
+        pmonitor = monitor.Monitor(self.appconfig, q, client_id="loadgen_monitor")
+        pmonitor.start()
+
+        publisher, _ = monitor.create_client(monitor.import_mqtt(), "loadgen_publisher")
+        publisher.username_pw_set(username=self.appconfig.username,
+                                  password=self.appconfig.secret)
+        publisher.connect(self.appconfig.host, self.appconfig.port)
+        publisher.loop_start()
+
+        # Give the monitor some time to subscribe
+        time.sleep(1)
+
+        return publisher, pmonitor
+
+
+    def summary(self, start, send_end):
+
+        """ Computes the load summary
+
+            :param start: the load start time
+            :param send_end: the time at which the last message was sent
+            :return: the summary dictionary
+        """
+
+        end = self.last_commit if self.last_commit is not None else send_end
+        elapsed = max(end - start, 1e-9)
+        percentiles = utils.get_percentiles(self.latencies, (50, 90, 99, 100))
+
+        return {
+            "mode": self.mode,
+            "devices": self.generator.devices,
+            "target_rate": self.rate,
+            "sent": self.sent,
+            "committed": self.committed,
+            "duplicates": self.generator.duplicates,
+            "reduced": self.get_reduced(),
+            "lost": self.sent - self.generator.duplicates - self.get_reduced() - self.committed,
+            "send_rate": self.sent / max(send_end - start, 1e-9),
+            "throughput": self.committed / elapsed,
+            "latency_p50": percentiles[50],
+            "latency_p90": percentiles[90],
+            "latency_p99": percentiles[99],
+            "latency_max": percentiles[100]
+        }
+
+
+def build_config(args):
+
+    """ Builds the application configuration used by the load harness
+
+        :param args: the parsed command line arguments
+        :return: the application configuration object
+    """
+
+    appconfig = config.AppConfig(args.config)
+
+    if args.config is not None:
+        if appconfig.load_app_config() != 0:
+            return None
+    else:
+        appconfig.parse_app_config({
+            "host": "localhost",
+            "port": 1883,
+            "username": "",
+            "secret": "",
+            "mac_address": "",
+            "topic": "voltazero/loadgen",
+            "database": "",
+            "table_name": "data",
+            "recorder_batch_size": 100,
+            "recorder_interval": 1,
+            "time_window": 300,
+            "viewer_interval": 5,
+            "no_viewer": True
+        })
+
+    # Command line overrides
+    for key in ("host", "port", "topic", "recorder_batch_size", "recorder_interval", "recorder_adaptive", "ingest_mode"):
+        value = getattr(args, key)
+        if value is not None:
+            setattr(appconfig, key, value)
+
+    appconfig.database_filename = args.database
+
+    return appconfig
+
+
+def main(argv=None):
+
+    """ Runs the load generator from the command line
+
+        :param argv: the command line arguments
+        :return: 0 if success, -1 otherwise
+    """
+
+    parser = argparse.ArgumentParser(description='VoltaZero synthetic telemetry load generator')
+    parser.add_argument('--mode', choices=['inject', 'publish'], default='inject',
+                        help='inject into Monitor.on_message or publish to a local broker')
+    parser.add_argument('--rate', type=float, default=100, help='messages per second (0: unthrottled)')
+    parser.add_argument('--devices', type=int, default=1, help='number of simulated devices')
+    parser.add_argument('--duration', type=float, default=10, help='load duration in seconds')
+    parser.add_argument('--null-ratio', type=float, default=0.05, help="probability of a 'null' reading")
+    parser.add_argument('--sequence', action='store_true',
+                        help="add a device timestamp ('ts') and a sequence number ('seq') to the payloads")
+    parser.add_argument('--duplicate-ratio', dest='duplicate_ratio', type=float, default=0.0,
+                        help='probability of sending the previous message again (implies --sequence)')
+    parser.add_argument('--seed', type=int, default=None, help='random generator seed')
+    parser.add_argument('--config', default=None, help='application configuration file')
+    parser.add_argument('--database', default=None, help='database file (default: temporary file)')
+    parser.add_argument('--host', default=None, help='broker host (publish mode)')
+    parser.add_argument('--port', type=int, default=None, help='broker port (publish mode)')
+    parser.add_argument('--topic', default=None, help='MQTT topic')
+    parser.add_argument('--recorder-batch-size', dest='recorder_batch_size', type=int, default=None)
+    parser.add_argument('--recorder-interval', dest='recorder_interval', type=float, default=None)
+    parser.add_argument('--adaptive', dest='recorder_adaptive', action='store_true', default=None,
+                        help='enable the adaptive batch size and flush interval')
+    parser.add_argument('--ingest-mode', dest='ingest_mode', choices=reduction.INGEST_MODES, default=None,
+                        help='stored readings (deadband tolerances from the configuration file)')
+    parser.add_argument('--output', default=None, help='write the JSON summary to this file')
+    parser.add_argument('--verbose', action='store_true', help='keep per-message debug logs')
+    args = parser.parse_args(argv)
+
+    log = get_logger('voltazero_monitor')
+    if not args.verbose:
+        log.setLevel(logging.INFO)
+
+    tmpdir = None
+    if args.database is None:
+        tmpdir = tempfile.mkdtemp(prefix='voltazero_loadgen_')
+        args.database = os.path.join(tmpdir, 'loadgen.db')
+
+    try:
+        appconfig = build_config(args)
+        if appconfig is None:
+            logger.error('The configuration file cannot be loaded!')
+            return -1
+
+        generator = TelemetryGenerator(devices=args.devices, null_ratio=args.null_ratio, seed=args.seed,
+                                       sequence=args.sequence or args.duplicate_ratio > 0,
+                                       duplicate_ratio=args.duplicate_ratio)
+        harness = LoadHarness(appconfig, generator, rate=args.rate, duration=args.duration, mode=args.mode)
+        result = harness.run()
+
+        text = json.dumps(result, indent=4)
+        print(text)
+
+        if args.output is not None:
+            utils.write_to_file(args.output, 'w', text)
+
+        return 0
+
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        stop_listeners()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
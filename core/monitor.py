@@ -1,17 +1,76 @@
 
 from core import telemetry
+from common import utils, metrics, profiler, logger as applog
 
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Event
 from datetime import datetime
 
 import json
-import paho.mqtt.client as mqtt
 import os
+import queue
+import random
+import time
 import logging
 
 
 # Initialize logger for the module
-logger = logging.getLogger('voltazero_monitor')
+logger = logging.getLogger('voltazero_monitor.monitor')
+
+# Ingestion metrics
+MESSAGES_RECEIVED = metrics.counter('voltazero_messages_received_total', 'Number of received MQTT messages')
+MESSAGES_DROPPED = metrics.counter('voltazero_messages_dropped_total', 'Number of messages dropped because they could not be decoded')
+DECODE_SECONDS = metrics.histogram('voltazero_message_decode_seconds', 'Time spent decoding and parsing a message')
+HANDOFF_FAILURES = metrics.counter('voltazero_handoff_failures_total', 'Number of messages refused because the queue was full (lost unless the acknowledgements are manual)')
+CONNECTED = metrics.gauge('voltazero_mqtt_connected', 'Whether the MQTT client is connected to the broker')
+RECONNECTS = metrics.counter('voltazero_mqtt_reconnects_total', 'Number of successful reconnections to the broker')
+CONNECT_FAILURES = metrics.counter('voltazero_mqtt_connect_failures_total', 'Number of failed connection attempts')
+GAP_SECONDS = metrics.histogram('voltazero_mqtt_gap_seconds', 'Duration of the broker disconnections', lowest=1e-3)
+
+
+def get_topics(topic):
+
+    """ Returns the list of topics of the topic parameter
+
+        :param topic: a topic or a list of topics
+        :return: the list of topics
+    """
+
+    return list(topic) if isinstance(topic, (list, tuple)) else [topic]
+
+
+def import_mqtt():
+
+    """ Imports the MQTT client library. It is only required by the monitor
+        process, so that the other processes do not pay for its import
+
+        :return: the paho.mqtt.client module
+    """
+
+    import paho.mqtt.client as mqtt
+    return mqtt
+
+
+def create_client(mqtt, client_id, clean_session=True, manual_ack=False):
+
+    """ Creates an MQTT client with the paho-mqtt 1.x callback signatures.
+        paho-mqtt 1.x sends the acknowledgement of a QoS 1 message before
+        its on_message handler is called. With paho-mqtt >= 2.0, the
+        acknowledgement can be left to the application (manual_ack), so
+        that a message is acknowledged only once its record is stored.
+
+        :param mqtt: the paho.mqtt.client module
+        :param client_id: the MQTT client identifier
+        :param clean_session: if False, the broker keeps the session across reconnections
+        :param manual_ack: if True, the messages are acknowledged by the application when supported
+        :return: the client and a flag indicating whether the acknowledgements are manual
+    """
+
+    if hasattr(mqtt, 'CallbackAPIVersion'):
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id,
+                             clean_session=clean_session, manual_ack=manual_ack)
+        return client, manual_ack
+
+    return mqtt.Client(client_id=client_id, clean_session=clean_session), False
 
 
 class Monitor(Process):
@@ -25,17 +84,40 @@ class Monitor(Process):
         :param client_id: the MQTT client identifier
         :param pid: the recorder process identifier
         :param stopped: a flag indicating if the process is running
+        :param stop_event: an event shared with the parent process to request a stop
         :param subscribed: a flag indicating if the client is subscribed to the topic
         :param connected: a flag indicating if the client is connected to the MQTT server
+        :param link_up: a flag indicating if the network connection to the broker is open
+        :param attempt: the number of connection attempts since the last successful one
+        :param disconnected_at: the time at which the connection was lost
+        :param log_queue: the main process logging queue
+        :param log_sampler: the rate limiter of the per-message log lines
+        :param profiler: the runtime-toggleable profiler of the monitor loop
+        :param created: the wall clock time at which the process was started
+        :param control: the queue of the reloaded configuration parameters
+        :param manual_ack: a flag indicating whether the messages are acknowledged by the
+                           application (paho-mqtt >= 2.0) or by paho before they are handled
+        :param acks: the queue of the acknowledgement tokens sent back by the Recorder once
+                     the records are committed or checkpointed (None to acknowledge the
+                     messages once queued)
+        :param session: the number of the current connection to the broker (the
+                        acknowledgement tokens of a previous connection are not sent)
     """
 
-    def __init__(self, appconfig, q, client_id):
+    # Maximum time to wait for room in the queue before refusing a message
+    handoff_timeout = 1.0
+
+    # Maximum time spent in the network loop, so that the stored records are acknowledged promptly
+    loop_timeout = 0.1
+
+    def __init__(self, appconfig, q, client_id, acks=None):
 
         """ Initializes the monitor object
 
             :param q: the telemetry data queue
             :param appconfig: the application configuration object
             :param client_id: the assigned client identifier
+            :param acks: the queue of the acknowledgement tokens of the stored records
         """
 
         super(Monitor, self).__init__()
@@ -44,9 +126,29 @@ class Monitor(Process):
         self.q = q
         self.subscribed = False
         self.connected = False
+        self.link_up = False
+        self.attempt = 0
+        self.disconnected_at = None
         self.client_id = client_id
         self.stopped = True
+        self.stop_event = Event()
         self.client = None
+        self.log_queue = applog.get_queue()
+        self.log_sampler = applog.RateLimiter(appconfig.log_sample_rate)
+        self.profiler = profiler.Profiler('monitor', appconfig.profile_dir, appconfig.profile_duration)
+        self.created = None
+        self.control = Queue()
+        self.manual_ack = False
+        self.acks = acks
+        self.session = 0
+
+
+    def start(self):
+
+        """Starts the monitor process"""
+
+        self.created = time.time()
+        super(Monitor, self).start()
 
 
     def init_connection(self):
@@ -57,22 +159,67 @@ class Monitor(Process):
         """
 
         try:
-            self.client = mqtt.Client(client_id=self.client_id,
-                                      clean_session=True)
-            self.client.username_pw_set(username=self.appconfig.username,
-                                        password=self.appconfig.secret)
-            self.client.on_connect = self.on_connect
-            self.client.on_message = self.on_message
-            self.client.on_subscribe = self.on_subscribe
+            # The client (and its session) is kept across reconnections
+            if self.client is None:
+                mqtt = import_mqtt()
+                self.client, self.manual_ack = create_client(mqtt, self.client_id, self.appconfig.mqtt_clean_session,
+                                                             manual_ack=True)
+
+                if not self.manual_ack:
+                    logger.warning('paho-mqtt < 2.0 acknowledges the messages before they are handled: '
+                                   'a message refused by a full queue or not committed before a crash is lost')
+                self.client.username_pw_set(username=self.appconfig.username,
+                                            password=self.appconfig.secret)
+                self.client.on_connect = self.on_connect
+                self.client.on_disconnect = self.on_disconnect
+                self.client.on_message = self.on_message
+                self.client.on_subscribe = self.on_subscribe
+
             self.client.connect(self.appconfig.host, self.appconfig.port)
+            self.link_up = True
 
             return 0
 
         except Exception as e:
+            CONNECT_FAILURES.inc()
             logger.error(f"Exception: {str(e)}")
             return -1
 
 
+    def get_backoff_delay(self):
+
+        """ Returns the delay before the next connection attempt. The delay is
+            drawn uniformly between 0 and an exponentially growing cap (full
+            jitter), so that a fleet of monitors does not reconnect in lockstep
+            after a broker outage
+
+            :return: the delay in seconds
+        """
+
+        cap = min(self.appconfig.reconnect_max_delay,
+                  self.appconfig.reconnect_min_delay * 2 ** min(self.attempt, 32))
+        return random.uniform(0, cap)
+
+
+    def on_connection_lost(self):
+
+        """Marks the connection as lost and waits before the next attempt"""
+
+        self.link_up = False
+        self.connected = False
+        self.subscribed = False
+        CONNECTED.set(0)
+
+        if self.disconnected_at is None:
+            self.disconnected_at = time.monotonic()
+
+        delay = self.get_backoff_delay()
+        self.attempt += 1
+
+        logger.warning(f'Connection to the broker lost, next attempt in {delay:.1f}s (attempt #{self.attempt})')
+        self.stop_event.wait(delay)
+
+
     def run(self):
 
         """ Runs the monitor loop
@@ -81,16 +228,40 @@ class Monitor(Process):
         """
 
         try:
+            startup = profiler.StartupTimer('monitor', self.created)
+            applog.configure_worker(self.log_queue, self.appconfig.log_levels)
+
             self.PID = os.getpid()
             logger.info(f'Monitor PID: {os.getpid()}')
+            startup.mark('logging')
+
+            metrics.start_server(self.appconfig.metrics_port, 'monitor')
+            utils.set_worker_signal_handlers(self.stop_event)
+            self.profiler.install_signal_handler()
+            startup.mark('metrics')
+
+            mqtt = import_mqtt()
+            startup.mark('imports')
+            startup.report()
 
             self.stopped = False
-            self.init_connection()
+            self.disconnected_at = time.monotonic()
+
+            # Reconnect with backoff until the monitor is stopped
+            while not self.stop_event.is_set():
+                if not self.link_up and self.init_connection() != 0:
+                    self.on_connection_lost()
+                    continue
+
+                self.poll_acks()
 
-            if self.client is not None:
-                while not self.stopped:
-                    self.client.loop()
+                if self.client.loop(timeout=self.loop_timeout) != mqtt.MQTT_ERR_SUCCESS:
+                    self.on_connection_lost()
 
+                self.profiler.poll()
+                self.poll_control()
+
+            self.disconnect()
             return 0
 
         except Exception as e:
@@ -100,7 +271,87 @@ class Monitor(Process):
 
     def stop(self):
 
-        """ Stops the monitor process
+        """ Requests the monitor process to stop. The process unsubscribes and
+            disconnects from the broker, then exits once its queued records are
+            flushed to the pipe (see join)
+
+            :return: 0 if success or -1 if an exception is raised
+        """
+
+        try:
+            self.stop_event.set()
+            return 0
+
+        except Exception as e:
+            logger.error(f"Exception: {str(e)}")
+            return -1
+
+
+    def apply_config(self, changes):
+
+        """ Sends reloaded configuration parameters to the monitor process
+
+            :param changes: dictionary mapping parameter names to their new values
+            :return: 0 if success or -1 if an exception is raised
+        """
+
+        try:
+            self.control.put(changes)
+            return 0
+
+        except Exception as e:
+            logger.error(f"Exception: {str(e)}")
+            return -1
+
+
+    def poll_control(self):
+
+        """Applies the reloaded configuration parameters (monitor process side)"""
+
+        try:
+            while True:
+                self.update_config(self.control.get_nowait())
+
+        except queue.Empty:
+            pass
+
+
+    def update_config(self, changes):
+
+        """ Applies reloaded configuration parameters. The subscriptions are
+            updated without reconnecting to the broker.
+
+            :param changes: dictionary mapping parameter names to their new values
+        """
+
+        old_topics = get_topics(self.appconfig.topic)
+        self.appconfig.update(changes)
+
+        if "log_levels" in changes:
+            applog.set_levels(self.appconfig.log_levels)
+
+        if "log_sample_rate" in changes:
+            self.log_sampler = applog.RateLimiter(self.appconfig.log_sample_rate)
+
+        if "profile_duration" in changes:
+            self.profiler.duration = self.appconfig.profile_duration
+
+        if "topic" in changes and self.connected:
+            new_topics = get_topics(self.appconfig.topic)
+            removed = [topic for topic in old_topics if topic not in new_topics]
+            added = [topic for topic in new_topics if topic not in old_topics]
+
+            if removed:
+                self.client.unsubscribe(removed)
+            if added:
+                self.client.subscribe([(topic, self.appconfig.mqtt_qos) for topic in added])
+
+            logger.info(f'Subscriptions updated (added: {added}, removed: {removed})')
+
+
+    def disconnect(self):
+
+        """ Unsubscribes and disconnects from the MQTT broker (monitor process side)
 
             :return: 0 if success or -1 if an exception is raised
         """
@@ -109,12 +360,14 @@ class Monitor(Process):
             self.stopped = True
 
             if self.client is not None and self.connected is True:
-                self.client.unsubscribe(self.appconfig.topic)
+                # A persistent session keeps its subscription so that the
+                # messages published meanwhile are delivered at restart
+                if self.appconfig.mqtt_clean_session:
+                    self.client.unsubscribe(get_topics(self.appconfig.topic))
                 self.client.disconnect()
                 self.connected = False
                 self.subscribed = False
 
-            super(Monitor, self).terminate()
             return 0
 
         except Exception as e:
@@ -132,23 +385,90 @@ class Monitor(Process):
             :param message: the telemetry message
         """
 
+        MESSAGES_RECEIVED.inc()
+
         try:
             if self.q is None:
                 self.q = Queue()
 
             # Decode and parse the telemetry data
+            received_at = time.time()
+            start = time.perf_counter()
             data = json.loads(message.payload.decode('ascii'))
-            ts = datetime.now().strftime('%Y/%m/%d %H:%M:%S')
+            ts, seq, device_ts = self.handle_metadata(data, received_at)
 
-            t0, t1, th, bz, lg, ir, id = self.handle_telemetry(data)
-            tlm = telemetry.Telemetry(timestamp=ts, t0=t0, t1=t1, th=th, bz=bz, ls=lg, ir=ir, id=id)
+            # With manual acknowledgements, a QoS 1 message is acknowledged
+            # once the Recorder committed or checkpointed its record
+            ack = None
+            if self.manual_ack and self.acks is not None and client is not None and message.qos > 0:
+                ack = (self.session, message.mid, message.qos)
 
-            self.q.put(tlm)
-
-            logger.debug(f"{str(tlm)}")
+            t0, t1, th, bz, lg, ir, id = self.handle_telemetry(data)
+            tlm = telemetry.Telemetry(timestamp=ts, t0=t0, t1=t1, th=th, bz=bz, ls=lg, ir=ir, id=id, received_at=received_at,
+                                      seq=seq, device_ts=device_ts, ack=ack)
+            DECODE_SECONDS.observe(time.perf_counter() - start)
+
+            self.q.put(tlm, timeout=self.handoff_timeout)
+
+            # Without the Recorder tokens, the message is acknowledged once queued
+            if ack is None:
+                self.ack(client, message)
+
+            # Per-message logs are sampled and formatted lazily
+            if logger.isEnabledFor(logging.DEBUG) and self.log_sampler.allow():
+                logger.debug("%s (%d lines suppressed)", tlm, self.log_sampler.pop_suppressed())
+
+        except queue.Full:
+            # The connection is dropped to stop the inflow while the queue
+            # drains. An unacknowledged message is redelivered once the
+            # session is resumed (mqtt_clean_session false), an acknowledged
+            # one (paho-mqtt 1.x) is lost.
+            HANDOFF_FAILURES.inc()
+            if self.manual_ack:
+                logger.error('The telemetry queue is full, the message is left unacknowledged')
+            else:
+                logger.error('The telemetry queue is full, the (already acknowledged) message is lost')
+            if client is not None:
+                client.disconnect()
 
         except Exception as e:
+            # An undecodable message would be redelivered forever
+            MESSAGES_DROPPED.inc()
             logger.error(f"Exception: {str(e)}")
+            self.ack(client, message)
+
+
+    def ack(self, client, message):
+
+        """ Acknowledges a message when the acknowledgements are manual
+
+            :param client: the MQTT client (None for injected messages)
+            :param message: the MQTT message
+        """
+
+        if self.manual_ack and client is not None:
+            client.ack(message.mid, message.qos)
+
+
+    def poll_acks(self):
+
+        """ Acknowledges the messages of the records stored by the Recorder.
+            The tokens of a previous connection are skipped: their message
+            identifiers are no longer valid, and the broker redelivers these
+            messages when the session is resumed (mqtt_clean_session false).
+        """
+
+        if self.acks is None:
+            return
+
+        try:
+            while True:
+                for session, mid, qos in self.acks.get_nowait():
+                    if session == self.session and self.connected:
+                        self.client.ack(mid, qos)
+
+        except queue.Empty:
+            pass
 
 
     def on_subscribe(self, client, userdata, mid, granted_qos):
@@ -176,13 +496,72 @@ class Monitor(Process):
 
         if rc == 0:
             self.connected = True
+            self.session += 1
+            self.attempt = 0
+            CONNECTED.set(1)
             logger.info(self.parse_return_code(0))
-            self.client.subscribe(self.appconfig.topic)
+
+            if self.disconnected_at is not None:
+                GAP_SECONDS.observe(time.monotonic() - self.disconnected_at)
+                self.disconnected_at = None
+                RECONNECTS.inc()
+
+            self.client.subscribe([(topic, self.appconfig.mqtt_qos) for topic in get_topics(self.appconfig.topic)])
         else:
+            CONNECT_FAILURES.inc()
             logger.error(f"{self.parse_return_code(rc)}")
             self.connected = False
 
 
+    def on_disconnect(self, client, userdata, rc):
+
+        """ The on_disconnect handler flags the lost connection
+
+            :param client: the MQTT client
+            :param userdata: the user data object
+            :param rc: the disconnection reason (0 if requested by the client)
+        """
+
+        self.link_up = False
+        self.connected = False
+        self.subscribed = False
+        CONNECTED.set(0)
+
+        if self.disconnected_at is None:
+            self.disconnected_at = time.monotonic()
+
+
+    def handle_metadata(self, data, received_at):
+
+        """ Parses the optional device timestamp ('ts', UNIX time) and sequence
+            number ('seq') of a message. The reception time is used when the
+            device timestamp is missing, disabled (device_timestamps) or ahead
+            of the reception time by more than device_time_max_skew seconds.
+
+            :param data: the MQTT message payload
+            :param received_at: the UNIX time of the reception
+            :return: timestamp, seq, device_ts: the record timestamp, the sequence
+                     number and the device timestamp (None if not used)
+        """
+
+        seq = data.get("seq")
+        seq = int(seq) if seq not in (None, 'null') else None
+
+        device_ts = data.get("ts")
+
+        if self.appconfig.device_timestamps and device_ts not in (None, 'null'):
+            device_ts = float(device_ts)
+
+            if device_ts - received_at <= self.appconfig.device_time_max_skew:
+                return datetime.fromtimestamp(device_ts).strftime('%Y/%m/%d %H:%M:%S'), seq, device_ts
+
+            if self.log_sampler.allow():
+                logger.warning("Device %s clock is %.0fs ahead, the reception time is used (%d lines suppressed)",
+                               data.get("id"), device_ts - received_at, self.log_sampler.pop_suppressed())
+
+        return datetime.fromtimestamp(received_at).strftime('%Y/%m/%d %H:%M:%S'), seq, None
+
+
     def handle_telemetry(self, data):
 
         """ Parses the telemetry data and returns the sensors' readings
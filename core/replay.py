@@ -0,0 +1,330 @@
+
+# Import custom subpackages
+from core import config, supervisor, telemetry
+from common import utils, database, metrics, profiler, logger as applog
+
+# Import standard packages
+from multiprocessing import Process, Event, Value
+from datetime import datetime
+
+import argparse
+import os
+import queue
+import sys
+import time
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.replay')
+
+# Replay metrics
+RECORDS_REPLAYED = metrics.counter('voltazero_records_replayed_total', 'Number of recorded telemetry records replayed into the queue')
+REPLAY_LAG = metrics.gauge('voltazero_replay_lag_seconds', 'Delay of the replay behind the original timing (scaled by the speed)')
+
+
+def read_rows(source, fmt=None, start=None, end=None, table_name="data", device_id=None, chunk_size=1000):
+
+    """ Reads the recorded rows of a database or of an export file by chunks
+
+        :param source: the database file or the export file (or npz directory)
+        :param fmt: the export format (default: guessed from the path, database if unknown)
+        :param start: the range start (see utils.get_naive_timestamp), None for no lower bound
+        :param end: the range end (excluded), None for no upper bound
+        :param table_name: the data table name (database source)
+        :param device_id: an optional device identifier filter
+        :param chunk_size: the number of rows per chunk
+        :return: generator of lists of rows (database.EXPORT_COLUMNS values)
+        :raises RuntimeError: the database cannot be opened
+    """
+
+    # The export readers and the compressed chunks require NumPy
+    from core import archive
+    from common import chunks
+
+    fmt = fmt or archive.guess_format(source)
+
+    if fmt is None:
+        reader = database.SnapshotReader()
+        connection_handler = reader.connect(source)
+
+        if connection_handler is None:
+            raise RuntimeError(f"The database {source} cannot be opened")
+
+        try:
+            # The compressed chunks and the rows are read from the same snapshot
+            with reader.snapshot(connection_handler):
+                yield from chunks.iterate_rows(connection_handler, start, end, table_name, device_id, chunk_size)
+        finally:
+            database.disconnect(connection_handler)
+        return
+
+    lower = utils.format_naive_timestamp(start) if start is not None else None
+    upper = utils.format_naive_timestamp(end) if end is not None else None
+
+    for rows in archive.READERS[fmt](source, chunk_size):
+        yield [row for row in rows
+               if (lower is None or row[0] >= lower) and (upper is None or row[0] < upper)
+               and (device_id is None or row[1] == device_id)]
+
+
+class Replay(Process):
+
+    """ Replays recorded telemetry into the ingestion queue, in place of the
+        MQTT Monitor, to reproduce incidents or to test the downstream stages.
+        The original intervals between the records are kept, divided by the
+        speed factor (0: as fast as possible, in batches). By default the
+        records are stamped with their replay time, as live records would
+        be, so that the Viewer shows them.
+
+        :param appconfig: the application configuration object
+        :param q: the telemetry data queue
+        :param source: the database file or the export file (or npz directory)
+        :param fmt: the export format (default: guessed from the source path)
+        :param speed: the speed factor (1: original timing, 0: as fast as possible)
+        :param start: the replayed range start (see utils.get_naive_timestamp)
+        :param end: the replayed range end (excluded)
+        :param device_id: an optional device identifier filter
+        :param restamp: if True, the records are stamped with their replay time
+        :param batch_size: the maximum number of records queued at once
+        :param stop_event: an event shared with the parent process to request a stop
+        :param count: the number of replayed records (shared with the parent process)
+        :param log_queue: the main process logging queue
+        :param created: the wall clock time at which the process was started
+    """
+
+    # Maximum time to wait for room in the queue before checking the stop event
+    handoff_timeout = 1.0
+
+    def __init__(self, appconfig, q, source, fmt=None, speed=1.0, start=None, end=None, device_id=None,
+                 restamp=True, batch_size=1000):
+
+        """ Initializes the replay process
+
+            :param appconfig: the application configuration object
+            :param q: the telemetry data queue
+            :param source: the database file or the export file
+            :param fmt: the export format (default: guessed from the source path)
+            :param speed: the speed factor (1: original timing, 0: as fast as possible)
+            :param start: the replayed range start
+            :param end: the replayed range end (excluded)
+            :param device_id: an optional device identifier filter
+            :param restamp: if True, the records are stamped with their replay time
+            :param batch_size: the maximum number of records queued at once
+        """
+
+        super(Replay, self).__init__()
+
+        self.appconfig = appconfig
+        self.q = q
+        self.source = source
+        self.fmt = fmt
+        self.speed = speed
+        self.start_time = start
+        self.end_time = end
+        self.device_id = device_id
+        self.restamp = restamp
+        self.batch_size = batch_size
+        self.stop_event = Event()
+        self.count = Value('q', 0)
+        self.log_queue = applog.get_queue()
+        self.created = None
+
+
+    def start(self):
+
+        """Starts the replay process"""
+
+        self.created = time.time()
+        super(Replay, self).start()
+
+
+    def run(self):
+
+        """ Runs the replay loop
+
+            :return: 0 if success or -1 if an exception is raised
+        """
+
+        try:
+            startup = profiler.StartupTimer('replay', self.created)
+            applog.configure_worker(self.log_queue, self.appconfig.log_levels)
+            logger.info(f'Replay PID: {os.getpid()}')
+
+            metrics.start_server(self.appconfig.metrics_port, 'monitor')
+            utils.set_worker_signal_handlers(self.stop_event)
+            startup.report()
+
+            start = time.time()
+            self.replay()
+
+            elapsed = max(time.time() - start, 1e-9)
+            logger.info(f'Replay complete: {self.count.value} records in {elapsed:.1f}s '
+                        f'({self.count.value / elapsed:.0f} records/s)')
+            return 0
+
+        except Exception as e:
+            logger.error(f"Exception: {str(e)}")
+            return -1
+
+
+    def replay(self):
+
+        """ Reads the source and queues the records with their original timing """
+
+        batch = []
+        origin = None
+        wall_start = None
+        last_text = last_value = None
+
+        for rows in read_rows(self.source, self.fmt, self.start_time, self.end_time, self.appconfig.table_name,
+                              self.device_id, self.batch_size):
+            for row in rows:
+                if self.stop_event.is_set():
+                    return
+
+                if self.speed > 0:
+                    # Consecutive records mostly share their timestamp
+                    if row[0] != last_text:
+                        last_text = row[0]
+                        last_value = utils.get_naive_timestamp(datetime.strptime(row[0], utils.TIMESTAMP_FORMAT))
+
+                    if origin is None:
+                        origin, wall_start = last_value, time.monotonic()
+
+                    delay = wall_start + (last_value - origin) / self.speed - time.monotonic()
+
+                    if delay > 0:
+                        self.put(batch)
+                        batch = []
+                        if self.stop_event.wait(delay):
+                            return
+                    else:
+                        REPLAY_LAG.set(-delay)
+
+                batch.append(row)
+
+                if len(batch) >= self.batch_size:
+                    self.put(batch)
+                    batch = []
+
+        self.put(batch)
+
+
+    def put(self, rows):
+
+        """ Converts rows into telemetry records and queues them as one batch.
+            The replay waits for room in the queue (back pressure).
+
+            :param rows: the list of rows (database.EXPORT_COLUMNS values)
+        """
+
+        if not rows:
+            return
+
+        received_at = time.time()
+        now = datetime.fromtimestamp(received_at).strftime(utils.TIMESTAMP_FORMAT)
+
+        records = [telemetry.Telemetry(timestamp=now if self.restamp else row[0], id=row[1],
+                                       t0=row[2], t1=row[3], th=row[4], ir=row[5], ls=row[6], bz=row[7],
+                                       received_at=received_at) for row in rows]
+
+        while not self.stop_event.is_set():
+            try:
+                self.q.put(records, timeout=self.handoff_timeout)
+                break
+            except queue.Full:
+                continue
+
+        with self.count.get_lock():
+            self.count.value += len(records)
+        RECORDS_REPLAYED.inc(len(records))
+
+
+    def stop(self):
+
+        """ Requests the replay process to stop
+
+            :return: 0 if success
+        """
+
+        self.stop_event.set()
+        return 0
+
+
+    def apply_config(self, changes):
+
+        """ Ignores the reloaded configuration parameters (no subscription)
+
+            :param changes: dictionary mapping parameter names to their new values
+            :return: 0
+        """
+
+        return 0
+
+
+def main(argv=None):
+
+    """ Replays recorded telemetry through the Recorder and Viewer from the
+        command line, then reports the replay and end-to-end throughputs
+
+        :param argv: the command line arguments
+        :return: 0 if success, -1 otherwise
+    """
+
+    parser = argparse.ArgumentParser(description='VoltaZero Monitor telemetry replay')
+    parser.add_argument('source', help='database file or export file (.csv, .jsonl, optionally .gz, .parquet, npz directory)')
+    parser.add_argument('--format', default=None, help='export format (default: from the file name)')
+    parser.add_argument('--speed', type=float, default=1.0, help='speed factor (default: 1, 0: as fast as possible)')
+    parser.add_argument('--start', default=None, help="range start ('2020/05/01 10:00:00' or seconds before now)")
+    parser.add_argument('--end', default=None, help='range end (excluded)')
+    parser.add_argument('--device', default=None, help='device identifier')
+    parser.add_argument('--keep-timestamps', dest='restamp', action='store_false',
+                        help='store the original timestamps instead of the replay times')
+    parser.add_argument('--config', default='./core/config.json', help='application configuration file')
+    parser.add_argument('--database', default=None, help='destination database (default: from the configuration)')
+    args = parser.parse_args(argv)
+
+    # The date parser is shared with the export tool
+    from core import archive
+
+    log = applog.get_logger('voltazero_monitor')
+
+    try:
+        appconfig = config.AppConfig(args.config)
+        if appconfig.load_app_config() != 0:
+            logger.error('The configuration file cannot be loaded!')
+            return -1
+
+        applog.set_levels(appconfig.log_levels)
+        log.setLevel(logging.INFO)
+
+        if args.database is not None:
+            appconfig.database_filename = args.database
+
+        if os.path.exists(appconfig.database_filename) and os.path.exists(args.source) and \
+                os.path.samefile(appconfig.database_filename, args.source):
+            logger.error('The replay source cannot be the destination database')
+            return -1
+
+        def create_source(q):
+            return Replay(appconfig, q, args.source, args.format, args.speed, archive.parse_date(args.start),
+                          archive.parse_date(args.end), args.device, args.restamp)
+
+        start = time.time()
+        psupervisor = supervisor.Supervisor(appconfig, client_id="replay", source=create_source)
+        psupervisor.start()
+        psupervisor.wait()
+        psupervisor.stop()
+        elapsed = max(time.time() - start, 1e-9)
+
+        count = psupervisor.monitor.count.value
+        logger.info(f'{count} records replayed and recorded in {elapsed:.1f}s ({count / elapsed:.0f} records/s end to end)')
+        return 0
+
+    finally:
+        applog.stop_listeners()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,238 @@
+
+# Import custom subpackages
+from core import monitor, config
+from common import database, recorder, writer, resources, logger as applog
+
+# Import standard packages
+from multiprocessing import Queue, Process
+from threading import Event
+
+import os
+import signal
+import time
+import logging
+
+
+# Initialize logger for the module
+logger = logging.getLogger('voltazero_monitor.supervisor')
+
+
+class Supervisor():
+
+    """ Starts the Monitor, Recorder and Viewer and orchestrates their
+        shutdown: ingestion is stopped first, then the Recorder drains the
+        queue until it is empty or the shutdown deadline is reached, in which
+        case the remaining records are checkpointed and restored at the next
+        start
+
+        :param appconfig: the application configuration object
+        :param q: the telemetry data queue
+        :param monitor: the Monitor process
+        :param recorder: the Recorder thread or writer process
+        :param viewer: the Viewer process (None if disabled)
+        :param stop_requested: an event set when a stop signal is received
+        :param watcher: the configuration file watcher (None if disabled)
+        :param commit_log: the commit sequence published by the Recorder to the Viewer
+        :param acks: the acknowledgement tokens sent back by the Recorder to the Monitor
+                     once their records are stored (None with another source)
+        :param reader: the snapshot reader shared by the reading processes (reader slots)
+        :param default_limits: the limits of the processes before the resources are applied
+        :param limits: dictionary mapping component names to their applied limits
+        :param source: a function creating the telemetry source process from
+                       the queue in place of the Monitor (e.g. a Replay), None
+                       for the MQTT Monitor
+    """
+
+    def __init__(self, appconfig, client_id="cp100", source=None):
+
+        """ Initializes the supervisor
+
+            :param appconfig: the application configuration object
+            :param client_id: the MQTT client identifier
+            :param source: a function creating the telemetry source process from the queue
+        """
+
+        self.appconfig = appconfig
+        self.client_id = client_id
+        self.q = Queue(maxsize=appconfig.queue_max_size)
+        self.monitor = None
+        self.recorder = None
+        self.viewer = None
+        self.stop_requested = Event()
+        self.watcher = None
+        self.source = source
+        self.commit_log = database.CommitLog()
+        self.acks = None
+        self.reader = database.SnapshotReader.from_config(appconfig)
+        self.default_limits = resources.get_defaults()
+        self.limits = {}
+
+
+    def start(self):
+
+        """Starts all the components and installs the stop signal handlers"""
+
+        # Start the Monitor and establish connection to the MQTT broker (or the replay source)
+        if self.source is not None:
+            self.monitor = self.source(self.q)
+        else:
+            # The MQTT messages are acknowledged once the Recorder stored their records
+            self.acks = Queue()
+            self.monitor = monitor.Monitor(self.appconfig, self.q, client_id=self.client_id, acks=self.acks)
+        self.monitor.start()
+
+        # Initialize and start database recorder (in a dedicated writer process if required)
+        if self.appconfig.recorder_process:
+            self.recorder = writer.Writer(self.q, self.appconfig, self.commit_log, self.acks)
+        else:
+            self.recorder = recorder.Recorder(self.q, self.appconfig, self.commit_log, self.acks)
+            self.recorder.profiler.install_signal_handler()
+        self.recorder.start()
+
+        # Start viewer if required (the plotting modules are only imported in that case)
+        if(not self.appconfig.no_viewer):
+            from core import viewer
+            self.viewer = viewer.Viewer(self.appconfig, window_title='Sensors data', commit_log=self.commit_log,
+                                        reader=self.reader)
+            self.viewer.start()
+        else:
+            logger.info('The viewer is disabled.')
+
+        self.apply_resources()
+
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGTERM, self.request_stop)
+
+        # Apply the configuration file changes live if required
+        if self.appconfig.config_reload_interval and self.appconfig.config_filename:
+            self.watcher = config.ConfigWatcher(self.appconfig, self.apply_config)
+            self.watcher.start()
+
+
+    def apply_config(self, changes):
+
+        """ Forwards reloaded configuration parameters to all the components
+
+            :param changes: dictionary mapping parameter names to their new values
+        """
+
+        if "log_levels" in changes:
+            applog.set_levels(changes["log_levels"])
+
+        for component in (self.monitor, self.recorder, self.viewer):
+            if component is not None:
+                component.apply_config(changes)
+
+        if "resources" in changes:
+            self.apply_resources()
+
+
+    def apply_resources(self):
+
+        """ Applies the configured CPU affinity, nice level and memory cap of
+            each component to its process, including the threads already
+            running in it (the in-process Recorder thread gets the limits of
+            the main process). The limits removed by a reload are restored
+            to the defaults of the processes first.
+
+            :return: 0 if success or -1 if a limit cannot be applied
+        """
+
+        processes = {"main": os.getpid()}
+
+        for name, component in (("monitor", self.monitor), ("writer", self.recorder), ("viewer", self.viewer)):
+            if isinstance(component, Process) and component.pid is not None:
+                processes[name] = component.pid
+
+        rcode = 0
+
+        for name, pid in processes.items():
+            limits = self.appconfig.resources.get(name) or {}
+            removed = [key for key, value in self.limits.get(name, {}).items()
+                       if value is not None and limits.get(key) is None]
+
+            if removed and resources.reset_limits(pid, name, removed, self.default_limits) != 0:
+                rcode = -1
+
+            if resources.apply_limits(pid, name, limits) != 0:
+                rcode = -1
+
+            self.limits[name] = dict(limits)
+
+        return rcode
+
+
+    def request_stop(self, signum=None, frame=None):
+
+        """ Signal handler requesting the shutdown
+
+            :param signum: the received signal
+            :param frame: the current stack frame
+        """
+
+        self.stop_requested.set()
+
+
+    def wait(self):
+
+        """Blocks until a stop is requested (or the end of a replay source)"""
+
+        try:
+            while not self.stop_requested.wait(1):
+                if self.source is not None and not self.monitor.is_alive():
+                    logger.info('The telemetry source has ended.')
+                    break
+
+        except KeyboardInterrupt:
+            self.stop_requested.set()
+
+
+    def stop(self):
+
+        """ Stops all the components within the shutdown_timeout deadline
+
+            :return: 0 if the shutdown completed in time, -1 otherwise
+        """
+
+        logger.info("Stopping all threads and processes... (This may take few seconds)")
+
+        if self.watcher is not None:
+            self.watcher.stop()
+
+        timeout = self.appconfig.shutdown_timeout
+        deadline = time.monotonic() + timeout
+        rcode = 0
+
+        # Stop the ingestion first and drain the queue meanwhile
+        if self.monitor is not None:
+            self.monitor.stop()
+
+        if self.recorder is not None:
+            self.recorder.stop(timeout=timeout, wait_producers=True)
+
+        if self.monitor is not None:
+            self.monitor.join(max(deadline - time.monotonic(), 0))
+            if self.monitor.is_alive():
+                logger.warning('The monitor did not stop in time and is terminated')
+                self.monitor.terminate()
+                self.monitor.join()
+                rcode = -1
+
+        # No more records will be queued
+        if self.recorder is not None:
+            self.recorder.producers_done.set()
+
+        # Stop viewer process if already started
+        if self.viewer is not None:
+            self.viewer.stop()
+            self.viewer.join(max(deadline - time.monotonic(), 1))
+            if self.viewer.is_alive():
+                self.viewer.terminate()
+                self.viewer.join()
+
+        # Wait for the recorder to drain the queue
+        if self.recorder is not None:
+            self.recorder.join()
+
+        logger.info("All threads and processes are stopped.")
+        return rcode
@@ -13,9 +13,15 @@ class Telemetry():
         :param ls: light sensor value, defaults to None
         :param ir: infrared sensor value, defaults to None
         :param id: instance identifier, defaults to None
+        :param received_at: UNIX time at which the record was ingested, defaults to None
+        :param seq: device sequence number, defaults to None
+        :param device_ts: UNIX time of the reading set by the device, defaults to None
+        :param ack: acknowledgement token of the MQTT message (connection number, message
+                    identifier, QoS) sent back once the record is stored, defaults to None
     """
 
-    def __init__(self, timestamp=None, t0=None, t1=None, th=None, bz=None, ls=None, ir=None, id=None):
+    def __init__(self, timestamp=None, t0=None, t1=None, th=None, bz=None, ls=None, ir=None, id=None, received_at=None,
+                 seq=None, device_ts=None, ack=None):
 
         """Initializes the Telemetry instance
 
@@ -27,6 +33,10 @@ class Telemetry():
         :param ls: light sensor value, defaults to None
         :param ir: infrared sensor value, defaults to None
         :param id: instance identifier, defaults to None
+        :param received_at: UNIX time at which the record was ingested, defaults to None
+        :param seq: device sequence number, defaults to None
+        :param device_ts: UNIX time of the reading set by the device, defaults to None
+        :param ack: acknowledgement token of the MQTT message, defaults to None
         """
 
         if timestamp is None:
@@ -41,6 +51,20 @@ class Telemetry():
         self.ls = ls
         self.ir = ir
         self.id = id
+        self.received_at = received_at
+        self.seq = seq
+        self.device_ts = device_ts
+        self.ack = ack
+
+
+    def as_row(self):
+
+        """Returns the database row of the Telemetry instance
+
+        :return: tuple of the values in the data table column order
+        """
+
+        return (self.t0, self.t1, self.th, self.ir, self.ls, self.bz, self.timestamp, self.id)
 
 
     def __repr__(self):
@@ -1,31 +1,55 @@
 
 # Import custom subpackages
-from common import utils, database
+from common import utils, database, metrics, profiler, calibration, resample, columnstore, logger as applog
 
 # Import standard packages
 from platform import system
-from multiprocessing import Process
+from multiprocessing import Process, Event, Queue
 
-import matplotlib.dates as mdates
-import matplotlib.ticker as ticker
-import matplotlib.pyplot as plt
 import numpy as np
 import datetime
+import queue
 import time
 import os
 import logging
 
 
 # Initialize logger for the module
-logger = logging.getLogger('voltazero_monitor')
+logger = logging.getLogger('voltazero_monitor.viewer')
 
-# Uncomment if you want to use WXAgg backend for matplotlib
-# because Tkinter is inherently not thread-safe
-# import matplotlib
-# matplotlib.use('WXAgg')
+# Viewer metrics
+QUERY_SECONDS = metrics.histogram('voltazero_viewer_query_seconds', 'Time spent retrieving the viewer data')
+RENDER_SECONDS = metrics.histogram('voltazero_viewer_render_seconds', 'Time spent drawing the plots')
 
-# Specify the plotting style
-plt.style.use('ggplot')
+# Plotting modules, imported by the viewer process only (see import_plotting)
+plt = None
+mdates = None
+ticker = None
+
+
+def import_plotting():
+
+    """ Imports matplotlib and sets the plotting style. The import is
+        deferred to the viewer process, so that the other processes (and the
+        no_viewer mode) never load the plotting libraries.
+    """
+
+    global plt, mdates, ticker
+
+    if plt is not None:
+        return
+
+    # Uncomment if you want to use WXAgg backend for matplotlib
+    # because Tkinter is inherently not thread-safe
+    # import matplotlib
+    # matplotlib.use('WXAgg')
+
+    import matplotlib.dates as mdates
+    import matplotlib.ticker as ticker
+    import matplotlib.pyplot as plt
+
+    # Specify the plotting style
+    plt.style.use('ggplot')
 
 
 def plt_maximize():
@@ -59,68 +83,128 @@ def plt_maximize():
 
 class Viewer(Process):
 
-    """This class runs the telemetry plot viewer
+    """This class runs the telemetry plot viewer. The viewer shows one window
+       per configured panel (viewer_panels), each with its own time window,
+       sensors and resampling. All the panels slice a shared column store,
+       refreshed by a single incremental query per update.
 
        :param window_title: the plot window title
        :param appconfig: the application configuration object
        :param sensor_info: a list of sensor subplots properties
-       :param columns: the list of telemetry data arrays
+       :param panels: the list of panel properties (figure, axes and plotted columns)
+       :param store: the column store shared by the panels
+       :param reader: the snapshot reader of the database queries
+       :param calibration: the per-device sensor calibration
        :param enabled: a flag indicating if the viewer's process is enabled
+       :param stop_event: an event shared with the parent process to request a stop
        :param pid: the viewer process identifier
+       :param log_queue: the main process logging queue
+       :param profiler: the runtime-toggleable profiler of the viewer loop
+       :param created: the wall clock time at which the process was started
+       :param control: the queue of the reloaded configuration parameters
+       :param last_draw: the monotonic time of the last draw
     """
 
-    def __init__(self, appconfig, window_title='Sensors data'):
+    def __init__(self, appconfig, window_title='Sensors data', commit_log=None, reader=None):
 
         """ Initializes the viewer object
 
         :param appconfig: the application configuration object
         :param window_title: the plot window title
+        :param commit_log: the commit log published by the Recorder (see database.CommitLog)
+        :param reader: the snapshot reader shared with the other processes (see database.SnapshotReader)
         """
 
         super(Viewer, self).__init__()
         self.appconfig = appconfig
         self.enabled = False
+        self.stop_event = Event()
         self.window_title = window_title
+        self.log_queue = applog.get_queue()
+        self.profiler = profiler.Profiler('viewer', appconfig.profile_dir, appconfig.profile_duration)
+        self.created = None
+        self.control = Queue()
+        self.last_draw = None
+        self.calibration = calibration.Calibration.from_config(appconfig)
+        self.reader = reader if reader is not None else database.SnapshotReader.from_config(appconfig)
 
         self.sensor_info = [
                             {
+                                "sensor": "t0",
                                 "title": 'T0 ($^\circ$C)',
                                 "min_y_lim": 0,
                                 "max_y_lim": 30,
                                 "enable_y_limits": False
                             },
                             {
+                                "sensor": "t1",
                                 "title": "T1 ($^\circ$C)",
                                 "min_y_lim": 0,
                                 "max_y_lim": 100,
                                 "enable_y_limits": True
                             },
                             {
+                                "sensor": "th",
                                 "title": "Th ($^\circ$C)",
                                 "min_y_lim": 0,
                                 "max_y_lim": 100,
                                 "enable_y_limits": True
                             },
                             {
+                                "sensor": "ir",
                                 "title": "IR (V)",
                                 "min_y_lim": -0.1,
                                 "max_y_lim": 5.1,
                                 "enable_y_limits": True
                             },
                             {
+                                "sensor": "ls",
                                 "title": "LS (V)",
                                 "min_y_lim": -0.1,
                                 "max_y_lim": 5.1,
                                 "enable_y_limits": True
                             },
                             {
+                                "sensor": "bz",
                                 "title": "Buzz. State",
                                 "min_y_lim": -0.1,
                                 "max_y_lim": 1.1,
                                 "enable_y_limits": True
                             }
                         ]
-        self.columns = [[], [], [], [], [], [], []]
+        self.sensor_info = [self.calibration.get_axis(info["sensor"], info) for info in self.sensor_info]
+        self.panels = self.get_panels()
+        self.store = columnstore.ColumnStore(max(panel["time_window"] for panel in self.panels),
+                                             appconfig.table_name, self.calibration, commit_log,
+                                             appconfig.viewer_max_records)
+
+
+    def get_panels(self):
+
+        """ Builds the panels properties from the viewer_panels parameter. The
+            unset properties default to the time_window and viewer_resample_*
+            parameters, and to all the sensors. Without panels, a single panel
+            shows all the sensors over time_window.
+
+            :return: the list of panel properties
+        """
+
+        panels = []
+        sensors = [info["sensor"] for info in self.sensor_info]
+
+        for index, panel in enumerate(self.appconfig.viewer_panels or [{}]):
+            panels.append({
+                "title": panel.get("title", self.window_title if index == 0 else f"{self.window_title} ({index + 1})"),
+                "time_window": panel.get("time_window", self.appconfig.time_window),
+                "sensors": [sensor for sensor in panel.get("sensors", sensors) if sensor in sensors],
+                "resample_step": panel.get("resample_step", self.appconfig.viewer_resample_step),
+                "resample_fill": panel.get("resample_fill", self.appconfig.viewer_resample_fill),
+                "resample_max_gap": panel.get("resample_max_gap", self.appconfig.viewer_resample_max_gap),
+                "columns": None,
+                "nrecords": 0
+            })
+
+        return panels
 
 
     def start(self):
@@ -128,6 +212,7 @@ class Viewer(Process):
         """Starts the viewer thread"""
 
         self.enabled = True
+        self.created = time.time()
         super(Viewer, self).start()
 
 
@@ -137,8 +222,7 @@ class Viewer(Process):
 
         try:
             self.enabled = False
-
-            super(Viewer, self).terminate()
+            self.stop_event.set()
             return 0
 
         except Exception as e:
@@ -149,26 +233,47 @@ class Viewer(Process):
     def run(self):
 
         """ Runs the viewer infinite loop """
+        startup = profiler.StartupTimer('viewer', self.created)
+        applog.configure_worker(self.log_queue, self.appconfig.log_levels)
+
         self.PID = os.getpid()
         logger.info(f'Viewer PID: {os.getpid()}')
+        startup.mark('logging')
+
+        metrics.start_server(self.appconfig.metrics_port, 'viewer')
+        utils.set_worker_signal_handlers(self.stop_event)
+        self.profiler.install_signal_handler()
+        startup.mark('metrics')
 
         # Initialize plot
+        import_plotting()
+        startup.mark('imports')
         self.init_viewer()
+        startup.mark('figures')
+        startup.report()
 
         try:
             # insert data in database
-            while (self.enabled):
+            while (not self.stop_event.is_set()):
                 # Update plot
                 nrecords = self.fetch_and_format_data()
 
-                # Set window title
-                self.fig.canvas.set_window_title(f"""{self.window_title} - [Last update: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Retrieved datapoints: {nrecords}]""")
+                # Set windows title
+                now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                for panel in self.panels:
+                    panel["fig"].canvas.manager.set_window_title(f"""{panel["title"]} - [Last update: {now} - Retrieved datapoints: {panel["nrecords"]}]""")
 
                 if (nrecords > 0):
+                    self.last_draw = time.monotonic()
+                    start = time.perf_counter()
                     self.draw()
+                    RENDER_SECONDS.observe(time.perf_counter() - start)
+
+                self.profiler.poll()
+                self.poll_control()
 
                 # Sleep viewer thread
-                time.sleep(self.appconfig.viewer_interval)
+                self.stop_event.wait(self.get_delay())
 
         except Exception as e:
             logger.error(f"Exception: {str(e)}")
@@ -177,107 +282,216 @@ class Viewer(Process):
             self.enabled = False
 
 
+    def get_delay(self):
+
+        """ Returns the delay before the next refresh: viewer_interval,
+            extended so that the panels are drawn at most viewer_max_fps
+            times per second
+
+            :return: the delay in seconds
+        """
+
+        delay = self.appconfig.viewer_interval
+
+        if self.appconfig.viewer_max_fps > 0 and self.last_draw is not None:
+            delay = max(delay, self.last_draw + 1 / self.appconfig.viewer_max_fps - time.monotonic())
+
+        return delay
+
+
+    def apply_config(self, changes):
+
+        """ Sends reloaded configuration parameters to the viewer process
+
+            :param changes: dictionary mapping parameter names to their new values
+            :return: 0 if success or -1 if an exception is raised
+        """
+
+        try:
+            self.control.put(changes)
+            return 0
+
+        except Exception as e:
+            logger.error(f"Exception: {str(e)}")
+            return -1
+
+
+    def poll_control(self):
+
+        """Applies the reloaded configuration parameters (viewer process side)"""
+
+        try:
+            while True:
+                self.update_config(self.control.get_nowait())
+
+        except queue.Empty:
+            pass
+
+
+    def update_config(self, changes):
+
+        """ Applies reloaded configuration parameters. The panels which do
+            not set their own time window follow time_window.
+
+            :param changes: dictionary mapping parameter names to their new values
+        """
+
+        self.appconfig.update(changes)
+
+        if "log_levels" in changes:
+            applog.set_levels(self.appconfig.log_levels)
+
+        if "profile_duration" in changes:
+            self.profiler.duration = self.appconfig.profile_duration
+
+        if "time_window" in changes:
+            for panel, properties in zip(self.panels, self.get_panels()):
+                panel["time_window"] = properties["time_window"]
+            self.store.resize(max(panel["time_window"] for panel in self.panels))
+
+
     def draw(self):
 
-        """Updates and plots the curves"""
+        """Updates and plots the curves of all the panels"""
+
+        drawn = False
+
+        for panel in self.panels:
+            columns = panel["columns"]
 
-        if (len(self.columns[0]) > 0):
-            min_x_lim = utils.get_datetime_with_offset(self.columns[0][0], -10)
-            max_x_lim = utils.get_datetime_with_offset(self.columns[0][len(self.columns[0])-1], 10)
+            if columns is None or len(columns[0]) == 0:
+                continue
 
-            for i in range(6):
-                if len(self.axs[i].lines) > 0:
-                    self.axs[i].lines.remove(self.axs[i].lines[0])
+            min_x_lim = columns[0][0] - np.timedelta64(10, 's')
+            max_x_lim = columns[0][-1] + np.timedelta64(10, 's')
 
-                self.axs[i].plot(self.columns[0], self.columns[i+1],
-                                 color='royalblue',
-                                 marker="o")
-                self.axs[i].set_xlim(min_x_lim, max_x_lim)
+            # The curves are updated in place, the artists are created once (see init_viewer)
+            for i, (axis, line) in enumerate(zip(panel["axs"], panel["lines"])):
+                line.set_data(columns[0], columns[i+1])
+                axis.relim()
+                axis.autoscale_view(scalex=False)
+                axis.set_xlim(min_x_lim, max_x_lim)
 
-                # Uncomment if plot update's screenshots are required
-                # plt.savefig(f'img/image_{datetime.datetime.timestamp(datetime.datetime.now())}.png')
+            drawn = True
 
-                # Show plot without blocking the running process
-                plt.show(block=False)
-                plt.pause(0.0001)
+        if drawn:
+            # Uncomment if plot update's screenshots are required
+            # plt.savefig(f'img/image_{datetime.datetime.timestamp(datetime.datetime.now())}.png')
+
+            # Show plots without blocking the running process
+            plt.show(block=False)
+            plt.pause(0.0001)
         else:
             logger.info('No data to plot!')
 
 
     def init_viewer(self):
 
-        """Initializes the plot window and figure"""
+        """Initializes the plot windows and figures (one per panel)"""
+
+        import_plotting()
 
         # Turn on matplotlib interactive mode if necessary
         # plt.ion()
 
-        # Creates just a figure and only one subplot
-        self.fig, self.axs = plt.subplots(6, sharex=True)
+        sensor_info = {info["sensor"]: info for info in self.sensor_info}
 
-        try:
-            # Maximize window
-            plt_maximize()
+        for panel in self.panels:
+            # Creates a figure with one subplot per sensor
+            panel["fig"], axs = plt.subplots(len(panel["sensors"]), sharex=True, squeeze=False)
+            panel["axs"] = list(axs[:, 0])
 
-            # Set up the subplots' properties
-            for i in range(6):
-                info = self.sensor_info[i]
-                self.axs[i].set_ylabel(info["title"])
+            try:
+                # Maximize window
+                plt_maximize()
 
-                if(info["enable_y_limits"]):
-                    self.axs[i].set_ylim(info["min_y_lim"], info["max_y_lim"])
+                # Set up the subplots' properties
+                for axis, sensor in zip(panel["axs"], panel["sensors"]):
+                    info = sensor_info[sensor]
+                    axis.set_ylabel(info["title"])
 
-                self.axs[i].xaxis.set_major_locator(plt.MaxNLocator(20))
+                    if(info["enable_y_limits"]):
+                        axis.set_ylim(info["min_y_lim"], info["max_y_lim"])
 
-                self.axs[i].xaxis.set_major_locator(mdates.MinuteLocator())
-                self.axs[i].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-                self.axs[i].xaxis.set_minor_locator(ticker.AutoMinorLocator())
-                self.axs[i].xaxis.set_minor_formatter(ticker.NullFormatter())
+                    axis.xaxis.set_major_locator(plt.MaxNLocator(20))
 
-                self.axs[i].xaxis_date()
-                self.axs[i].autoscale_view()
-                self.axs[i].grid(which='major', axis='both', alpha=.3)
+                    axis.xaxis.set_major_locator(mdates.MinuteLocator())
+                    axis.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+                    axis.xaxis.set_minor_locator(ticker.AutoMinorLocator())
+                    axis.xaxis.set_minor_formatter(ticker.NullFormatter())
 
-        except Exception as e:
-            print(f'Exception: {str(e)}')
+                    axis.xaxis_date()
+                    axis.autoscale_view()
+                    axis.grid(which='major', axis='both', alpha=.3)
+
+            except Exception as e:
+                print(f'Exception: {str(e)}')
+
+            panel["lines"] = [axis.plot([], [], color='royalblue', marker="o")[0] for axis in panel["axs"]]
 
 
     def fetch_and_format_data(self):
 
-        """Fetches data from database and formats the retrieved data for plotting
+        """Refreshes the shared column store and formats the data of each panel for plotting
 
-           :return : the number of retrieved data records, -1 if exception is raised
+           :return : the number of cached data records, -1 if exception is raised
         """
 
         try:
-            # Retrieve data from database
-            db_connect = database.connect(self.appconfig.database_filename)
-            data = database.retrieve_data(db_connect, self.appconfig.time_window, self.appconfig.table_name)
-            database.disconnect(db_connect)
-
-            logger.debug(f"Total retrieved records: {len(data)}")
-
-            # Format retrieved data
-            timestamps = []
-            t0 = []
-            t1 = []
-            th = []
-            ir = []
-            bz = []
-            ls = []
-
-            for item in data:
-                timestamps.append(datetime.datetime.strptime(item.timestamp, '%Y/%m/%d %H:%M:%S'))
-                t0.append(item.t0 if not (item.t0 is None) else np.nan)
-                t1.append(item.t1 if not (item.t1 is None) else np.nan)
-                th.append(item.th if not (item.th is None) else np.nan)
-                ir.append(item.ir if not (item.ir is None) else np.nan)
-                ls.append(item.ls if not (item.ls is None) else np.nan)
-                bz.append(item.bz if not (item.bz is None) else np.nan)         
-
-            self.columns = [timestamps, t0, t1, th, ir, ls, bz]
-
-            return len(data)
+            # Retrieve the new records from database
+            start = time.perf_counter()
+            end_ts = utils.get_naive_timestamp()
+
+            # Without new commit, the database is not opened (the freshness is checked once)
+            current = self.store.is_current()
+            db_connect = None if current else self.reader.connect(self.appconfig.database_filename)
+
+            if db_connect is None and not current:
+                return -1
+
+            try:
+                with self.reader.snapshot(db_connect):
+                    count = self.store.refresh(db_connect, end_ts, current=current)
+            finally:
+                database.disconnect(db_connect)
+            QUERY_SECONDS.observe(time.perf_counter() - start)
+
+            if count < 0:
+                return -1
+
+            logger.debug("New retrieved records: %d (cached: %d)", count, len(self.store))
+
+            for panel in self.panels:
+                self.format_panel(panel, end_ts)
+
+            return len(self.store)
 
         except Exception as e:
             logger.error(f"Exception: {str(e)}")
             return -1
+
+
+    def format_panel(self, panel, end_ts):
+
+        """ Slices the panel window out of the column store and formats it
+            (the calibrated values are plotted when available)
+
+            :param panel: the panel properties
+            :param end_ts: the window end (naive timestamp)
+        """
+
+        start_ts = end_ts - panel["time_window"]
+        data = self.store.slice(start_ts)
+        panel["nrecords"] = len(data["id"])
+
+        # Resample on a regular grid if required (empty bins are filled or left as gaps)
+        if panel["resample_step"] and panel["nrecords"] > 0:
+            sensors = [key for key in data if key in panel["sensors"] or key.endswith('_cal') and key[:-4] in panel["sensors"]]
+            data = resample.resample(data, panel["resample_step"], start_ts, end_ts,
+                                     fill=panel["resample_fill"],
+                                     max_gap=panel["resample_max_gap"],
+                                     sensors=sensors)
+
+        timestamps = (data["timestamp"] * 1000).astype('datetime64[ms]')
+
+        panel["columns"] = [timestamps] + [data.get(f"{sensor}_cal", data[sensor]) for sensor in panel["sensors"]]
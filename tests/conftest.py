@@ -0,0 +1,95 @@
+
+# Import custom subpackages
+from common import database, utils
+from core import config, telemetry
+
+# Import standard packages
+import pytest
+
+
+# Start of the test records (2020/05/01 00:00:00)
+BASE = 1588291200.0
+
+
+def make_rows(count, start=BASE, devices=1):
+
+    """ Creates EXPORT_COLUMNS rows, one per second, spread over devices.
+        The readings vary from row to row (t1 is missing every 5 rows and
+        bz changes every 50 rows).
+
+        :param count: the number of rows
+        :param start: the naive timestamp of the first row
+        :param devices: the number of devices
+        :return: the list of rows
+    """
+
+    return [(utils.format_naive_timestamp(start + i), f"vsu-{i % devices}", 20.0 + (i % 7) * 0.1,
+             None if i % 5 == 0 else 21.0 + i % 7, 45.25, float(i % 3), 300.0 + i, i // 50 % 2) for i in range(count)]
+
+
+def make_record(offset=0, device="vsu-1", **fields):
+
+    """ Creates a telemetry record
+
+        :param offset: the time of the record in seconds after BASE
+        :param device: the device identifier
+        :param fields: the overridden Telemetry fields (readings, seq, device_ts...)
+        :return: the telemetry record
+    """
+
+    values = {"t0": 20.0, "t1": 21.0, "th": 40.0, "ir": 1.0, "ls": 300.0, "bz": 0}
+    values.update(fields)
+
+    return telemetry.Telemetry(timestamp=utils.format_naive_timestamp(BASE + offset), id=device, **values)
+
+
+def make_config_data(**options):
+
+    """ Creates the content of a configuration file
+
+        :param options: the overridden configuration keys
+        :return: the configuration dictionary
+    """
+
+    data = {"host": "localhost", "port": 1883, "username": "", "secret": "", "mac_address": "",
+            "topic": "voltazero/test", "database": "test.db", "table_name": "data", "no_viewer": True,
+            "recorder_batch_size": 100, "recorder_interval": 1, "time_window": 300, "viewer_interval": 5,
+            "recorder_adaptive": True, "recorder_min_interval": 0.1, "recorder_max_latency": 2,
+            "recorder_min_batch_size": 10, "recorder_max_batch_size": 5000}
+    data.update(options)
+    return data
+
+
+def make_config(**options):
+
+    """ Creates an application configuration
+
+        :param options: the overridden configuration keys
+        :return: the application configuration object
+    """
+
+    appconfig = config.AppConfig(None)
+    assert appconfig.parse_app_config(make_config_data(**options)) == 0
+    return appconfig
+
+
+@pytest.fixture
+def database_path(tmp_path):
+
+    """ Path of a database with an empty data table """
+
+    path = str(tmp_path / "test.db")
+    connection_handler = database.connect(path)
+    database.create_datatable(connection_handler)
+    database.disconnect(connection_handler)
+    return path
+
+
+@pytest.fixture
+def connection_handler(database_path):
+
+    """ Connection to the test database """
+
+    connection_handler = database.connect(database_path)
+    yield connection_handler
+    database.disconnect(connection_handler)
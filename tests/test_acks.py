@@ -0,0 +1,156 @@
+
+# Import custom subpackages
+from common import database, recorder
+from core import monitor
+from tests.conftest import make_config, make_record
+
+# Import standard packages
+import json
+import queue
+
+import pytest
+
+
+class FakeClient():
+
+    """ MQTT client recording the acknowledgements """
+
+    def __init__(self):
+        self.acked = []
+
+    def ack(self, mid, qos):
+        self.acked.append(mid)
+
+    def disconnect(self):
+        pass
+
+
+class Message():
+
+    """ MQTT message of a telemetry payload """
+
+    def __init__(self, mid, qos=1, device="vsu-1"):
+        self.mid = mid
+        self.qos = qos
+        self.payload = json.dumps({"id": device, "t0": 20.5, "t1": 21, "th": "null", "ir": 1,
+                                   "bz": 0, "lg": 300, "seq": mid}).encode('ascii')
+
+
+@pytest.fixture
+def appconfig(database_path, tmp_path):
+
+    return make_config(database=database_path, checkpoint_file=str(tmp_path / "checkpoint.jsonl"),
+                       recorder_adaptive=False, latest_shared_memory="")
+
+
+@pytest.fixture
+def writer(appconfig):
+
+    acks = queue.Queue()
+    trecorder = recorder.Recorder(queue.Queue(), appconfig, acks=acks)
+    assert trecorder.init_connection() == 0
+    trecorder.init_latest()
+    yield trecorder
+    database.disconnect(trecorder.connection_handler)
+
+
+def get_acks(acks):
+
+    """ Returns the message identifiers of the tokens sent back
+
+        :param acks: the queue of the acknowledgement tokens
+        :return: the list of message identifiers
+    """
+
+    tokens = []
+
+    while not acks.empty():
+        tokens.extend(acks.get_nowait())
+
+    return [token[1] for token in tokens]
+
+
+def test_messages_are_acknowledged_by_the_recorder(appconfig):
+
+    acks = queue.Queue()
+    q = queue.Queue()
+    pmonitor = monitor.Monitor(appconfig, q, client_id="test", acks=acks)
+    pmonitor.manual_ack = True
+    pmonitor.connected = True
+    pmonitor.session = 1
+    client = pmonitor.client = FakeClient()
+
+    for mid in (1, 2, 3):
+        pmonitor.on_message(client, None, Message(mid))
+
+    # Nothing is acknowledged once queued
+    assert client.acked == []
+    assert [q.get_nowait().ack for _ in range(3)] == [(1, 1, 1), (1, 2, 1), (1, 3, 1)]
+
+    # The tokens of a previous connection are skipped
+    acks.put([(1, 1, 1), (1, 2, 1)])
+    acks.put([(0, 3, 1)])
+    pmonitor.poll_acks()
+
+    assert client.acked == [1, 2]
+
+
+def test_undecodable_message_is_acknowledged(appconfig):
+
+    pmonitor = monitor.Monitor(appconfig, queue.Queue(), client_id="test", acks=queue.Queue())
+    pmonitor.manual_ack = True
+    client = FakeClient()
+    message = Message(7)
+    message.payload = b'not json'
+
+    pmonitor.on_message(client, None, message)
+
+    assert client.acked == [7]
+
+
+def test_tokens_are_sent_after_commit(writer):
+
+    for mid in range(5):
+        writer.q.put(make_record(mid, seq=mid, ack=(1, mid, 1)))
+
+    assert len(writer.insert_batch(100)) == 5
+    assert get_acks(writer.acks) == [0, 1, 2, 3, 4]
+
+
+def test_duplicates_are_acknowledged(writer):
+
+    writer.q.put([make_record(0, seq=0, ack=(1, 1, 1)), make_record(0, seq=0, ack=(1, 2, 1))])
+
+    assert len(writer.insert_batch(100)) == 1
+    assert get_acks(writer.acks) == [1, 2]
+
+
+def test_tokens_wait_for_failed_inserts(writer, monkeypatch):
+
+    writer.q.put([make_record(mid, seq=mid, ack=(1, mid, 1)) for mid in range(3)])
+    monkeypatch.setattr(database, "insert_telemetry_data", lambda *args, **kwargs: -1)
+
+    writer.insert_batch(100)
+
+    assert get_acks(writer.acks) == []
+    assert len(writer.pending) == 3
+
+    monkeypatch.undo()
+    writer.insert_batch(100)
+
+    assert get_acks(writer.acks) == [0, 1, 2]
+
+
+def test_checkpointed_records_are_acknowledged(writer, monkeypatch):
+
+    writer.q.put([make_record(mid, seq=mid, ack=(1, mid, 1)) for mid in range(3)])
+    monkeypatch.setattr(database, "insert_telemetry_data", lambda *args, **kwargs: -1)
+
+    for _ in range(writer.max_failures):
+        writer.insert_batch(100)
+
+    assert get_acks(writer.acks) == [0, 1, 2]
+
+    # The tokens are not saved with the records
+    with open(writer.appconfig.checkpoint_file) as fid:
+        assert all("ack" not in json.loads(line) for line in fid)
@@ -0,0 +1,61 @@
+
+# Import custom subpackages
+from common import adaptive
+from tests.conftest import make_config
+
+
+def test_initial_values_within_bounds():
+
+    controller = adaptive.BatchController(make_config(recorder_batch_size=1, recorder_interval=1))
+
+    assert controller.batch_size == 10
+    assert controller.interval == 1
+
+
+def test_batch_size_follows_arrival_rate():
+
+    controller = adaptive.BatchController(make_config())
+
+    for i in range(20):
+        controller.update(500, 0.01, 0.5, 0, now=float(i))
+
+    assert 450 < controller.rate < 550
+    assert controller.batch_size >= controller.rate * controller.interval
+
+
+def test_queue_backlog_counts_as_arrivals():
+
+    controller = adaptive.BatchController(make_config())
+    controller.update(100, 0.01, 0.1, 0, now=0.0)
+    controller.update(100, 0.01, 0.1, 400, now=1.0)
+
+    assert controller.rate == 500
+    assert controller.batch_size >= 400
+
+
+def test_interval_shrinks_when_queue_is_late():
+
+    controller = adaptive.BatchController(make_config())
+    controller.update(100, 0.01, 0.1, 0, now=0.0)
+    interval = controller.interval
+    controller.update(100, 0.01, 10.0, 0, now=1.0)
+
+    assert controller.interval <= interval / 2
+
+
+def test_duty_cycle_limits_interval():
+
+    controller = adaptive.BatchController(make_config(recorder_max_latency=1))
+    controller.update(100, 0.8, 0.1, 0, now=0.0)
+
+    # At most half of the time is spent committing
+    assert controller.interval >= 0.8
+
+
+def test_empty_flush_keeps_commit_latency():
+
+    controller = adaptive.BatchController(make_config())
+    controller.update(100, 0.2, 0.1, 0, now=0.0)
+    controller.update(100, 0, 0.1, 0, now=1.0)
+
+    assert controller.commit_seconds == 0.2
@@ -0,0 +1,60 @@
+
+# Import custom subpackages
+from common import database
+from core import archive
+from tests.conftest import BASE, make_rows
+
+# Import standard packages
+import pytest
+
+
+def get_indexes(connection_handler):
+
+    """ Returns the index names of the data table
+
+        :param connection_handler: the Connection object
+        :return: the set of index names
+    """
+
+    rows = connection_handler.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'data'")
+    return {row[0] for row in rows}
+
+
+@pytest.mark.parametrize("name", ["export.csv", "export.csv.gz", "export.jsonl", "export_npz"])
+def test_export_import_round_trip(connection_handler, tmp_path, name):
+
+    rows = make_rows(500, devices=3)
+    database.bulk_insert(connection_handler, [rows])
+    path = str(tmp_path / name)
+
+    assert archive.export_data(connection_handler, path, fmt="npz" if name.endswith("npz") else None,
+                               chunk_size=128) == 500
+
+    target = database.connect(str(tmp_path / "target.db"))
+
+    try:
+        assert archive.import_data(target, path, fmt="npz" if name.endswith("npz") else None) == 500
+        assert [row for chunk in database.iterate_rows(target) for row in chunk] == rows
+    finally:
+        database.disconnect(target)
+
+
+def test_malformed_import_is_rolled_back(connection_handler, tmp_path):
+
+    database.bulk_insert(connection_handler, [make_rows(10)])
+    indexes = get_indexes(connection_handler)
+    synchronous = connection_handler.execute("PRAGMA synchronous").fetchone()[0]
+
+    path = tmp_path / "malformed.csv"
+    archive.write_csv([make_rows(20, BASE + 100)], str(path))
+
+    with open(path, 'a') as fid:
+        fid.write("2020/05/01 01:00:00,vsu-0,not a number,,,,,\n")
+
+    assert archive.import_data(connection_handler, str(path), chunk_size=8) == -1
+
+    # Nothing is imported, the indexes and the pragma are restored
+    assert not connection_handler.in_transaction
+    assert connection_handler.execute("SELECT COUNT(*) FROM data").fetchone()[0] == 10
+    assert get_indexes(connection_handler) == indexes
+    assert connection_handler.execute("PRAGMA synchronous").fetchone()[0] == synchronous
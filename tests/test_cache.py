@@ -0,0 +1,167 @@
+
+# Import custom subpackages
+from common import columnstore, database
+from core import archive
+from tests.conftest import BASE, make_rows
+
+# Import standard packages
+import pytest
+
+
+@pytest.fixture
+def path(database_path):
+
+    """ Path of a database holding 300 records """
+
+    connection_handler = database.connect(database_path)
+    database.bulk_insert(connection_handler, [make_rows(300)])
+    database.disconnect(connection_handler)
+    return database_path
+
+
+class Counter():
+
+    """ Query function counting its calls """
+
+    def __init__(self, value="result"):
+        self.calls = 0
+        self.value = value
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+def test_commit_outside_range_keeps_result():
+
+    commit_log = database.CommitLog()
+    cache = database.QueryCache(commit_log=commit_log)
+    compute = Counter()
+
+    cache.memoize(None, "window", BASE + 60, compute)
+    commit_log.publish(BASE + 120)
+
+    assert cache.memoize(None, "window", BASE + 60, compute) == "result"
+    assert compute.calls == 1
+
+
+def test_commit_inside_range_invalidates_result():
+
+    commit_log = database.CommitLog()
+    cache = database.QueryCache(commit_log=commit_log)
+    compute = Counter()
+
+    cache.memoize(None, "window", BASE + 60, compute)
+    commit_log.publish(BASE + 30)
+    cache.memoize(None, "window", BASE + 60, compute)
+
+    assert compute.calls == 2
+
+
+def test_commit_log_overflow_invalidates_result():
+
+    commit_log = database.CommitLog()
+    cache = database.QueryCache(commit_log=commit_log)
+    compute = Counter()
+
+    cache.memoize(None, "window", BASE + 60, compute)
+
+    for _ in range(commit_log.capacity + 1):
+        commit_log.publish(BASE + 120)
+
+    cache.memoize(None, "window", BASE + 60, compute)
+
+    assert compute.calls == 2
+
+
+def test_budget_evicts_least_recently_used():
+
+    cache = database.QueryCache(budget_mb=1, commit_log=database.CommitLog())
+    block = b'x' * (400 * 1024)
+
+    for key in ("a", "b", "c"):
+        cache.memoize(None, key, BASE, Counter(block))
+
+    assert list(cache.entries) == ["b", "c"]
+    assert cache.size <= cache.budget
+
+
+def test_data_version_invalidates_without_commit_log(path):
+
+    reader = database.connect(path, readonly=True)
+    writer = database.connect(path)
+    cache = database.QueryCache()
+
+    try:
+        first = cache.retrieve_columns(reader, BASE, BASE + 600)
+        assert len(first["timestamp"]) == 300
+        assert len(cache) > 0
+
+        database.bulk_insert(writer, [make_rows(100, BASE + 300)])
+
+        assert len(cache.retrieve_columns(reader, BASE, BASE + 600)["timestamp"]) == 400
+
+    finally:
+        database.disconnect(reader)
+        database.disconnect(writer)
+
+
+def test_external_import_invalidates_with_commit_log(path, tmp_path):
+
+    reader = database.connect(path, readonly=True)
+    cache = database.QueryCache(commit_log=database.CommitLog())
+    source = str(tmp_path / "import.csv")
+    archive.write_csv([make_rows(100, BASE + 300)], source)
+
+    try:
+        assert len(cache.retrieve_columns(reader, BASE, BASE + 600)["timestamp"]) == 300
+
+        # Imported by another process: nothing is published in the commit log
+        assert archive.main(["--database", path, "import", source]) == 0
+
+        assert len(cache.retrieve_columns(reader, BASE, BASE + 600)["timestamp"]) == 400
+
+    finally:
+        database.disconnect(reader)
+
+
+def test_column_store_refresh_uses_checked_freshness(path):
+
+    commit_log = database.CommitLog()
+    store = columnstore.ColumnStore(600, commit_log=commit_log)
+    connection_handler = database.connect(path, readonly=True)
+
+    try:
+        assert store.refresh(connection_handler, BASE + 300) == 300
+    finally:
+        database.disconnect(connection_handler)
+
+    # A commit lands between the freshness check and the refresh: the
+    # connection was not opened, the new records are fetched next time
+    current = store.is_current()
+    commit_log.publish(BASE + 300)
+
+    assert current
+    assert store.refresh(None, BASE + 300, current=current) == 0
+    assert not store.is_current()
+
+
+def test_column_store_backfills_a_larger_window(path):
+
+    store = columnstore.ColumnStore(100)
+    connection_handler = database.connect(path, readonly=True)
+
+    try:
+        assert store.refresh(connection_handler, BASE + 300) == 100
+
+        # Smaller window: the cached records are evicted, nothing is queried again
+        store.resize(50)
+        assert store.refresh(connection_handler, BASE + 300) == 0
+        assert len(store) == 50
+
+        # Larger window: the records before the cached ones are fetched
+        store.resize(600)
+        assert store.refresh(connection_handler, BASE + 300) == 300
+        assert len(store) == 300
+    finally:
+        database.disconnect(connection_handler)
@@ -0,0 +1,86 @@
+
+# Import custom subpackages
+from common import chunks, database
+from tests.conftest import BASE, make_rows
+
+# Import standard packages
+import numpy as np
+import pytest
+
+
+def test_timestamps_round_trip():
+
+    timestamps = BASE + np.cumsum(np.random.default_rng(1).integers(0, 5, 1000)).astype(float)
+
+    decoded = chunks.decode_timestamps(chunks.encode_timestamps(timestamps), len(timestamps))
+
+    assert np.array_equal(decoded, timestamps)
+
+
+@pytest.mark.parametrize("values", [
+    np.array([20.0, 20.1, 20.15, -3.25, 0.0, 1e6]),
+    np.array([1 / 3, np.pi, 2.0 ** 0.5]),
+    np.array([20.0, np.nan, 20.5, np.nan])
+])
+def test_floats_round_trip(values):
+
+    decoded = chunks.decode_floats(chunks.encode_floats(values), len(values))
+
+    assert np.array_equal(decoded, values, equal_nan=True)
+
+
+def test_runs_round_trip():
+
+    values = np.array([0.0] * 40 + [1.0] * 3 + [0.0] * 100 + [np.nan] * 2 + [1.0])
+
+    decoded = chunks.decode_runs(chunks.encode_runs(values), len(values))
+
+    assert np.array_equal(decoded, values, equal_nan=True)
+
+
+def test_chunk_round_trip():
+
+    rng = np.random.default_rng(2)
+    columns = {"timestamp": BASE + np.arange(500, dtype=float)}
+    columns.update({sensor: np.round(rng.normal(20, 5, 500), 2) for sensor in database.SENSORS})
+    columns["bz"] = (np.arange(500) // 60 % 2).astype(float)
+
+    decoded = chunks.decode_chunk(chunks.encode_chunk(columns))
+
+    for key, values in columns.items():
+        assert np.array_equal(decoded[key], values)
+
+
+def test_unknown_chunk_format():
+
+    with pytest.raises(ValueError):
+        chunks.decode_chunk(b'XXXX' + bytes(8))
+
+
+def test_compacted_rows_are_unchanged(connection_handler):
+
+    rows = make_rows(3000, devices=3)
+    database.bulk_insert(connection_handler, [rows])
+
+    assert chunks.compact(connection_handler, BASE + 2500, span=600) == 2500
+
+    merged = [row for batch in chunks.iterate_rows(connection_handler, chunk_size=128) for row in batch]
+
+    assert merged == rows
+
+
+def test_rows_are_merged_by_timestamp(connection_handler):
+
+    database.bulk_insert(connection_handler, [make_rows(2000, devices=3)])
+    chunks.compact(connection_handler, BASE + 2000, span=300)
+
+    # Late records inserted in the data table after the compaction
+    late = make_rows(100, BASE + 500.5)
+    database.bulk_insert(connection_handler, [late])
+
+    batches = list(chunks.iterate_rows(connection_handler, BASE + 400, BASE + 1400, chunk_size=64))
+    timestamps = [row[0] for batch in batches for row in batch]
+
+    assert all(len(batch) <= 64 for batch in batches)
+    assert timestamps == sorted(timestamps)
+    assert len(timestamps) == 1000 + 100
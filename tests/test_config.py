@@ -0,0 +1,154 @@
+
+# Import custom subpackages
+from common import database
+from core import config, monitor, supervisor
+from tests.conftest import BASE, make_config, make_config_data, make_rows
+
+# Import standard packages
+import json
+import os
+import queue
+
+import pytest
+
+
+class FakeClient():
+
+    """ MQTT client recording the subscription changes """
+
+    def __init__(self):
+        self.subscribed = []
+        self.unsubscribed = []
+
+    def subscribe(self, topics):
+        self.subscribed.extend(topics)
+
+    def unsubscribe(self, topics):
+        self.unsubscribed.extend(topics)
+
+
+class Component():
+
+    """ Component recording the reloaded parameters """
+
+    def __init__(self):
+        self.changes = []
+
+    def apply_config(self, changes):
+        self.changes.append(changes)
+        return 0
+
+
+def write_config(path, **options):
+
+    """ Writes a configuration file with a new modification time
+
+        :param path: the configuration file path
+        :param options: the overridden configuration keys
+    """
+
+    mtime = os.stat(path).st_mtime_ns + 1_000_000_000 if os.path.exists(path) else None
+
+    with open(path, 'w') as fid:
+        json.dump(make_config_data(**options), fid)
+
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+
+
+@pytest.fixture
+def watcher(tmp_path):
+
+    """ Watcher of a loaded configuration file, recording the applied changes """
+
+    path = str(tmp_path / "config.json")
+    write_config(path)
+
+    appconfig = config.AppConfig(path)
+    assert appconfig.load_app_config() == 0
+
+    changes = []
+    return config.ConfigWatcher(appconfig, changes.append, interval=60), changes
+
+
+def test_watcher_applies_the_tunable_changes_only(watcher):
+
+    watcher, changes = watcher
+    path = watcher.appconfig.config_filename
+
+    assert watcher.check() is None
+
+    write_config(path, recorder_batch_size=500, time_window=600, database="other.db")
+
+    assert watcher.check() == {"recorder_batch_size": 500, "time_window": 600}
+    assert changes == [{"recorder_batch_size": 500, "time_window": 600}]
+    assert watcher.appconfig.recorder_batch_size == 500
+    assert watcher.appconfig.database_filename == "test.db"
+
+    # The file is only reloaded once modified again
+    assert watcher.check() is None
+    assert len(changes) == 1
+
+
+@pytest.mark.parametrize("content", ['{"host": ', json.dumps(make_config_data(recorder_batch_size=0))])
+def test_watcher_ignores_invalid_files(watcher, content):
+
+    watcher, changes = watcher
+    path = watcher.appconfig.config_filename
+    mtime = os.stat(path).st_mtime_ns + 1_000_000_000
+
+    with open(path, 'w') as fid:
+        fid.write(content)
+    os.utime(path, ns=(mtime, mtime))
+
+    assert watcher.check() is None
+    assert changes == []
+    assert watcher.appconfig.recorder_batch_size == 100
+
+
+def test_monitor_updates_the_subscriptions():
+
+    pmonitor = monitor.Monitor(make_config(topic=["vz/a", "vz/b"]), queue.Queue(), client_id="test")
+    pmonitor.client = FakeClient()
+    pmonitor.connected = True
+
+    pmonitor.update_config({"topic": ["vz/b", "vz/c"]})
+
+    assert pmonitor.client.unsubscribed == ["vz/a"]
+    assert pmonitor.client.subscribed == [("vz/c", pmonitor.appconfig.mqtt_qos)]
+    assert pmonitor.appconfig.topic == ["vz/b", "vz/c"]
+
+
+def test_supervisor_forwards_the_changes_to_the_components():
+
+    psupervisor = supervisor.Supervisor(make_config())
+    psupervisor.monitor, psupervisor.recorder = Component(), Component()
+
+    psupervisor.apply_config({"recorder_interval": 2})
+
+    assert psupervisor.monitor.changes == [{"recorder_interval": 2}]
+    assert psupervisor.recorder.changes == [{"recorder_interval": 2}]
+
+
+def test_viewer_backfills_a_larger_time_window(database_path):
+
+    # The plotting backend does not require a display
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    from core import viewer
+
+    connection_handler = database.connect(database_path)
+    database.bulk_insert(connection_handler, [make_rows(300)])
+    database.disconnect(connection_handler)
+
+    pviewer = viewer.Viewer(make_config(database=database_path, time_window=100))
+    connection_handler = database.connect(database_path, readonly=True)
+
+    try:
+        assert pviewer.store.refresh(connection_handler, BASE + 300) == 100
+
+        pviewer.update_config({"time_window": 600})
+
+        assert pviewer.panels[0]["time_window"] == 600
+        assert pviewer.store.refresh(connection_handler, BASE + 300) == 300
+    finally:
+        database.disconnect(connection_handler)
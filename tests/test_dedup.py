@@ -0,0 +1,58 @@
+
+# Import custom subpackages
+from common import dedup
+from tests.conftest import make_record
+
+
+def test_redelivery_is_dropped():
+
+    index = dedup.DedupIndex(capacity=16)
+    records = [make_record(seq=i, device_ts=1000.0 + i) for i in range(10)]
+
+    assert len(index.filter(records)) == 10
+    assert index.filter([make_record(seq=3, device_ts=1003.0)]) == []
+
+
+def test_devices_have_separate_sequences():
+
+    index = dedup.DedupIndex(capacity=16)
+    records = [make_record(seq=1, device_ts=1000.0, device=device) for device in ("vsu-1", "vsu-2")]
+
+    assert len(index.filter(records)) == 2
+
+
+def test_reboot_with_device_timestamps_keeps_readings():
+
+    index = dedup.DedupIndex(capacity=1024)
+    before = [make_record(seq=i, device_ts=1000.0 + i) for i in range(100)]
+    after = [make_record(seq=i, device_ts=5000.0 + i) for i in range(100)]
+
+    assert len(index.filter(before)) == 100
+    assert len(index.filter(after)) == 100
+
+    # The redeliveries of the new sequence are still dropped
+    assert index.filter(after[:10]) == []
+
+
+def test_reboot_without_device_timestamps_clears_the_window():
+
+    index = dedup.DedupIndex(capacity=16)
+
+    assert len(index.filter([make_record(seq=i) for i in range(100)])) == 100
+    assert len(index.filter([make_record(seq=i) for i in range(100)])) == 100
+
+
+def test_late_reading_is_not_a_restart():
+
+    index = dedup.DedupIndex(capacity=16)
+    index.filter([make_record(seq=i, device_ts=1000.0 + i) for i in range(10) if i != 2])
+
+    assert len(index.filter([make_record(seq=2, device_ts=1002.0)])) == 1
+    assert index.filter([make_record(seq=8, device_ts=1008.0)]) == []
+
+
+def test_readings_without_identification_are_kept():
+
+    index = dedup.DedupIndex(capacity=16)
+
+    assert len(index.filter([make_record(), make_record()])) == 2
@@ -0,0 +1,52 @@
+
+# Import custom subpackages
+from common import chunks, database, executor
+from tests.conftest import BASE, make_rows
+
+# Import standard packages
+import pytest
+
+
+@pytest.mark.parametrize("start, end, step, partitions", [
+    (BASE, BASE + 3600, 60, 4),
+    (BASE + 17, BASE + 3599, 60, 3),
+    (BASE, BASE + 100, 60, 8),
+    (BASE + 5, BASE + 6, 3600, 2)
+])
+def test_split_range_covers_range_on_bucket_bounds(start, end, step, partitions):
+
+    bounds = executor.split_range(start, end, step, partitions)
+
+    assert bounds[0][0] == start
+    assert bounds[-1][1] == end
+    assert all(upper == lower for (_, upper), (lower, _) in zip(bounds, bounds[1:]))
+    assert len(bounds) <= partitions
+
+    # Each bucket is computed by one partition
+    assert all(upper % step == 0 for _, upper in bounds[:-1])
+
+
+def test_merge_combines_partial_aggregates():
+
+    partial = {}
+    executor.merge(partial, (BASE, None, "t0"), (2, 30.0, 10.0, 20.0))
+    executor.merge(partial, (BASE, None, "t0"), (1, 5.0, 5.0, 5.0))
+    executor.merge(partial, (BASE, None, "t1"), (1, 7.0, 7.0, 7.0))
+
+    assert partial == {(BASE, None, "t0"): (3, 35.0, 5.0, 20.0), (BASE, None, "t1"): (1, 7.0, 7.0, 7.0)}
+
+
+def test_sql_and_columnar_aggregates_match(connection_handler):
+
+    database.bulk_insert(connection_handler, [make_rows(600, devices=3)])
+
+    sensors = ("t0", "t1", "bz")
+    expected = executor.aggregate_rows(connection_handler, BASE, BASE + 600, 60, sensors, by_device=True)
+
+    chunks.compact(connection_handler, BASE + 600, span=300)
+    columns = chunks.retrieve_chunks(connection_handler, BASE, BASE + 600)
+
+    merged = executor.aggregate_columns(columns, 60, sensors, by_device=True)
+
+    assert merged.keys() == expected.keys()
+    assert all(merged[key] == pytest.approx(expected[key]) for key in expected)
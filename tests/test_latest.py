@@ -0,0 +1,110 @@
+
+# Import custom subpackages
+from common import latest
+
+# Import standard packages
+from multiprocessing import resource_tracker, shared_memory
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.fixture
+def segment():
+
+    segment = latest.LatestSegment(f"vz_test_{os.getpid()}", capacity=8)
+    yield segment
+    segment.close()
+
+
+def make_row(device, t0=20.0):
+
+    """ Creates a latest row
+
+        :param device: the device identifier
+        :param t0: the t0 reading
+        :return: the row tuple (LATEST_COLUMNS values)
+    """
+
+    return (device, "2020/05/01 10:00:00", t0, 21.0, None, 1.0, 300.0, 1)
+
+
+def open_reader(segment):
+
+    """ Attaches a reader to a segment of this process
+
+        :param segment: the LatestSegment object
+        :return: the LatestReader object
+    """
+
+    reader = latest.LatestReader(segment.name)
+
+    # The reader unregisters the segment, which is still removed by its owner here
+    resource_tracker.register(reader.shm._name, 'shared_memory')
+    return reader
+
+
+def test_published_rows_are_read(segment):
+
+    segment.publish([make_row("vsu-1"), make_row("vsu-2", 25.0)])
+    reader = open_reader(segment)
+
+    try:
+        assert reader.get("vsu-2")[2] == 25.0
+        assert reader.get("vsu-1")[4] is None
+        assert reader.get("vsu-3") is None
+        assert set(reader.get_all()) == {"vsu-1", "vsu-2"}
+    finally:
+        reader.close()
+
+
+def test_long_device_identifiers_are_not_published(segment):
+
+    prefix = "x" * latest.MAX_DEVICE_ID_BYTES
+    segment.publish([make_row(prefix, 20.0), make_row(prefix + "-a", 30.0), make_row("é" * 17, 40.0)])
+    reader = open_reader(segment)
+
+    try:
+        # The longer identifiers are not truncated into the slot of another device
+        assert reader.get_all() == {prefix: make_row(prefix, 20.0)}
+        assert segment.rejected == {prefix + "-a", "é" * 17}
+    finally:
+        reader.close()
+
+
+def test_segment_of_running_process_is_not_replaced(segment):
+
+    segment.publish([make_row("vsu-1")])
+
+    with pytest.raises(FileExistsError):
+        latest.LatestSegment(segment.name, capacity=8)
+
+    reader = open_reader(segment)
+
+    try:
+        assert reader.get("vsu-1") == make_row("vsu-1")
+    finally:
+        reader.close()
+
+
+def test_stale_segment_is_replaced():
+
+    name = f"vz_test_stale_{os.getpid()}"
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+
+    # Segment left by an exited owner
+    stale = shared_memory.SharedMemory(name=name, create=True, size=latest.HEADER.size)
+    latest.HEADER.pack_into(stale.buf, 0, 3, 1, process.pid)
+    stale.close()
+    resource_tracker.unregister(stale._name, 'shared_memory')
+
+    segment = latest.LatestSegment(name, capacity=8)
+
+    try:
+        assert latest.HEADER.unpack_from(segment.shm.buf, 0) == (0, 8, os.getpid())
+    finally:
+        segment.close()
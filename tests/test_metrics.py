@@ -0,0 +1,32 @@
+
+# Import custom subpackages
+from common import metrics
+
+
+def get_buckets(histogram):
+
+    """ Returns the cumulative bucket counts of a rendered histogram
+
+        :param histogram: the Histogram object
+        :return: dictionary mapping the 'le' labels to their count
+    """
+
+    lines = [line for line in histogram.render("test") if '_bucket{' in line]
+    return {line.split('le="')[1].split('"')[0]: int(line.rsplit(' ', 1)[1]) for line in lines}
+
+
+def test_histogram_buckets_never_count_values_above_their_bound():
+
+    registry = metrics.Registry()
+    registry.enabled = True
+    histogram = metrics.Histogram("latency", "test", registry, buckets=(0.001, 0.002))
+
+    # 1.005 ms shares a bin starting at 1 ms
+    values = [0.0005, 0.001005, 0.0015, 0.003]
+    for value in values:
+        histogram.observe(value)
+
+    buckets = get_buckets(histogram)
+
+    assert buckets == {"0.001": 1, "0.002": 3, "+Inf": 4}
+    assert all(buckets[le] <= sum(value <= float(le) for value in values) for le in buckets if le != "+Inf")
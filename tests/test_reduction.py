@@ -0,0 +1,86 @@
+
+# Import custom subpackages
+from common import reduction, utils
+from tests.conftest import BASE, make_record
+
+
+def test_deadband_drops_readings_within_tolerance():
+
+    reducer = reduction.DeadbandFilter({"t0": 0.5}, max_interval=300)
+    records = [make_record(i, t0=20.0 + 0.1 * (i % 3)) for i in range(10)]
+
+    assert reducer.filter(records) == records[:1]
+    assert reducer.reduced == 9
+
+
+def test_deadband_keeps_changes_and_heartbeats():
+
+    reducer = reduction.DeadbandFilter({"t0": 0.5}, max_interval=60)
+    records = [make_record(0), make_record(1, t0=21.0), make_record(2, t0=21.0, bz=1),
+               make_record(3, t0=21.0, bz=1), make_record(63, t0=21.0, bz=1)]
+
+    assert reducer.filter(records) == [records[0], records[1], records[2], records[4]]
+
+
+def test_deadband_keeps_late_readings():
+
+    reducer = reduction.DeadbandFilter({"t0": 0.5})
+    reducer.filter([make_record(100)])
+    late = make_record(50)
+
+    assert reducer.filter([late]) == [late]
+    assert reducer.filter([make_record(101)]) == []
+
+
+def test_deadband_tracks_devices_separately():
+
+    reducer = reduction.DeadbandFilter({"t0": 0.5})
+    records = [make_record(0, device="vsu-1"), make_record(0, device="vsu-2"), make_record(1, device="vsu-1")]
+
+    assert reducer.filter(records) == records[:2]
+
+
+def test_summary_means_per_interval():
+
+    reducer = reduction.SummaryAggregator(interval=60)
+
+    assert reducer.filter([make_record(i, t0=20.0 + i % 2) for i in range(60)]) == []
+
+    summaries = reducer.filter([make_record(60)])
+
+    assert len(summaries) == 1
+    assert summaries[0].timestamp == utils.format_naive_timestamp(BASE)
+    assert summaries[0].t0 == 20.5
+    assert summaries[0].bz == 0
+
+    flushed = reducer.flush()
+
+    assert [tlm.timestamp for tlm in flushed] == [utils.format_naive_timestamp(BASE + 60)]
+    assert reducer.reduced == 61 - 2
+
+
+def test_summary_keeps_buzzer_changes():
+
+    reducer = reduction.SummaryAggregator(interval=60)
+    change = make_record(10, bz=1)
+
+    assert reducer.filter([make_record(0), change, make_record(20, bz=1)]) == [change]
+    assert reducer.flush()[0].bz == 0
+
+
+def test_summary_flush_closes_ended_intervals():
+
+    reducer = reduction.SummaryAggregator(interval=60)
+    reducer.filter([make_record(0, device="vsu-1"), make_record(70, device="vsu-2")])
+
+    assert [tlm.id for tlm in reducer.flush(BASE + 90)] == ["vsu-1"]
+    assert [tlm.id for tlm in reducer.flush()] == ["vsu-2"]
+
+
+def test_summary_keeps_late_readings():
+
+    reducer = reduction.SummaryAggregator(interval=60)
+    reducer.filter([make_record(120)])
+    late = make_record(30)
+
+    assert reducer.filter([late]) == [late]
@@ -0,0 +1,127 @@
+
+# Import custom subpackages
+from core import archive, replay
+from tests.conftest import BASE, make_rows, make_config
+
+# Import standard packages
+import queue
+
+import pytest
+
+
+class Clock():
+
+    """ Fake monotonic clock, advanced by the waits of the replay in place
+        of its stop event
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.waits = []
+
+    def monotonic(self):
+        return self.now
+
+    def is_set(self):
+        return False
+
+    def wait(self, delay):
+        self.waits.append(delay)
+        self.now += delay
+        return False
+
+
+@pytest.fixture
+def source(tmp_path):
+
+    """ CSV export of 6 records, one per second """
+
+    path = str(tmp_path / "source.csv")
+    archive.write_csv([make_rows(6)], path)
+    return path
+
+
+def run_replay(source, clock, monkeypatch, **options):
+
+    """ Runs a replay in this process with a fake clock
+
+        :param source: the source file
+        :param clock: the Clock object
+        :param options: the Replay options
+        :return: the list of queued batches
+    """
+
+    q = queue.Queue()
+    process = replay.Replay(make_config(), q, source, **options)
+    process.stop_event = clock
+    monkeypatch.setattr(replay.time, "monotonic", clock.monotonic)
+
+    process.replay()
+
+    assert process.count.value == 6
+    return [q.get_nowait() for _ in range(q.qsize())]
+
+
+def test_replay_keeps_the_intervals_divided_by_the_speed(source, monkeypatch):
+
+    clock = Clock()
+    batches = run_replay(source, clock, monkeypatch, speed=2.0)
+
+    # Each record is queued once its original offset (halved) is reached
+    assert clock.waits == pytest.approx([0.5] * 5)
+    assert [len(batch) for batch in batches] == [1] * 6
+
+
+def test_replay_as_fast_as_possible_queues_batches(source, monkeypatch):
+
+    clock = Clock()
+    batches = run_replay(source, clock, monkeypatch, speed=0, batch_size=4)
+
+    assert clock.waits == []
+    assert [len(batch) for batch in batches] == [4, 2]
+
+
+def test_replay_restamps_the_records_unless_kept(source, monkeypatch):
+
+    rows = make_rows(6)
+
+    restamped = [tlm for batch in run_replay(source, Clock(), monkeypatch, speed=0) for tlm in batch]
+    kept = [tlm for batch in run_replay(source, Clock(), monkeypatch, speed=0, restamp=False) for tlm in batch]
+
+    assert all(tlm.timestamp > rows[-1][0] for tlm in restamped)
+    assert [tlm.timestamp for tlm in kept] == [row[0] for row in rows]
+    assert [(tlm.id, tlm.t0) for tlm in kept] == [(row[1], row[2]) for row in rows]
+
+
+class Supervisor():
+
+    """ Supervisor creating the replay source without starting it """
+
+    instances = []
+
+    def __init__(self, appconfig, client_id, source):
+        self.monitor = source(queue.Queue())
+        self.instances.append(self)
+
+    def start(self):
+        pass
+
+    def wait(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+@pytest.mark.parametrize("options, restamp", [([], True), (["--keep-timestamps"], False)])
+def test_keep_timestamps_option(source, tmp_path, monkeypatch, options, restamp):
+
+    appconfig = make_config()
+
+    monkeypatch.setattr(appconfig, "load_app_config", lambda: 0)
+    monkeypatch.setattr(replay.config, "AppConfig", lambda filename: appconfig)
+    monkeypatch.setattr(replay.supervisor, "Supervisor", Supervisor)
+
+    assert replay.main([source, "--speed", "0", "--database", str(tmp_path / "replay.db")] + options) == 0
+    assert Supervisor.instances[-1].monitor.restamp is restamp
+    assert Supervisor.instances[-1].monitor.speed == 0
@@ -0,0 +1,91 @@
+
+# Import custom subpackages
+from common import resample
+
+# Import standard packages
+import numpy as np
+import pytest
+
+
+def make_columns(timestamps, values):
+
+    """ Creates columnar records of the t0 sensor
+
+        :param timestamps: the record timestamps
+        :param values: the t0 readings
+        :return: the columns dictionary
+    """
+
+    return {"timestamp": np.asarray(timestamps, dtype=float), "t0": np.asarray(values, dtype=float)}
+
+
+@pytest.mark.parametrize("step, seconds", [(5, 5.0), ("10s", 10.0), ("2m", 120.0), ("1h", 3600.0), ("1.5", 1.5)])
+def test_parse_step(step, seconds):
+
+    assert resample.parse_step(step) == seconds
+
+
+@pytest.mark.parametrize("step", [0, -1, "0s", "abc"])
+def test_invalid_step(step):
+
+    with pytest.raises(ValueError):
+        resample.parse_step(step)
+
+
+def test_invalid_fill_mode():
+
+    with pytest.raises(ValueError):
+        resample.resample(make_columns([0], [1]), 1, fill='nearest', sensors=("t0",))
+
+
+def test_bins_hold_means_and_counts():
+
+    result = resample.resample(make_columns([0, 1, 2, 10, 11], [1, 2, 3, 10, 20]), 5, 0, 15, sensors=("t0",))
+
+    assert result["timestamp"].tolist() == [0, 5, 10]
+    assert np.array_equal(result["t0"], [2, np.nan, 15], equal_nan=True)
+    assert result["t0_count"].tolist() == [3, 0, 2]
+    assert result["t0_gap"].tolist() == [False, True, False]
+
+
+def test_ffill_respects_max_gap():
+
+    columns = make_columns([0, 40], [1, 5])
+
+    filled = resample.resample(columns, 10, 0, 50, fill='ffill', sensors=("t0",))
+    limited = resample.resample(columns, 10, 0, 50, fill='ffill', max_gap=20, sensors=("t0",))
+
+    # The gap is measured up to the bin end
+    assert filled["t0"].tolist() == [1, 1, 1, 1, 5]
+    assert np.array_equal(limited["t0"], [1, 1, np.nan, np.nan, 5], equal_nan=True)
+
+
+def test_linear_respects_max_gap():
+
+    columns = make_columns([0, 30, 100], [0, 3, 10])
+
+    filled = resample.resample(columns, 10, 0, 110, fill='linear', sensors=("t0",))
+    limited = resample.resample(columns, 10, 0, 110, fill='linear', max_gap=40, sensors=("t0",))
+
+    assert np.allclose(filled["t0"], np.arange(11))
+    assert np.allclose(limited["t0"][:4], [0, 1, 2, 3])
+    assert np.isnan(limited["t0"][4:10]).all()
+    assert limited["t0"][10] == 10
+
+
+def test_step_holds_last_reading():
+
+    columns = make_columns([5, 12, 13, 60], [1, 2, 3, 4])
+
+    result = resample.resample(columns, 10, 0, 70, fill='step', max_gap=30, sensors=("t0",))
+
+    # The bin value is the last reading before the bin end, not the bin mean
+    assert np.array_equal(result["t0"], [1, 3, 3, 3, np.nan, np.nan, 4], equal_nan=True)
+
+
+def test_no_extrapolation_before_first_reading():
+
+    for fill in ('ffill', 'linear', 'step'):
+        result = resample.resample(make_columns([25, 35], [1, 2]), 10, 0, 40, fill=fill, sensors=("t0",))
+
+        assert np.isnan(result["t0"][:2]).all()
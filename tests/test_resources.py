@@ -0,0 +1,79 @@
+
+# Import custom subpackages
+from common import resources
+
+# Import standard packages
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+def test_validate_limits_accepts_valid_limits():
+
+    limits = {"main": {"cpus": [0], "nice": 5, "memory_mb": 512}, "viewer": {"nice": 19}}
+
+    assert resources.validate_limits(limits) == []
+
+
+@pytest.mark.parametrize("limits", [
+    [],
+    {"recorder": {"nice": 1}},
+    {"main": {"cpus": []}},
+    {"main": {"cpus": [-1]}},
+    {"main": {"nice": 20}},
+    {"main": {"nice": 1.5}},
+    {"main": {"memory_mb": 0}}
+])
+def test_validate_limits_rejects_invalid_limits(limits):
+
+    assert resources.validate_limits(limits) != []
+
+
+# Child process with a running thread, which prints the thread identifier and
+# waits for its standard input to close
+CHILD = """
+import sys, threading
+thread = threading.Thread(target=sys.stdin.read)
+thread.start()
+print(thread.native_id, flush=True)
+thread.join()
+"""
+
+
+@pytest.fixture
+def child():
+
+    """ Child process with a running thread (process, thread identifier) """
+
+    process = subprocess.Popen([sys.executable, "-c", CHILD], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    try:
+        yield process, int(process.stdout.readline())
+    finally:
+        process.stdin.close()
+        process.wait()
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/task'), reason="Linux only")
+def test_limits_apply_to_running_threads(child):
+
+    process, tid = child
+    nice = min(os.getpriority(os.PRIO_PROCESS, process.pid) + 1, 19)
+
+    assert resources.apply_limits(process.pid, "viewer", {"nice": nice}) == 0
+    assert os.getpriority(os.PRIO_PROCESS, tid) == nice
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/task'), reason="Linux only")
+def test_removed_limits_are_restored(child):
+
+    process, tid = child
+    defaults = resources.get_defaults()
+
+    assert resources.apply_limits(process.pid, "viewer", {"cpus": defaults["cpus"][:1]}) == 0
+    assert os.sched_getaffinity(tid) == set(defaults["cpus"][:1])
+
+    assert resources.reset_limits(process.pid, "viewer", ["cpus"], defaults) == 0
+    assert os.sched_getaffinity(tid) == set(defaults["cpus"])
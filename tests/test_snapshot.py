@@ -0,0 +1,98 @@
+
+# Import custom subpackages
+from common import database
+
+# Import standard packages
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def writer(database_path):
+
+    """ Writable connection holding no lock (rollback journal) """
+
+    connection_handler = database.connect(database_path)
+    assert connection_handler.execute("PRAGMA journal_mode=DELETE").fetchone()[0] == "delete"
+    yield connection_handler
+    database.disconnect(connection_handler)
+
+
+@pytest.fixture
+def reader_connection(database_path):
+
+    """ Read-only connection which does not wait for the locks """
+
+    connection_handler = database.SnapshotReader(busy_timeout=0).connect(database_path)
+    yield connection_handler
+    database.disconnect(connection_handler)
+
+
+def test_snapshot_is_attempted_again_once_the_lock_is_released(writer, reader_connection, monkeypatch):
+
+    reader = database.SnapshotReader(busy_timeout=0, retries=5)
+    delays = []
+
+    def sleep(delay):
+        delays.append(delay)
+        if len(delays) == 3:
+            writer.commit()
+
+    writer.execute("BEGIN EXCLUSIVE")
+    monkeypatch.setattr(database.time, "sleep", sleep)
+
+    with reader.snapshot(reader_connection) as connection_handler:
+        assert connection_handler.in_transaction
+        assert connection_handler.execute("SELECT COUNT(*) FROM data").fetchone() == (0,)
+
+    # Exponential backoff until the writer released its lock
+    assert delays == [0.01, 0.02, 0.04]
+    assert not reader_connection.in_transaction
+
+
+def test_snapshot_fails_when_the_database_stays_locked(writer, reader_connection, monkeypatch):
+
+    reader = database.SnapshotReader(max_readers=1, busy_timeout=0, retries=2)
+    delays = []
+
+    writer.execute("BEGIN EXCLUSIVE")
+    monkeypatch.setattr(database.time, "sleep", delays.append)
+
+    try:
+        with pytest.raises(sqlite3.OperationalError, match="locked"):
+            with reader.snapshot(reader_connection):
+                pass
+    finally:
+        writer.rollback()
+
+    assert delays == [0.01, 0.02]
+    assert not reader_connection.in_transaction
+
+    # The reader slot is released after a failure
+    with reader.snapshot(reader_connection):
+        pass
+
+
+def test_snapshots_wait_for_a_reader_slot(database_path):
+
+    reader = database.SnapshotReader(max_readers=1, busy_timeout=0.05)
+    first = reader.connect(database_path)
+    second = reader.connect(database_path)
+
+    try:
+        with reader.snapshot(first):
+            with pytest.raises(sqlite3.OperationalError, match="1 concurrent readers"):
+                with reader.snapshot(second):
+                    pass
+
+        with pytest.raises(RuntimeError):
+            with reader.snapshot(first):
+                raise RuntimeError("query failure")
+
+        # The slots are released on exit, also after an exception
+        with reader.snapshot(second) as connection_handler:
+            assert connection_handler.execute("SELECT COUNT(*) FROM data").fetchone() == (0,)
+    finally:
+        database.disconnect(first)
+        database.disconnect(second)